@@ -0,0 +1,381 @@
+#Copyright 2021 Georg Kempf, Friedrich Miescher Institute for Biomedical Research
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+import os
+import re
+import sys
+import json
+import math
+import fcntl
+import shlex
+import socket
+import argparse
+import datetime
+import logging
+from rosem import utils, scheduler, orchestrator, slurm
+
+logger = logging.getLogger("RosEM")
+
+BATCH_TEMPLATE = 'batch_slurm.j2'
+#Factor applied to the predicted runtime of an allocation to get its time limit.
+TIME_SAFETY_FACTOR = 1.5
+MIN_TIME_LIMIT = 1800
+#Directory (in the batch directory) with cancel requests of packed jobs, one file per job id.
+CANCEL_DIR = 'cancel'
+
+
+def get_batch_dir():
+    batch_dir = os.path.join(utils.get_rosem_dir(), 'batch')
+    if not os.path.exists(batch_dir):
+        os.makedirs(batch_dir, exist_ok=True)
+    return batch_dir
+
+
+def now():
+    return datetime.datetime.now().isoformat(timespec='seconds')
+
+
+def append_log(log_file, msg):
+    try:
+        with open(log_file, 'a') as f:
+            f.write(f"{msg}\n")
+    except OSError:
+        logger.error(f"Could not write to {log_file}.")
+
+
+def get_cancel_file(batch_dir, job_id):
+    return os.path.join(batch_dir, CANCEL_DIR, str(job_id))
+
+
+def find_packed_job(batch_dir, job_id):
+    '''
+    Job with job_id from the batches submitted from batch_dir or None.
+    '''
+    for file in sorted(os.listdir(batch_dir)):
+        if re.match(r'batch_.+\.json$', file):
+            with open(os.path.join(batch_dir, file), 'r') as f:
+                for job in json.load(f)['jobs']:
+                    if job['id'] == job_id:
+                        return job
+    return None
+
+
+def request_cancel(batch_dir, job_id):
+    '''
+    Request to stop a packed job. The allocation running the job terminates its process,
+    the other jobs of the allocation continue.
+    '''
+    os.makedirs(os.path.join(batch_dir, CANCEL_DIR), exist_ok=True)
+    with open(get_cancel_file(batch_dir, job_id), 'w') as f:
+        f.write(f"{now()}\n")
+
+
+def parse_submission_script(submission_script):
+    '''
+    Read the rosemcl command, log file and number of CPUs from a submission script
+    rendered from the queue template.
+    '''
+    command, log_file, cpus = None, None, 1
+    with open(submission_script, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if re.match(r'#SBATCH\s+--output=', line):
+                log_file = line.split('=', 1)[1]
+            elif re.match(r'#SBATCH\s+--cpus-per-task=', line):
+                cpus = int(line.split('=', 1)[1])
+            elif re.match(r'(\S*/)?rosemcl\s', line):
+                command = line
+    if command is None:
+        logger.error(f"No rosemcl command found in {submission_script}.")
+        raise SystemExit
+    return command, log_file, cpus
+
+
+def predict_core_seconds(command, history=None):
+    '''
+    Predict the CPU time of a rosemcl job from its input files and relax options.
+    '''
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--num_models', type=int, default=10)
+    parser.add_argument('--num_cycles', type=int, default=5)
+    parser.add_argument('--weight', default='35')
+    parser.add_argument('--space', default='cartesian')
+    args, unknown = parser.parse_known_args(shlex.split(command)[1:])
+    pdb_file = next((x for x in unknown if x.endswith('.pdb')), None)
+    map_file = next((x for x in unknown if x.endswith('.mrc')), None)
+    features = {'residues': 0,
+                'box': 0,
+                'num_cycles': args.num_cycles,
+                'space': args.space.lower()}
+    if not pdb_file is None and os.path.exists(pdb_file):
+        features['residues'] = utils.get_residue_count(pdb_file)
+    if not map_file is None and os.path.exists(map_file):
+        nx, ny, nz = utils.get_map_dimensions(map_file)
+        features['box'] = nx * ny * nz
+    if history is None:
+        history = scheduler.RuntimeHistory()
+    core_seconds = 0.0
+    for wt in args.weight.split(','):
+        try:
+            features['weight'] = float(wt)
+        except ValueError:
+            features['weight'] = 0.0
+        core_seconds += history.predict(features) * args.num_models
+    return core_seconds
+
+
+class BatchQueue:
+    '''
+    Jobs waiting to be packed into a queue allocation. Stored in ~/.rosem/batch/pending.json.
+    '''
+    def __init__(self, batch_dir=None):
+        if batch_dir is None:
+            batch_dir = get_batch_dir()
+        self.batch_dir = batch_dir
+        self.queue_file = os.path.join(batch_dir, 'pending.json')
+
+    def _load(self):
+        if os.path.exists(self.queue_file):
+            with open(self.queue_file, 'r') as f:
+                return json.load(f)
+        return {'next_id': 1, 'jobs': []}
+
+    def _save(self, queue):
+        tmp_file = f"{self.queue_file}.{os.getpid()}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(queue, f, indent=2)
+        os.replace(tmp_file, self.queue_file)
+
+    def _update(self, func):
+        with open(f"{self.queue_file}.lock", 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            queue = self._load()
+            result = func(queue)
+            self._save(queue)
+        return result
+
+    def add(self, job):
+        def _add(queue):
+            job['id'] = queue['next_id']
+            queue['next_id'] += 1
+            queue['jobs'].append(job)
+            return job['id']
+        return self._update(_add)
+
+    def remove(self, job_ids):
+        def _remove(queue):
+            removed = [x for x in queue['jobs'] if x['id'] in job_ids]
+            queue['jobs'] = [x for x in queue['jobs'] if not x['id'] in job_ids]
+            return removed
+        return self._update(_remove)
+
+    def get_jobs(self):
+        return self._load()['jobs']
+
+
+def pack_jobs(jobs, max_cpus, max_hours):
+    '''
+    First-fit decreasing packing of jobs into allocations of max_cpus CPUs for max_hours.
+    A job that does not fit into an empty allocation gets its own allocation.
+    '''
+    capacity = max_cpus * max_hours * 3600
+    allocations = []
+    for job in sorted(jobs, key=lambda x: x['core_seconds'], reverse=True):
+        for allocation in allocations:
+            if allocation['core_seconds'] + job['core_seconds'] <= capacity:
+                allocation['jobs'].append(job)
+                allocation['core_seconds'] += job['core_seconds']
+                break
+        else:
+            if job['core_seconds'] > capacity:
+                logger.warning(f"Job {job['id']} is predicted to need more than {max_hours} hours on {max_cpus} CPUs.")
+            allocations.append({'jobs': [job], 'core_seconds': job['core_seconds']})
+    for allocation in allocations:
+        allocation['cpus'] = max(1, min(max_cpus, sum([min(x['cpus'], max_cpus) for x in allocation['jobs']])))
+        #The allocation takes at least as long as its longest job
+        walltime = max(allocation['core_seconds'] / allocation['cpus'],
+                       max([x['core_seconds'] / min(x['cpus'], allocation['cpus']) for x in allocation['jobs']]))
+        allocation['time_limit'] = max(MIN_TIME_LIMIT, int(math.ceil(walltime * TIME_SAFETY_FACTOR)))
+    return allocations
+
+
+def submit_batches(batch_queue, max_cpus, max_hours, mem_per_cpu=1, account=None, sbatch='sbatch'):
+    jobs = batch_queue.get_jobs()
+    if jobs == []:
+        logger.info("No pending jobs.")
+        return []
+    submitted = []
+    for i, allocation in enumerate(pack_jobs(jobs, max_cpus, max_hours)):
+        name = f"batch_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}_{i}"
+        batch_file = os.path.join(batch_queue.batch_dir, f"{name}.json")
+        with open(batch_file, 'w') as f:
+            json.dump(allocation, f, indent=2)
+        batch_script = os.path.join(batch_queue.batch_dir, f"{name}.run")
+        command = ' '.join([shlex.quote(x) for x in [sys.executable, '-m', 'rosem.batch', 'run', batch_file]])
+        slurm.write_script(batch_script, slurm.render_template(BATCH_TEMPLATE,
+                                                               account=account,
+                                                               cpu=allocation['cpus'],
+                                                               mem=mem_per_cpu,
+                                                               time=scheduler.format_duration(allocation['time_limit']),
+                                                               logfile=os.path.join(batch_queue.batch_dir, f"{name}.log"),
+                                                               command=command))
+        queue_job_id = slurm.submit(batch_script, sbatch)
+        batch_queue.remove([x['id'] for x in allocation['jobs']])
+        for job in allocation['jobs']:
+            append_log(job['log_file'], f"[INFO] [{now()}] Job packed into batch allocation {name} (queue job {queue_job_id})"
+                                        f" with {len(allocation['jobs'])} jobs.")
+            #The batch job id, so that the job is cancelled with rosembatch cancel and not the whole allocation
+            append_log(job['log_file'], f"[INFO] [{now()}] QUEUE_JOB_ID={job['id']}")
+        logger.info(f"Submitted {name} as job {queue_job_id}: {len(allocation['jobs'])} jobs, {allocation['cpus']} CPUs,"
+                    f" time limit {scheduler.format_duration(allocation['time_limit'])}.")
+        submitted.append((queue_job_id, allocation))
+    return submitted
+
+
+def run_batch(batch_file, cpus=None):
+    '''
+    Run the jobs of a batch in the current allocation. Jobs are started longest first and
+    the output, start and exit code of each job are appended to its own log file.
+    Jobs with a cancel request (rosembatch cancel) are stopped without affecting the other jobs.
+    '''
+    batch_dir = os.path.dirname(os.path.abspath(batch_file))
+    with open(batch_file, 'r') as f:
+        allocation = json.load(f)
+    if cpus is None:
+        cpus = int(os.environ.get('SLURM_CPUS_PER_TASK', os.cpu_count()))
+    queue_job_id = os.environ.get('SLURM_JOB_ID', '')
+    jobs = {job['id']: job for job in allocation['jobs']}
+    tasks = []
+    for job in sorted(allocation['jobs'], key=lambda x: x['core_seconds'], reverse=True):
+        tasks.append(orchestrator.Task(f"Batch job {job['id']}",
+                                       job['command'],
+                                       job['job_dir'],
+                                       job['log_file'],
+                                       key=job['id'],
+                                       slots=job['cpus'],
+                                       append=True))
+
+    def is_cancelled(task):
+        return os.path.exists(get_cancel_file(batch_dir, task.key))
+
+    def on_start(task):
+        job = jobs[task.key]
+        append_log(job['log_file'], f"[INFO] [{now()}] Starting job in batch allocation {queue_job_id} on {socket.gethostname().split('.')[0]}")
+        logger.info(f"Starting {task.name} in {job['job_dir']}.")
+
+    def on_finish(task):
+        job = jobs[task.key]
+        if task.cancelled:
+            append_log(job['log_file'], f"[INFO] [{now()}] Job CANCELLED in batch allocation {queue_job_id}.")
+            append_log(job['log_file'], "Job finished with exit code 2")
+            logger.info(f"{task.name} cancelled.")
+            try:
+                os.remove(get_cancel_file(batch_dir, task.key))
+            except OSError:
+                pass
+            return
+        append_log(job['log_file'], f"[INFO] [{now()}] Workflow finished with code {task.returncode}")
+        append_log(job['log_file'], f"[INFO] [{now()}] Workflow execution time (seconds): {int(task.duration)}")
+        logger.info(f"{task.name} finished with code {task.returncode} after {scheduler.format_duration(task.duration)}.")
+
+    orchestrator.TaskOrchestrator(cpus, on_start=on_start, on_finish=on_finish, is_cancelled=is_cancelled).run(tasks)
+    return tasks
+
+
+def get_cli_args():
+    parser = argparse.ArgumentParser(description="Pack many RosEM jobs into few queue allocations.")
+    parser.add_argument('--batch_dir',
+                        help="Directory for the pending job list and batch scripts. Default=~/.rosem/batch")
+    parser.add_argument('--debug',
+                        help="Enable debug mode.",
+                        action='store_true')
+    subparsers = parser.add_subparsers(dest='command')
+    add = subparsers.add_parser('add', help="Add a job given by its submission script to the pending jobs.")
+    add.add_argument('submission_script')
+    subparsers.add_parser('list', help="List pending jobs.")
+    cancel = subparsers.add_parser('cancel', help="Remove a pending job or stop a job packed into an allocation.")
+    cancel.add_argument('job_id', type=int)
+    submit = subparsers.add_parser('submit', help="Pack pending jobs into allocations and submit them.")
+    submit.add_argument('--max_cpus',
+                        help="Maximum number of CPUs per allocation. Default=16",
+                        default=16,
+                        type=int)
+    submit.add_argument('--max_hours',
+                        help="Maximum predicted runtime of an allocation in hours. Default=24",
+                        default=24,
+                        type=float)
+    submit.add_argument('--mem_per_cpu',
+                        help="Memory per CPU in GB. Default=2",
+                        default=2,
+                        type=int)
+    submit.add_argument('--account',
+                        help="Queue account.")
+    submit.add_argument('--sbatch',
+                        help="Command used to submit jobs. Default=sbatch",
+                        default='sbatch')
+    run = subparsers.add_parser('run', help="Run a batch inside its allocation.")
+    run.add_argument('batch_file')
+    run.add_argument('--cpus',
+                     help="Number of CPUs. Default=SLURM_CPUS_PER_TASK or all CPUs.",
+                     type=int)
+    args = parser.parse_args()
+    if args.command is None:
+        parser.print_help()
+        raise SystemExit
+    return args
+
+
+def main():
+    args = get_cli_args()
+    logger.addHandler(logging.StreamHandler())
+    logger.setLevel(logging.DEBUG if args.debug else logging.INFO)
+    batch_queue = BatchQueue(args.batch_dir)
+    if args.command == 'add':
+        submission_script = os.path.abspath(args.submission_script)
+        command, log_file, cpus = parse_submission_script(submission_script)
+        job_dir = os.path.dirname(submission_script)
+        if log_file is None:
+            log_file = os.path.join(job_dir, 'batch_job.log')
+        log_file = os.path.join(job_dir, log_file)
+        job_id = batch_queue.add({'job_dir': job_dir,
+                                  'command': command,
+                                  'log_file': log_file,
+                                  'cpus': cpus,
+                                  'core_seconds': predict_core_seconds(command),
+                                  'added': now()})
+        append_log(log_file, f"[INFO] [{now()}] Job added to batch queue as pending job {job_id}.")
+        print(f"Queued batch job {job_id}")
+    elif args.command == 'list':
+        for job in batch_queue.get_jobs():
+            print(f"{job['id']}\t{job['cpus']} CPUs\t{job['core_seconds'] / 3600:.2f} core-hours\t{job['added']}\t{job['job_dir']}")
+    elif args.command == 'cancel':
+        removed = batch_queue.remove([args.job_id])
+        if removed == []:
+            job = find_packed_job(batch_queue.batch_dir, args.job_id)
+            if job is None:
+                print(f"No pending or packed job {args.job_id}.")
+                raise SystemExit(1)
+            request_cancel(batch_queue.batch_dir, args.job_id)
+            append_log(job['log_file'], f"[INFO] [{now()}] Cancel requested. The job is stopped inside its batch allocation.")
+            print(f"Cancel requested for batch job {args.job_id}")
+        for job in removed:
+            append_log(job['log_file'], f"[INFO] [{now()}] Job CANCELLED before submission.")
+            append_log(job['log_file'], "Job finished with exit code 2")
+    elif args.command == 'submit':
+        submit_batches(batch_queue, args.max_cpus, args.max_hours, args.mem_per_cpu, args.account, args.sbatch)
+    elif args.command == 'run':
+        run_batch(args.batch_file, args.cpus)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+#Copyright 2021 Georg Kempf, Friedrich Miescher Institute for Biomedical Research
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+import os
+import json
+import time
+import shutil
+import argparse
+import datetime
+import logging
+from rosem import utils
+
+logger = logging.getLogger("RosEM")
+
+META_FILE = 'meta.json'
+
+
+def get_cache_dir():
+    return os.path.join(utils.get_rosem_dir(), 'cache')
+
+
+class ResultCache:
+    '''
+    Content-addressed store of task results. Each entry is a directory named by the
+    key (hash of all task inputs) that holds the cached files and a meta.json file.
+    Entries are grouped by namespace, e.g. relax for rosetta_scripts results.
+    '''
+    def __init__(self, cache_dir=None, namespace='relax'):
+        if cache_dir is None:
+            cache_dir = get_cache_dir()
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.namespace = namespace
+
+    def get_entry_dir(self, key, namespace=None):
+        if namespace is None:
+            namespace = self.namespace
+        return os.path.join(self.cache_dir, namespace, key[:2], key)
+
+    def contains(self, key):
+        return os.path.exists(os.path.join(self.get_entry_dir(key), META_FILE))
+
+    def _read_meta(self, entry_dir):
+        with open(os.path.join(entry_dir, META_FILE), 'r') as f:
+            return json.load(f)
+
+    def _write_meta(self, entry_dir, meta):
+        tmp_file = os.path.join(entry_dir, f"{META_FILE}.{os.getpid()}.tmp")
+        with open(tmp_file, 'w') as f:
+            json.dump(meta, f, indent=2)
+        os.replace(tmp_file, os.path.join(entry_dir, META_FILE))
+
+    def store(self, key, files, metadata=None):
+        '''
+        Copy files into the cache.
+        files: dict of name in cache -> path of the file to store
+        '''
+        entry_dir = self.get_entry_dir(key)
+        if self.contains(key):
+            return entry_dir
+        tmp_dir = f"{entry_dir}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(tmp_dir, exist_ok=True)
+            for name, path in files.items():
+                shutil.copyfile(path, os.path.join(tmp_dir, name))
+            now = time.time()
+            meta = {'key': key,
+                    'namespace': self.namespace,
+                    'files': list(files.keys()),
+                    'created': now,
+                    'last_used': now,
+                    'metadata': metadata if not metadata is None else {}}
+            self._write_meta(tmp_dir, meta)
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            #Another job stored the same entry in the meantime or the cache is not writable.
+            logger.debug(f"Could not store {key} in cache.", exc_info=True)
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        return entry_dir
+
+    def restore(self, key, files):
+        '''
+        Copy cached files to their destinations. Returns False if the entry is not in the cache.
+        files: dict of name in cache -> destination path
+        '''
+        if not self.contains(key):
+            return False
+        entry_dir = self.get_entry_dir(key)
+        try:
+            meta = self._read_meta(entry_dir)
+            for name, path in files.items():
+                shutil.copyfile(os.path.join(entry_dir, name), path)
+            meta['last_used'] = time.time()
+            self._write_meta(entry_dir, meta)
+        except (OSError, ValueError):
+            logger.debug(f"Could not restore {key} from cache.", exc_info=True)
+            return False
+        return True
+
+    def get_path(self, key, name):
+        if not self.contains(key):
+            return None
+        return os.path.join(self.get_entry_dir(key), name)
+
+    def list_entries(self, namespace=None):
+        entries = []
+        namespaces = [namespace] if not namespace is None else self.get_namespaces()
+        for ns in namespaces:
+            ns_dir = os.path.join(self.cache_dir, ns)
+            if not os.path.isdir(ns_dir):
+                continue
+            for prefix in os.listdir(ns_dir):
+                for key in os.listdir(os.path.join(ns_dir, prefix)):
+                    entry_dir = os.path.join(ns_dir, prefix, key)
+                    if key.endswith('.tmp') or not os.path.exists(os.path.join(entry_dir, META_FILE)):
+                        continue
+                    try:
+                        meta = self._read_meta(entry_dir)
+                    except ValueError:
+                        continue
+                    meta['namespace'] = ns
+                    meta['size'] = sum(os.path.getsize(os.path.join(entry_dir, x)) for x in os.listdir(entry_dir))
+                    entries.append(meta)
+        return entries
+
+    def get_namespaces(self):
+        if not os.path.isdir(self.cache_dir):
+            return []
+        return [x for x in os.listdir(self.cache_dir) if os.path.isdir(os.path.join(self.cache_dir, x))]
+
+    def remove(self, key, namespace=None):
+        entry_dir = self.get_entry_dir(key, namespace)
+        if os.path.exists(entry_dir):
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            return True
+        return False
+
+    def prune(self, max_size=None, older_than=None, namespace=None):
+        '''
+        Remove entries not used for older_than days and the least recently used entries
+        until the cache is smaller than max_size bytes. Returns the removed entries.
+        '''
+        entries = sorted(self.list_entries(namespace), key=lambda x: x['last_used'])
+        removed = []
+        if not older_than is None:
+            cutoff = time.time() - older_than * 86400
+            for entry in [x for x in entries if x['last_used'] < cutoff]:
+                self.remove(entry['key'], entry['namespace'])
+                removed.append(entry)
+            entries = [x for x in entries if not x in removed]
+        if not max_size is None:
+            total = sum(x['size'] for x in entries)
+            while total > max_size and not entries == []:
+                entry = entries.pop(0)
+                self.remove(entry['key'], entry['namespace'])
+                removed.append(entry)
+                total -= entry['size']
+        return removed
+
+
+def format_size(size):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+
+def format_time(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M')
+
+
+def get_cli_args():
+    parser = argparse.ArgumentParser(description="Inspect and prune the RosEM result cache.")
+    parser.add_argument('--cache_dir',
+                        help="Cache directory. Default=~/.rosem/cache")
+    parser.add_argument('--namespace',
+                        help="Only consider entries of this namespace (e.g. relax).")
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('list', help="List cache entries.")
+    subparsers.add_parser('stats', help="Show number and size of cache entries.")
+    info = subparsers.add_parser('info', help="Show metadata of a cache entry.")
+    info.add_argument('key')
+    prune = subparsers.add_parser('prune', help="Remove old or least recently used entries.")
+    prune.add_argument('--max_size',
+                       help="Maximum cache size in GB.",
+                       type=float)
+    prune.add_argument('--older_than',
+                       help="Remove entries not used for the given number of days.",
+                       type=float)
+    subparsers.add_parser('clear', help="Remove all entries.")
+    args = parser.parse_args()
+    if args.command is None:
+        parser.print_help()
+        raise SystemExit
+    return args
+
+
+def main():
+    args = get_cli_args()
+    cache = ResultCache(args.cache_dir)
+    if args.command == 'list':
+        for entry in sorted(cache.list_entries(args.namespace), key=lambda x: x['last_used']):
+            print(f"{entry['namespace']}\t{entry['key'][:16]}\t{format_size(entry['size'])}\t"
+                  f"last used {format_time(entry['last_used'])}\t{json.dumps(entry['metadata'])}")
+    elif args.command == 'stats':
+        entries = cache.list_entries(args.namespace)
+        for ns in sorted({x['namespace'] for x in entries}):
+            ns_entries = [x for x in entries if x['namespace'] == ns]
+            print(f"{ns}: {len(ns_entries)} entries, {format_size(sum(x['size'] for x in ns_entries))}")
+        print(f"Total: {len(entries)} entries, {format_size(sum(x['size'] for x in entries))} in {cache.cache_dir}")
+    elif args.command == 'info':
+        matches = [x for x in cache.list_entries(args.namespace) if x['key'].startswith(args.key)]
+        if matches == []:
+            print(f"No entry found for {args.key}.")
+            raise SystemExit(1)
+        for entry in matches:
+            print(json.dumps(entry, indent=2))
+    elif args.command == 'prune':
+        max_size = args.max_size * 1024 ** 3 if not args.max_size is None else None
+        removed = cache.prune(max_size=max_size, older_than=args.older_than, namespace=args.namespace)
+        print(f"Removed {len(removed)} entries ({format_size(sum(x['size'] for x in removed))}).")
+    elif args.command == 'clear':
+        removed = cache.prune(max_size=0, namespace=args.namespace)
+        print(f"Removed {len(removed)} entries ({format_size(sum(x['size'] for x in removed))}).")
+
+
+if __name__ == '__main__':
+    main()
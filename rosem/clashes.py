@@ -0,0 +1,66 @@
+#Copyright 2021 Georg Kempf, Friedrich Miescher Institute for Biomedical Research
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+import logging
+import numpy as np
+from rosem.preprocess import Atoms
+from rosem.spatial import get_neighbor_pairs
+
+logger = logging.getLogger("RosEM")
+
+#Van der Waals radii of heavy atoms (Angstrom). Unknown elements use DEFAULT_RADIUS.
+VDW_RADII = {'C': 1.7, 'N': 1.55, 'O': 1.52, 'S': 1.8, 'P': 1.8, 'SE': 1.9}
+DEFAULT_RADIUS = 1.7
+#Overlap (Angstrom) that counts as serious clash as in molprobity
+CLASH_OVERLAP = 0.4
+#Additional overlap allowed between polar atoms that can form hydrogen bonds
+HBOND_OVERLAP = 0.6
+POLAR_ELEMENTS = ['N', 'O']
+#Atoms bonded to the neighboring residue. Pairs of these atoms with atoms of the neighbor are not checked.
+LINK_ATOMS = ['N', 'CA', 'C', 'O', 'OXT', 'P', 'OP1', 'OP2', 'O1P', 'O2P', "O5'", "C5'", "C4'", "C3'", "O3'"]
+
+
+def get_clashes(pdb_file):
+    '''
+    Nonbonded heavy-atom pairs that overlap by at least CLASH_OVERLAP. Pairs within a residue, pairs of
+    link atoms with the neighboring residue and disulfides are skipped. Polar pairs are allowed an
+    additional HBOND_OVERLAP. Returns the number of clashes and the number of atoms.
+    '''
+    atoms = Atoms(pdb_file, hydrogens=False)
+    if len(atoms) == 0:
+        return 0, 0
+    coords, elements, names, residues, chains = atoms.coords, atoms.elements, atoms.names, atoms.positions, atoms.chains
+    radii = np.array([VDW_RADII.get(x, DEFAULT_RADIUS) for x in elements])
+    cutoff = 2 * max(radii.max(), DEFAULT_RADIUS) - CLASH_OVERLAP
+    pairs = get_neighbor_pairs(coords, cutoff)
+    i, j = pairs[:, 0], pairs[:, 1]
+    distance = np.linalg.norm(coords[i] - coords[j], axis=1)
+    polar = np.isin(elements[i], POLAR_ELEMENTS) & np.isin(elements[j], POLAR_ELEMENTS)
+    overlap = radii[i] + radii[j] - distance - np.where(polar, HBOND_OVERLAP, 0.0)
+    same_residue = residues[i] == residues[j]
+    link = np.isin(names[i], LINK_ATOMS) | np.isin(names[j], LINK_ATOMS)
+    neighbors = (np.abs(residues[i] - residues[j]) == 1) & (chains[i] == chains[j]) & link
+    disulfide = (names[i] == 'SG') & (names[j] == 'SG')
+    clashes = (overlap >= CLASH_OVERLAP) & ~same_residue & ~neighbors & ~disulfide
+    return int(np.sum(clashes)), len(coords)
+
+
+def get_clashscore(pdb_file):
+    '''
+    Approximate clashscore: clashes per 1000 heavy atoms. Molprobity also counts hydrogens,
+    so the values are comparable between models but not identical to molprobity.
+    '''
+    num_clashes, num_atoms = get_clashes(pdb_file)
+    if num_atoms == 0:
+        return 0.0
+    return 1000.0 * num_clashes / num_atoms
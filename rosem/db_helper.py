@@ -206,6 +206,8 @@ class DBHelper:
         stmts += ['ALTER TABLE settings ADD queue_account VARCHAR DEFAULT NULL']
         stmts += ['ALTER TABLE validation ADD density_weight INTEGER DEFAULT NULL']
         stmts += ['ALTER TABLE job ADD active BOOLEAN DEFAULT FALSE']
+        stmts += ['ALTER TABLE fastrelaxparams ADD cache BOOLEAN DEFAULT FALSE']
+        stmts += ['ALTER TABLE fastrelaxparams ADD resample_map BOOLEAN DEFAULT FALSE']
         stmts += ['ALTER TABLE validation RENAME COLUMN bonds TO bond_rmsd']
         stmts += ['ALTER TABLE validation RENAME COLUMN bond_rmsd TO bonds']
         stmts += ['ALTER TABLE fastrelaxparams DROP COLUMN sc_weights',
@@ -0,0 +1,255 @@
+#Copyright 2021 Georg Kempf, Friedrich Miescher Institute for Biomedical Research
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+import logging
+import numpy as np
+from rosem import mrc
+from rosem.preprocess import Atoms
+
+logger = logging.getLogger("RosEM")
+
+#Scattering weight of atoms (atomic number). Unknown elements are counted as carbon.
+ATOMIC_NUMBERS = {'C': 6, 'N': 7, 'O': 8, 'P': 15, 'S': 16, 'SE': 34, 'MG': 12, 'ZN': 30, 'FE': 26, 'CA': 20}
+DEFAULT_ATOMIC_NUMBER = 6
+#Standard deviation of the gaussian atoms relative to the resolution (as in chimera molmap).
+SIGMA_FACTOR = 0.225
+#Radius of the atom mask for CC_mask is the resolution limited to this range (Angstrom).
+MIN_MASK_RADIUS = 1.0
+MAX_MASK_RADIUS = 3.0
+#Atoms per chunk for the atom mask
+ATOM_CHUNK = 10000
+
+
+def read_atoms(pdb_file):
+    '''
+    Coordinates and atomic numbers of the heavy atoms in the first model of a PDB file.
+    '''
+    atoms = Atoms(pdb_file, hydrogens=False)
+    return atoms.coords, get_weights(atoms.elements)
+
+
+def get_weights(elements):
+    return np.array([ATOMIC_NUMBERS.get(x, DEFAULT_ATOMIC_NUMBER) for x in elements], dtype=float)
+
+
+def read_map(map_file):
+    '''
+    Read a map in x, y, z order.
+    Returns the data, the voxel size and the position (in Angstrom) of the first voxel.
+    '''
+    with mrc.MrcFile(map_file) as map_in:
+        if not np.allclose(map_in.header['cellb'], 90.0):
+            raise mrc.MrcError(f"Non-orthogonal cell of {map_file} not supported.")
+        axes = map_in.axes
+        voxel_size = map_in.voxel_size
+        origin = map_in.origin.copy()
+        for i, axis in enumerate(axes):
+            origin[axis] += map_in.nstart[i] * voxel_size[axis]
+        #File order (sections, rows, columns) to x, y, z
+        data = np.transpose(map_in.read(), [2 - axes.index(x) for x in range(3)])
+    return np.ascontiguousarray(data), voxel_size, origin
+
+
+def bin_map(data, voxel_size, origin, max_voxel_size):
+    '''
+    Average blocks of voxels so that the voxel size does not exceed max_voxel_size.
+    '''
+    factors = [max(1, int(max_voxel_size // x)) for x in voxel_size]
+    if factors == [1, 1, 1]:
+        return data, voxel_size, origin
+    shape = [n // f for n, f in zip(data.shape, factors)]
+    data = data[:shape[0] * factors[0], :shape[1] * factors[1], :shape[2] * factors[2]]
+    data = data.reshape(shape[0], factors[0], shape[1], factors[1], shape[2], factors[2]).mean(axis=(1, 3, 5))
+    factors = np.array(factors)
+    return data, voxel_size * factors, origin + (factors - 1) / 2 * voxel_size
+
+
+def _get_squared_frequencies(shape, voxel_size):
+    '''
+    Squared spatial frequency (1/Angstrom^2) of the rfftn coefficients.
+    '''
+    freqs = [np.fft.fftfreq(n, d) for n, d in zip(shape[:2], voxel_size[:2])]
+    freqs.append(np.fft.rfftfreq(shape[2], voxel_size[2]))
+    return sum([np.square(f).reshape([-1 if i == dim else 1 for i in range(3)]) for dim, f in enumerate(freqs)])
+
+
+def get_gaussian_filter(shape, voxel_size, sigma):
+    '''
+    Fourier transform (rfftn layout) of a normalized gaussian with standard deviation sigma (Angstrom).
+    '''
+    return np.exp(-2 * np.pi ** 2 * sigma ** 2 * _get_squared_frequencies(shape, voxel_size))
+
+
+def splat_atoms(coords, weights, shape, voxel_size, origin):
+    '''
+    Distribute the atom weights to the 8 neighboring voxels (trilinear).
+    Positions outside of the box are wrapped around (periodic box).
+    '''
+    position = (coords - origin) / voxel_size
+    lower = np.floor(position).astype(int)
+    frac = position - lower
+    grid = np.zeros(int(np.prod(shape)))
+    for corner in np.ndindex(2, 2, 2):
+        corner = np.array(corner)
+        index = np.mod(lower + corner, shape)
+        w = weights * np.prod(np.where(corner == 1, frac, 1 - frac), axis=1)
+        grid += np.bincount(np.ravel_multi_index(index.T, shape), weights=w, minlength=grid.size)
+    return grid.reshape(shape)
+
+
+def simulate_map(coords, weights, shape, voxel_size, origin, resolution):
+    '''
+    Model map of gaussian atoms with a width of SIGMA_FACTOR * resolution on the given grid.
+    '''
+    grid = splat_atoms(coords, weights, shape, voxel_size, origin)
+    sigma = SIGMA_FACTOR * float(resolution)
+    return np.fft.irfftn(np.fft.rfftn(grid) * get_gaussian_filter(shape, voxel_size, sigma), s=shape)
+
+
+def get_shells(shape, voxel_size):
+    '''
+    Resolution shell of each rfftn coefficient and the resolution (Angstrom) at the center of each shell.
+    The shell width is the coarsest frequency step of the axes. Coefficients beyond the Nyquist
+    frequency of the coarsest axis are assigned to the extra shell len(resolution).
+    '''
+    width = max([1.0 / (n * d) for n, d in zip(shape, voxel_size)])
+    num_shells = int(min([0.5 / d for d in voxel_size]) / width)
+    shells = np.floor(np.sqrt(_get_squared_frequencies(shape, voxel_size)) / width).astype(int)
+    shells[shells > num_shells] = num_shells
+    resolution = 1.0 / ((np.arange(num_shells) + 0.5) * width)
+    return shells.ravel(), resolution
+
+
+def get_fsc(ft_1, ft_2, shells, num_shells):
+    '''
+    Fourier shell correlation of two maps from their rfftn coefficients.
+    '''
+    def shell_sum(values):
+        return np.bincount(shells, weights=values.ravel(), minlength=num_shells + 1)[:num_shells]
+    numerator = shell_sum((ft_1 * np.conj(ft_2)).real)
+    denominator = np.sqrt(shell_sum(np.abs(ft_1) ** 2) * shell_sum(np.abs(ft_2) ** 2))
+    return np.divide(numerator, denominator, out=np.zeros(num_shells), where=denominator > 0)
+
+
+def get_band_fsc(resolution, fsc, res_low, res_high):
+    '''
+    Mean FSC of the shells between res_low and res_high (Angstrom) as reported by rosetta ReportFSC.
+    '''
+    resolution, fsc = np.asarray(resolution), np.asarray(fsc)
+    band = (resolution <= float(res_low)) & (resolution >= float(res_high))
+    if not np.any(band):
+        return None
+    return float(fsc[band].mean())
+
+
+def get_correlation(map_1, map_2):
+    map_1, map_2 = map_1 - map_1.mean(), map_2 - map_2.mean()
+    denominator = np.sqrt(np.sum(map_1 ** 2) * np.sum(map_2 ** 2))
+    return float(np.sum(map_1 * map_2) / denominator) if denominator > 0 else 0.0
+
+
+def _get_sphere_offsets(voxel_size, radius):
+    extent = np.ceil(radius / voxel_size).astype(int)
+    offsets = np.stack(np.meshgrid(*[np.arange(-x, x + 1) for x in extent], indexing='ij'), axis=-1).reshape(-1, 3)
+    return offsets[np.sum((offsets * voxel_size) ** 2, axis=1) <= radius ** 2]
+
+
+def get_atom_mask(coords, shape, voxel_size, origin, radius):
+    '''
+    Voxels within radius (Angstrom) of an atom.
+    '''
+    offsets = _get_sphere_offsets(voxel_size, radius)
+    centers = np.rint((coords - origin) / voxel_size).astype(int)
+    mask = np.zeros(shape, dtype=bool)
+    for start in range(0, len(centers), ATOM_CHUNK):
+        index = (centers[start:start + ATOM_CHUNK, None, :] + offsets[None, :, :]).reshape(-1, 3)
+        index = index[np.all((index >= 0) & (index < shape), axis=1)]
+        mask[tuple(index.T)] = True
+    return mask
+
+
+class MapMetrics:
+    '''
+    Model-map FSC curves, CC_mask and CC_box of models against a map and optional test map.
+    The maps and their Fourier transforms are read once and used for all models.
+    '''
+    def __init__(self, map_file, resolution, test_map=None):
+        self.resolution = float(resolution)
+        self.data, self.voxel_size, self.origin = read_map(map_file)
+        self.map_ft = np.fft.rfftn(self.data)
+        self.test_ft = None
+        if not test_map is None:
+            test_data, test_voxel_size, _ = read_map(test_map)
+            if not test_data.shape == self.data.shape or not np.allclose(test_voxel_size, self.voxel_size):
+                raise mrc.MrcError(f"Grid of {test_map} differs from {map_file}.")
+            self.test_ft = np.fft.rfftn(test_data)
+        self.shells, self.shell_resolution = get_shells(self.data.shape, self.voxel_size)
+        self.gaussian = get_gaussian_filter(self.data.shape, self.voxel_size, SIGMA_FACTOR * self.resolution)
+
+    def _get_mask_radius(self):
+        return min(max(self.resolution, MIN_MASK_RADIUS), MAX_MASK_RADIUS)
+
+    def _get_model_map(self, coords, weights):
+        '''
+        Simulated model map and its rfftn coefficients.
+        '''
+        shape = self.data.shape
+        model_ft = np.fft.rfftn(splat_atoms(coords, weights, shape, self.voxel_size, self.origin)) * self.gaussian
+        return np.fft.irfftn(model_ft, s=shape), model_ft
+
+    def get_metrics(self, pdb_file):
+        '''
+        Metrics of a model as dict with the FSC curve(s) by shell resolution, cc_mask and cc_box.
+        '''
+        coords, weights = read_atoms(pdb_file)
+        model, model_ft = self._get_model_map(coords, weights)
+        num_shells = len(self.shell_resolution)
+        mask = get_atom_mask(coords, self.data.shape, self.voxel_size, self.origin, self._get_mask_radius())
+        metrics = {'resolution': self.shell_resolution[1:].tolist(),
+                   'fsc': get_fsc(self.map_ft, model_ft, self.shells, num_shells)[1:].tolist(),
+                   'cc_mask': get_correlation(self.data[mask], model[mask]) if np.any(mask) else 0.0,
+                   'cc_box': get_correlation(self.data, model)}
+        if not self.test_ft is None:
+            metrics['fsc_test'] = get_fsc(self.test_ft, model_ft, self.shells, num_shells)[1:].tolist()
+        return metrics
+
+    def get_residue_cc(self, pdb_file):
+        '''
+        Correlation of map and model map in the voxels within the mask radius of the atoms of each residue.
+        Returns the residues as (chain, residue number, residue name) and an array with the
+        correlation of each residue (nan for residues outside of the map).
+        '''
+        shape = self.data.shape
+        atoms = Atoms(pdb_file, hydrogens=False)
+        model, _ = self._get_model_map(atoms.coords, get_weights(atoms.elements))
+        residues, coords, positions = atoms.residues, atoms.coords, atoms.positions
+        offsets = _get_sphere_offsets(self.voxel_size, self._get_mask_radius())
+        centers = np.rint((coords - self.origin) / self.voxel_size).astype(int)
+        index = (centers[:, None, :] + offsets[None, :, :]).reshape(-1, 3)
+        residue_index = np.repeat(positions, len(offsets))
+        inside = np.all((index >= 0) & (index < shape), axis=1)
+        #Count each voxel once per residue
+        keys = np.unique(residue_index[inside] * np.prod(shape) + np.ravel_multi_index(index[inside].T, shape))
+        residue_index, voxels = np.divmod(keys, np.prod(shape))
+        x, y = self.data.ravel()[voxels], model.ravel()[voxels]
+
+        def residue_sum(values):
+            return np.bincount(residue_index, weights=values, minlength=len(residues))
+        n = residue_sum(np.ones(len(voxels)))
+        sx, sy = residue_sum(x), residue_sum(y)
+        covariance = n * residue_sum(x * y) - sx * sy
+        variance = (n * residue_sum(x * x) - sx ** 2) * (n * residue_sum(y * y) - sy ** 2)
+        cc = np.full(len(residues), np.nan)
+        valid = variance > 0
+        cc[valid] = covariance[valid] / np.sqrt(variance[valid])
+        return residues, cc
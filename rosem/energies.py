@@ -0,0 +1,165 @@
+#Copyright 2021 Georg Kempf, Friedrich Miescher Institute for Biomedical Research
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+import logging
+import numpy as np
+
+logger = logging.getLogger("RosEM")
+
+#Density fit term of the rosetta score function
+DENSITY_TERM = 'elec_dens_fast'
+#Robust z-score (median absolute deviation) above which a residue is an outlier
+OUTLIER_Z = 3.5
+
+
+def read_energies(pdb_file):
+    '''
+    Read the pose energies table that rosetta appends to output models. Lines are read one at a time
+    and reading stops at the end of the table.
+    Returns the score terms, the residue labels (e.g. ALA:NtermProteinFull_1) and an array
+    (residue x term) of the weighted energies or None if the model has no table.
+    '''
+    terms, labels, rows = None, [], []
+    in_table = False
+    with open(pdb_file, 'r') as f:
+        for line in f:
+            if line.startswith('#BEGIN_POSE_ENERGIES_TABLE'):
+                in_table = True
+            elif line.startswith('#END_POSE_ENERGIES_TABLE'):
+                break
+            elif in_table:
+                fields = line.split()
+                if fields == [] or fields[0] in ('weights', 'pose'):
+                    continue
+                if fields[0] == 'label':
+                    terms = fields[1:]
+                    continue
+                labels.append(fields[0])
+                rows.append(fields[1:])
+    if terms is None:
+        return None
+    return terms, labels, np.array(rows, dtype=float).reshape(-1, len(terms))
+
+
+def get_residue_number(label):
+    '''
+    Pose number and residue name of a residue label, e.g. (1, 'ALA') for ALA:NtermProteinFull_1.
+    '''
+    name, _, number = label.rpartition('_')
+    return int(number), name.split(':')[0]
+
+
+class EnergyTables:
+    '''
+    Per-residue energies of replicates as array (replicate x residue x term). Terms and residues
+    are taken from the first model; missing values are nan.
+    '''
+    def __init__(self, models, groups=None):
+        '''
+        models: list of PDB files
+        groups: group of each model, e.g. the density weight
+        '''
+        self.terms, self.labels, self.models, self.groups = None, None, [], []
+        tables = []
+        for i, model in enumerate(models):
+            table = read_energies(model)
+            if table is None:
+                logger.debug(f"No energies table in {model}.")
+                continue
+            terms, labels, values = table
+            if self.terms is None:
+                self.terms, self.labels = terms, labels
+            aligned = np.full((len(self.labels), len(self.terms)), np.nan, dtype='f4')
+            term_index = [self.terms.index(x) if x in self.terms else -1 for x in terms]
+            if labels == self.labels:
+                residue_index = np.arange(len(labels))
+            else:
+                position = {x: j for j, x in enumerate(self.labels)}
+                residue_index = np.array([position.get(x, -1) for x in labels], dtype=int)
+            rows, cols = residue_index >= 0, np.array(term_index) >= 0
+            aligned[np.ix_(residue_index[rows], np.array(term_index)[cols])] = values[np.ix_(rows, cols)]
+            tables.append(aligned)
+            self.models.append(model)
+            self.groups.append(groups[i] if not groups is None else None)
+        if tables == []:
+            self.values = np.zeros((0, 0, 0), dtype='f4')
+        else:
+            self.values = np.stack(tables)
+
+    def __len__(self):
+        return len(self.models)
+
+    def get_term(self, term):
+        '''
+        Energies of a term (replicate x residue).
+        '''
+        return self.values[:, :, self.terms.index(term)]
+
+    def get_group_means(self, term):
+        '''
+        Mean energy of each residue over the replicates of each group (group x residue).
+        '''
+        values = self.get_term(term)
+        groups = list(dict.fromkeys(self.groups))
+        return groups, np.stack([np.nanmean(values[[x == group for x in self.groups]], axis=0) for group in groups])
+
+    def get_consensus(self, term):
+        '''
+        Consensus energy of each residue (median over the group means), the spread between
+        groups (standard deviation of the group means) and the robust z-score of the consensus
+        relative to all residues. Residues with a z-score above OUTLIER_Z are outliers.
+        '''
+        groups, means = self.get_group_means(term)
+        consensus = np.nanmedian(means, axis=0)
+        spread = np.nanstd(means, axis=0)
+        mad = np.nanmedian(np.abs(consensus - np.nanmedian(consensus))) * 1.4826
+        if mad > 0:
+            z = (consensus - np.nanmedian(consensus)) / mad
+        else:
+            z = np.zeros(len(consensus))
+        return groups, means, consensus, spread, z
+
+    def save(self, npz_file):
+        np.savez_compressed(npz_file,
+                            values=self.values,
+                            terms=np.array(self.terms if not self.terms is None else []),
+                            labels=np.array(self.labels if not self.labels is None else []),
+                            models=np.array(self.models),
+                            groups=np.array([str(x) for x in self.groups]))
+
+
+def get_residue_report(tables, terms, residues=None):
+    '''
+    One row per residue with the consensus, spread, z-score and group means of each term.
+    residues: (chain, residue number, residue name) in pose order to add the PDB numbering.
+    '''
+    rows = []
+    for i, label in enumerate(tables.labels):
+        number, name = get_residue_number(label)
+        row = {'pose_number': number, 'resname': name}
+        if not residues is None and len(residues) == len(tables.labels):
+            row['chain'], row['resseq'] = residues[i][0], residues[i][1]
+        rows.append(row)
+    outlier = np.zeros(len(rows), dtype=bool)
+    for term in [x for x in terms if x in tables.terms]:
+        groups, means, consensus, spread, z = tables.get_consensus(term)
+        outlier |= z > OUTLIER_Z
+        for i, row in enumerate(rows):
+            row[term] = float(consensus[i])
+            row[f"{term}_spread"] = float(spread[i])
+            row[f"{term}_z"] = float(z[i])
+            for group, values in zip(groups, means):
+                row[f"{term}_{group}"] = float(values[i])
+    for row, value in zip(rows, outlier):
+        row['outlier'] = bool(value)
+    return rows
@@ -0,0 +1,98 @@
+#Copyright 2021 Georg Kempf, Friedrich Miescher Institute for Biomedical Research
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+import logging
+import numpy as np
+from rosem.preprocess import Atoms
+
+logger = logging.getLogger("RosEM")
+
+
+class Ensemble:
+    '''
+    Coordinates of the atoms present in all models as array (model x atom x 3).
+    The models are refined in the same map and compared without superposition.
+    '''
+    def __init__(self, models):
+        self.models = list(models)
+        atoms = [Atoms(x, hydrogens=False) for x in self.models]
+        atoms = [(x.keys, x.coords) for x in atoms]
+        common = set(atoms[0][0])
+        for keys, _ in atoms[1:]:
+            common &= set(keys)
+        self.keys = [x for x in atoms[0][0] if x in common]
+        self.coords = np.zeros((len(self.models), len(self.keys), 3))
+        for i, (keys, coords) in enumerate(atoms):
+            index = {x: j for j, x in enumerate(keys)}
+            self.coords[i] = coords[[index[x] for x in self.keys]]
+        if len(self.keys) < max([len(x[0]) for x in atoms]):
+            logger.debug(f"{len(self.keys)} atoms in common between {len(self.models)} models.")
+
+    def get_rmsd_matrix(self):
+        '''
+        Pairwise RMSD (Angstrom) between all models. Models without common atoms are not
+        comparable and their RMSD is nan.
+        '''
+        if len(self.keys) == 0:
+            rmsd = np.full((len(self.models), len(self.models)), np.nan)
+            np.fill_diagonal(rmsd, 0.0)
+            return rmsd
+        flat = self.coords.reshape(len(self.models), -1)
+        squared = np.sum(flat ** 2, axis=1)
+        distances = squared[:, None] + squared[None, :] - 2 * flat @ flat.T
+        rmsd = np.sqrt(np.maximum(distances, 0.0) / len(self.keys))
+        np.fill_diagonal(rmsd, 0.0)
+        return rmsd
+
+    def get_rmsf(self):
+        '''
+        Root mean square fluctuation about the mean structure of each residue.
+        Returns the residues (chain, residue number, insertion code) and an array with the RMSF.
+        '''
+        deviation = np.sum((self.coords - self.coords.mean(axis=0)) ** 2, axis=2).mean(axis=0)
+        residues, index = [], []
+        for chain, resseq, icode, _ in self.keys:
+            if residues == [] or not residues[-1] == (chain, resseq, icode):
+                residues.append((chain, resseq, icode))
+            index.append(len(residues) - 1)
+        counts = np.bincount(index, minlength=len(residues))
+        return residues, np.sqrt(np.bincount(index, weights=deviation, minlength=len(residues)) / counts)
+
+
+def get_duplicates(rmsd, tolerance, order=None):
+    '''
+    Group models within tolerance (Angstrom RMSD). Models are visited in order (e.g. best first)
+    and each model that is not a duplicate of a previous representative becomes a representative.
+    Models with nan RMSD (not comparable) are never duplicates.
+    Returns a dict of representative -> list of its duplicates (indices into rmsd).
+    '''
+    if order is None:
+        order = range(len(rmsd))
+    groups = {}
+    for i in order:
+        for representative in groups:
+            if rmsd[i, representative] <= tolerance:
+                groups[representative].append(i)
+                break
+        else:
+            groups[i] = []
+    return groups
+
+
+def get_mean_rmsd(rmsd):
+    '''
+    Mean RMSD over all pairs of models.
+    '''
+    if len(rmsd) < 2:
+        return 0.0
+    return float(rmsd[np.triu_indices(len(rmsd), 1)].mean())
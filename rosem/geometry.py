@@ -0,0 +1,153 @@
+#Copyright 2021 Georg Kempf, Friedrich Miescher Institute for Biomedical Research
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+import logging
+import numpy as np
+from rosem.preprocess import Atoms
+
+logger = logging.getLogger("RosEM")
+
+#Backbone atoms per residue in the order of the coordinate array
+BACKBONE_ATOMS = ['N', 'CA', 'C', 'O', 'CB']
+N, CA, C, O, CB = range(len(BACKBONE_ATOMS))
+#Maximum C-N distance (Angstrom) of a peptide bond
+MAX_PEPTIDE_BOND = 2.0
+#Ideal bond lengths (Angstrom) and angles (degrees) of the protein backbone (Engh & Huber 2001).
+#Atom indices are (residue offset, atom).
+IDEAL_BONDS = [((0, N), (0, CA), 1.459),
+               ((0, CA), (0, C), 1.525),
+               ((0, C), (0, O), 1.229),
+               ((0, CA), (0, CB), 1.530),
+               ((0, C), (1, N), 1.336)]
+IDEAL_ANGLES = [((0, N), (0, CA), (0, C), 111.0),
+                ((0, CA), (0, C), (0, O), 120.1),
+                ((0, N), (0, CA), (0, CB), 110.6),
+                ((0, C), (0, CA), (0, CB), 110.4),
+                ((0, CA), (0, C), (1, N), 117.2),
+                ((0, O), (0, C), (1, N), 122.7),
+                ((0, C), (1, N), (1, CA), 121.7)]
+#Residue specific ideal N-CA-C angles
+IDEAL_N_CA_C = {'GLY': 113.1, 'PRO': 112.1}
+#Omega (degrees) of cis peptides is below CIS_OMEGA and of twisted peptides between CIS_OMEGA and TRANS_OMEGA (absolute value)
+CIS_OMEGA = 30.0
+TRANS_OMEGA = 150.0
+
+
+def read_backbone(pdb_file):
+    '''
+    Backbone atoms of the protein residues of the first model.
+    Returns the residue names, chains and an array (residue x BACKBONE_ATOMS x 3) with nan for missing atoms.
+    '''
+    atoms = Atoms(pdb_file, hydrogens=False)
+    coords = np.full((len(atoms.residues), len(BACKBONE_ATOMS), 3), np.nan)
+    backbone = np.isin(atoms.names, BACKBONE_ATOMS)
+    atom_index = np.array([BACKBONE_ATOMS.index(x) for x in atoms.names[backbone]], dtype=int)
+    coords[atoms.positions[backbone], atom_index] = atoms.coords[backbone]
+    resnames = np.array([x[2] for x in atoms.residues])
+    chains = np.array([x[0] for x in atoms.residues])
+    #Only amino acids (with N, CA and C)
+    protein = ~np.isnan(coords[:, [N, CA, C], 0]).any(axis=1)
+    return resnames[protein], chains[protein], coords[protein]
+
+
+def get_distances(a, b):
+    return np.linalg.norm(a - b, axis=-1)
+
+
+def get_angles(a, b, c):
+    '''
+    Angles a-b-c (degrees) of arrays of points.
+    '''
+    u, v = a - b, c - b
+    cos = np.sum(u * v, axis=-1) / (np.linalg.norm(u, axis=-1) * np.linalg.norm(v, axis=-1))
+    return np.degrees(np.arccos(np.clip(cos, -1.0, 1.0)))
+
+
+def get_dihedrals(a, b, c, d):
+    '''
+    Dihedral angles a-b-c-d (degrees, -180 to 180) of arrays of points.
+    '''
+    b0, b1, b2 = a - b, c - b, d - c
+    b1 = b1 / np.linalg.norm(b1, axis=-1, keepdims=True)
+    v = b0 - np.sum(b0 * b1, axis=-1, keepdims=True) * b1
+    w = b2 - np.sum(b2 * b1, axis=-1, keepdims=True) * b1
+    x = np.sum(v * w, axis=-1)
+    y = np.sum(np.cross(b1, v) * w, axis=-1)
+    return np.degrees(np.arctan2(y, x))
+
+
+class BackboneGeometry:
+    '''
+    Backbone geometry of a protein model computed over all residues at once.
+    '''
+    def __init__(self, pdb_file):
+        self.resnames, self.chains, self.coords = read_backbone(pdb_file)
+        #linked[i]: residue i is bonded to residue i + 1
+        self.linked = np.zeros(len(self.coords), dtype=bool)
+        if len(self.coords) > 1:
+            peptide = get_distances(self.coords[:-1, C], self.coords[1:, N])
+            self.linked[:-1] = (self.chains[:-1] == self.chains[1:]) & (peptide < MAX_PEPTIDE_BOND)
+
+    def _get_atoms(self, offset, atom):
+        '''
+        Coordinates of an atom of the residue at offset of each residue (nan if not linked).
+        '''
+        if offset == 0:
+            return self.coords[:, atom]
+        atoms = np.full((len(self.coords), 3), np.nan)
+        if len(self.coords) > 1:
+            atoms[:-1] = np.where(self.linked[:-1, None], self.coords[1:, atom], np.nan)
+        return atoms
+
+    def get_bond_deviations(self):
+        deviations = [get_distances(self._get_atoms(*a), self._get_atoms(*b)) - ideal for a, b, ideal in IDEAL_BONDS]
+        deviations = np.concatenate(deviations)
+        return deviations[~np.isnan(deviations)]
+
+    def get_angle_deviations(self):
+        deviations = []
+        for a, b, c, ideal in IDEAL_ANGLES:
+            if (a, b, c) == ((0, N), (0, CA), (0, C)):
+                ideal = np.array([IDEAL_N_CA_C.get(x, ideal) for x in self.resnames])
+            deviations.append(get_angles(self._get_atoms(*a), self._get_atoms(*b), self._get_atoms(*c)) - ideal)
+        deviations = np.concatenate(deviations)
+        return deviations[~np.isnan(deviations)]
+
+    def get_omega(self):
+        '''
+        Omega of the peptide bond between residue i and i + 1 (nan if not linked).
+        '''
+        return get_dihedrals(self.coords[:, CA], self.coords[:, C], self._get_atoms(1, N), self._get_atoms(1, CA))
+
+    def get_peptides(self):
+        '''
+        Percentage of cis and twisted peptides preceding proline and other residues.
+        '''
+        omega = np.abs(self.get_omega())
+        valid = ~np.isnan(omega)
+        proline = np.zeros(len(omega), dtype=bool)
+        proline[:-1] = self.resnames[1:] == 'PRO'
+        result = {}
+        for name, selected in [('proline', valid & proline), ('general', valid & ~proline)]:
+            total = int(np.sum(selected))
+            cis = int(np.sum(selected & (omega < CIS_OMEGA)))
+            twisted = int(np.sum(selected & (omega >= CIS_OMEGA) & (omega < TRANS_OMEGA)))
+            result[f"cis_{name}"] = 100.0 * cis / total if total > 0 else 0.0
+            result[f"twisted_{name}"] = 100.0 * twisted / total if total > 0 else 0.0
+        return result
+
+
+def get_rmsd(deviations):
+    if len(deviations) == 0:
+        return None
+    return float(np.sqrt(np.mean(deviations ** 2)))
@@ -682,6 +682,8 @@ class FastRelaxParams(GUIVariables):
         self.nproc = Variable('nproc', 'int', ctrl_type='sbo', cmd=True)
         self.selection = Variable('selection', 'str', ctrl_type='pte', cmd=True)
         self.validation = Variable('validation', 'bool', ctrl_type='chk', cmd=True)
+        self.cache = Variable('cache', 'bool', ctrl_type='chk', cmd=True)
+        self.resample_map = Variable('resample_map', 'bool', ctrl_type='chk', cmd=True)
         self.queue = Variable('queue', 'bool', ctrl_type='chk')
         self.bfactor = Variable('bfactor', 'bool', ctrl_type='chk', cmd=True)
         self.fastrelax = Variable('fastrelax', 'bool', ctrl_type='chk', cmd=True)
@@ -0,0 +1,89 @@
+#Copyright 2021 Georg Kempf, Friedrich Miescher Institute for Biomedical Research
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+import os
+import json
+import fcntl
+import datetime
+import logging
+
+logger = logging.getLogger("RosEM")
+
+
+class TaskManifest:
+    '''
+    Record of completed (weight, model) tasks in a job directory. A task counts as complete
+    when it was recorded with the same input hash and all its outputs still exist.
+    Changes are merged into the file on save, so that several processes (e.g. SLURM array tasks)
+    can record tasks in the same manifest.
+    '''
+    def __init__(self, manifest_file):
+        self.manifest_file = manifest_file
+        self.tasks = self._load()
+        self.changes = {}
+
+    def _load(self):
+        if os.path.exists(self.manifest_file):
+            try:
+                with open(self.manifest_file, 'r') as f:
+                    return json.load(f)
+            except ValueError:
+                logger.warning(f"Could not read task manifest {self.manifest_file}. All tasks will be run.")
+        return {}
+
+    def get_key(self, mdl, wt):
+        return f"w{wt}_m{mdl}"
+
+    def is_complete(self, mdl, wt, input_hash, validate=None):
+        '''
+        validate: optional function that is called with each output path and returns False for invalid outputs.
+        '''
+        entry = self.tasks.get(self.get_key(mdl, wt))
+        if entry is None or not entry['input_hash'] == input_hash:
+            return False
+        for output in entry['outputs']:
+            if not os.path.exists(output):
+                return False
+            if not validate is None and not validate(output):
+                return False
+        return True
+
+    def add(self, mdl, wt, input_hash, outputs):
+        key = self.get_key(mdl, wt)
+        self.tasks[key] = {'weight': str(wt),
+                           'model': mdl,
+                           'input_hash': input_hash,
+                           'outputs': outputs,
+                           'finished': str(datetime.datetime.now())}
+        self.changes[key] = self.tasks[key]
+
+    def remove(self, mdl, wt):
+        key = self.get_key(mdl, wt)
+        self.tasks.pop(key, None)
+        self.changes[key] = None
+
+    def save(self):
+        with open(f"{self.manifest_file}.lock", 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            tasks = self._load()
+            for key, entry in self.changes.items():
+                if entry is None:
+                    tasks.pop(key, None)
+                else:
+                    tasks[key] = entry
+            self.tasks = tasks
+            tmp_file = f"{self.manifest_file}.{os.getpid()}.tmp"
+            with open(tmp_file, 'w') as f:
+                json.dump(self.tasks, f, indent=2)
+            os.replace(tmp_file, self.manifest_file)
+            self.changes = {}
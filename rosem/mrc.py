@@ -0,0 +1,180 @@
+#Copyright 2021 Georg Kempf, Friedrich Miescher Institute for Biomedical Research
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+import os
+import logging
+import numpy as np
+
+logger = logging.getLogger("RosEM")
+
+#MRC2014 header (1024 bytes)
+HEADER_DTYPE = np.dtype([('n', 'i4', 3),
+                         ('mode', 'i4'),
+                         ('nstart', 'i4', 3),
+                         ('m', 'i4', 3),
+                         ('cella', 'f4', 3),
+                         ('cellb', 'f4', 3),
+                         ('mapcrs', 'i4', 3),
+                         ('dmin', 'f4'),
+                         ('dmax', 'f4'),
+                         ('dmean', 'f4'),
+                         ('ispg', 'i4'),
+                         ('nsymbt', 'i4'),
+                         ('extra', 'V100'),
+                         ('origin', 'f4', 3),
+                         ('map', 'S4'),
+                         ('machst', 'u1', 4),
+                         ('rms', 'f4'),
+                         ('nlabl', 'i4'),
+                         ('label', 'S80', 10)])
+MODES = {0: 'i1', 1: 'i2', 2: 'f4', 6: 'u2', 12: 'f2'}
+
+
+class MrcError(Exception):
+    pass
+
+
+def read_header(map_file):
+    '''
+    Read the header of an MRC file. Big-endian files are detected from the grid size.
+    '''
+    with open(map_file, 'rb') as f:
+        raw = f.read(HEADER_DTYPE.itemsize)
+    if len(raw) < HEADER_DTYPE.itemsize:
+        raise MrcError(f"{map_file} is too short for an MRC file.")
+    header = np.frombuffer(raw, dtype=HEADER_DTYPE)[0]
+    if not all(0 < x < 100000 for x in header['n']):
+        header = np.frombuffer(raw, dtype=HEADER_DTYPE.newbyteorder('>'))[0]
+        if not all(0 < x < 100000 for x in header['n']):
+            raise MrcError(f"Could not read the grid size of {map_file}.")
+    return header.copy()
+
+
+class MrcFile:
+    '''
+    MRC map with lazily read header. The data is memory-mapped with the shape
+    (sections, rows, columns), so that subregions can be read without loading the full map.
+    Sizes, start indices and slices are given in file order (columns, rows, sections),
+    voxel size, cell and origin in x, y, z.
+    '''
+    def __init__(self, map_file):
+        self.map_file = map_file
+        self._header = None
+        self._data = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._data = None
+
+    @property
+    def header(self):
+        if self._header is None:
+            self._header = read_header(self.map_file)
+        return self._header
+
+    @property
+    def dimensions(self):
+        return tuple(int(x) for x in self.header['n'])
+
+    @property
+    def shape(self):
+        return self.dimensions[::-1]
+
+    @property
+    def num_voxels(self):
+        nc, nr, ns = self.dimensions
+        return nc * nr * ns
+
+    @property
+    def nstart(self):
+        return self.header['nstart'].astype(int)
+
+    @property
+    def origin(self):
+        return self.header['origin'].astype(float)
+
+    @property
+    def axes(self):
+        '''
+        Spatial axis (0=x, 1=y, 2=z) of columns, rows and sections.
+        '''
+        return tuple(int(x) - 1 for x in self.header['mapcrs'])
+
+    @property
+    def voxel_size(self):
+        return self.header['cella'].astype(float) / self.header['m']
+
+    @property
+    def dtype(self):
+        mode = int(self.header['mode'])
+        if not mode in MODES:
+            raise MrcError(f"MRC mode {mode} of {self.map_file} not supported.")
+        return np.dtype(MODES[mode]).newbyteorder(self.header.dtype['mode'].byteorder)
+
+    @property
+    def data_offset(self):
+        return HEADER_DTYPE.itemsize + int(self.header['nsymbt'])
+
+    @property
+    def data(self):
+        if self._data is None:
+            expected = self.data_offset + self.num_voxels * self.dtype.itemsize
+            if os.path.getsize(self.map_file) < expected:
+                raise MrcError(f"{self.map_file} is truncated.")
+            self._data = np.memmap(self.map_file, dtype=self.dtype, mode='r',
+                                   offset=self.data_offset, shape=self.shape)
+        return self._data
+
+    def read(self):
+        '''
+        Read the full map into memory as 32-bit float array.
+        '''
+        return np.array(self.data, dtype='f4')
+
+    def read_region(self, start, stop):
+        '''
+        Read a subregion from start (inclusive) to stop (exclusive) in file order
+        as 32-bit float array. Only the sections of the region are read from disk.
+        '''
+        (c0, r0, s0), (c1, r1, s1) = start, stop
+        return np.array(self.data[s0:s1, r0:r1, c0:c1], dtype='f4')
+
+
+def write_map(map_file, data, header, label=None):
+    '''
+    Write data with the shape (sections, rows, columns) as 32-bit float MRC file.
+    Start indices, sampling, cell, axis order and origin are taken from header.
+    '''
+    data = np.asarray(data, dtype='<f4')
+    out = np.zeros(1, dtype=HEADER_DTYPE.newbyteorder('<'))[0]
+    for field in ['nstart', 'm', 'cella', 'cellb', 'mapcrs', 'ispg', 'origin', 'label', 'nlabl']:
+        out[field] = header[field]
+    out['n'] = data.shape[::-1]
+    out['mode'] = 2
+    out['dmin'], out['dmax'], out['dmean'], out['rms'] = data.min(), data.max(), data.mean(), data.std()
+    out['map'] = b'MAP '
+    out['machst'] = [0x44, 0x44, 0, 0]
+    if not label is None:
+        nlabl = min(int(out['nlabl']), 9)
+        out['label'][nlabl] = label.encode()[:80]
+        out['nlabl'] = nlabl + 1
+    tmp_file = f"{map_file}.{os.getpid()}.tmp"
+    with open(tmp_file, 'wb') as f:
+        out.tofile(f)
+        data.tofile(f)
+    os.replace(tmp_file, map_file)
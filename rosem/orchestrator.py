@@ -0,0 +1,218 @@
+#Copyright 2021 Georg Kempf, Friedrich Miescher Institute for Biomedical Research
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+import os
+import time
+import signal
+import shlex
+import asyncio
+import logging
+
+logger = logging.getLogger("RosEM")
+
+#Seconds to wait after SIGTERM before a process group is killed.
+KILL_TIMEOUT = 10
+#Seconds between checks for cancelled tasks.
+CANCEL_POLL_INTERVAL = 10
+
+
+class Task:
+    '''
+    External program run in its own working directory. stdout and stderr are written to log_file
+    (appended if append is set).
+    memory: estimated peak memory in bytes, used for admission control.
+    slots: number of slots (CPUs) occupied by the task.
+    '''
+    def __init__(self, name, cmd, cwd, log_file, key=None, memory=0, slots=1, append=False):
+        self.name = name
+        if isinstance(cmd, str):
+            cmd = shlex.split(cmd)
+        self.cmd = cmd
+        self.cwd = cwd
+        self.log_file = log_file
+        self.key = key
+        self.memory = memory
+        self.slots = slots
+        self.append = append
+        self.returncode = None
+        self.duration = None
+        self.cancelled = False
+
+    def __repr__(self):
+        return f"Task({self.name})"
+
+
+class TaskOrchestrator:
+    '''
+    Runs tasks as subprocesses with asyncio. Tasks occupy their number of slots while running and
+    at most max_concurrent slots are used at the same time. Tasks are started in the given order,
+    but a task that fits into the free slots can start before a larger task that is still waiting.
+    Each task runs in its own session so that the whole process group can be killed on
+    cancellation (KeyboardInterrupt, SIGTERM).
+    If a memory_budget (resources.MemoryBudget) is given, a task is only started when its
+    estimated memory fits into the budget, otherwise it waits for running tasks to finish.
+    on_start(task) and on_finish(task) are called in the main thread.
+    If is_cancelled(task) is given, it is checked before a task starts and every CANCEL_POLL_INTERVAL
+    seconds while it runs. A cancelled task is not started or its process group is terminated, and
+    task.cancelled is set. The other tasks continue.
+    '''
+    def __init__(self, max_concurrent=1, on_start=None, on_finish=None, memory_budget=None, is_cancelled=None):
+        self.max_concurrent = max(1, int(max_concurrent))
+        self.on_start = on_start
+        self.on_finish = on_finish
+        self.is_cancelled = is_cancelled
+        self.memory_budget = memory_budget
+        self.condition = None
+        self.used_slots = 0
+        self.processes = {}
+
+    def run(self, tasks):
+        '''
+        Run all tasks and return them with returncode and duration set.
+        '''
+        tasks = list(tasks)
+        if tasks == []:
+            return tasks
+        try:
+            asyncio.run(self._run_all(tasks))
+        except KeyboardInterrupt:
+            self.kill_all()
+            raise
+        return tasks
+
+    async def _run_all(self, tasks):
+        loop = asyncio.get_running_loop()
+        main_task = asyncio.current_task()
+        try:
+            loop.add_signal_handler(signal.SIGTERM, main_task.cancel)
+        except (NotImplementedError, RuntimeError):
+            pass
+        self.condition = asyncio.Condition()
+        try:
+            await asyncio.gather(*[self._run_task(task) for task in tasks])
+        except asyncio.CancelledError:
+            logger.error("Tasks cancelled.")
+            self.kill_all()
+            raise KeyboardInterrupt
+        finally:
+            try:
+                loop.remove_signal_handler(signal.SIGTERM)
+            except (NotImplementedError, RuntimeError):
+                pass
+
+    def _get_slots(self, task):
+        return min(max(1, int(task.slots)), self.max_concurrent)
+
+    def _try_admit(self, task):
+        if self.used_slots + self._get_slots(task) > self.max_concurrent:
+            return False
+        if not self.memory_budget is None and not self.memory_budget.try_reserve(task.memory):
+            return False
+        self.used_slots += self._get_slots(task)
+        return True
+
+    async def _admit(self, task):
+        async with self.condition:
+            if not self._try_admit(task):
+                logger.debug(f"Task \"{task.name}\" waits for free slots or memory.")
+                await self.condition.wait_for(lambda: self._try_admit(task))
+
+    async def _release(self, task):
+        async with self.condition:
+            self.used_slots -= self._get_slots(task)
+            if not self.memory_budget is None:
+                self.memory_budget.release(task.memory)
+            self.condition.notify_all()
+
+    async def _run_task(self, task):
+        await self._admit(task)
+        try:
+            return await self._run_admitted(task)
+        finally:
+            await self._release(task)
+
+    def _check_cancelled(self, task):
+        if not self.is_cancelled is None and self.is_cancelled(task):
+            logger.info(f"Task \"{task.name}\" cancelled.")
+            task.cancelled = True
+        return task.cancelled
+
+    async def _wait(self, task, proc):
+        if self.is_cancelled is None:
+            return await proc.wait()
+        while True:
+            try:
+                return await asyncio.wait_for(asyncio.shield(proc.wait()), CANCEL_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                if self._check_cancelled(task):
+                    await self._terminate(proc)
+                    return await proc.wait()
+
+    async def _run_admitted(self, task):
+        if self._check_cancelled(task):
+            task.duration = 0.0
+            if not self.on_finish is None:
+                self.on_finish(task)
+            return task
+        if not self.on_start is None:
+            self.on_start(task)
+        start = time.time()
+        try:
+            with open(task.log_file, 'a' if task.append else 'w') as log:
+                proc = await asyncio.create_subprocess_exec(*task.cmd,
+                                                            cwd=task.cwd,
+                                                            stdin=asyncio.subprocess.DEVNULL,
+                                                            stdout=log,
+                                                            stderr=log,
+                                                            start_new_session=True)
+                self.processes[task] = proc
+                try:
+                    task.returncode = await self._wait(task, proc)
+                except asyncio.CancelledError:
+                    await self._terminate(proc)
+                    raise
+                finally:
+                    self.processes.pop(task, None)
+        except OSError:
+            logger.error(f"Could not start task \"{task.name}\".", exc_info=True)
+            task.returncode = -1
+        task.duration = time.time() - start
+        if not self.on_finish is None:
+            self.on_finish(task)
+        return task
+
+    async def _terminate(self, proc):
+        self._killpg(proc.pid, signal.SIGTERM)
+        try:
+            await asyncio.wait_for(proc.wait(), KILL_TIMEOUT)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            self._killpg(proc.pid, signal.SIGKILL)
+
+    def _killpg(self, pid, sig):
+        try:
+            os.killpg(pid, sig)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    def kill_all(self):
+        for task, proc in list(self.processes.items()):
+            if proc.returncode is None:
+                logger.error(f"Killing task \"{task.name}\".")
+                self._killpg(proc.pid, signal.SIGKILL)
+
+
+def run_task(task):
+    '''
+    Run a single task in the foreground.
+    '''
+    return TaskOrchestrator(1).run([task])[0]
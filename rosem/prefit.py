@@ -0,0 +1,192 @@
+#Copyright 2021 Georg Kempf, Friedrich Miescher Institute for Biomedical Research
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+import math
+import logging
+import numpy as np
+from rosem import density
+from rosem.symmetry import rotation_matrix
+
+logger = logging.getLogger("RosEM")
+
+#The map is binned to a voxel size of about resolution / SAMPLES_PER_RESOLUTION for the search.
+SAMPLES_PER_RESOLUTION = 2.0
+#The coarse rotation search is done at this multiple of the resolution
+COARSE_RESOLUTION_FACTOR = 2.5
+#Number of best coarse rotations that are refined locally at the resolution of the map
+COARSE_PEAKS = 3
+#Local rotations around a coarse rotation have a spacing of angle_step / LOCAL_STEPS
+LOCAL_STEPS = 4
+#Minimum increase of the correlation to move the model
+MIN_IMPROVEMENT = 0.01
+
+
+class RigidBodyFit:
+    '''
+    Rotation about center followed by shift (Angstrom) with the correlation before and after the fit.
+    '''
+    def __init__(self, rotation, center, shift, initial_cc, cc):
+        self.rotation = rotation
+        self.center = center
+        self.shift = shift
+        self.initial_cc = initial_cc
+        self.cc = cc
+
+    @property
+    def moved(self):
+        return not (np.allclose(self.rotation, np.eye(3)) and np.allclose(self.shift, 0.0))
+
+    def apply(self, coords):
+        return (coords - self.center) @ self.rotation.T + self.center + self.shift
+
+
+def quaternion_to_matrix(q):
+    w, x, y, z = q / np.linalg.norm(q)
+    return np.array([[1 - 2 * (y * y + z * z), 2 * (x * y - w * z), 2 * (x * z + w * y)],
+                     [2 * (x * y + w * z), 1 - 2 * (x * x + z * z), 2 * (y * z - w * x)],
+                     [2 * (x * z - w * y), 2 * (y * z + w * x), 1 - 2 * (x * x + y * y)]])
+
+
+def get_rotation_grid(angle_step):
+    '''
+    Uniform sampling of rotations with a spacing of about angle_step (degrees) from the Hopf fibration
+    of SO(3) (Yershova et al. 2010): points on the sphere (fibonacci lattice) combined with rotations
+    about them on a circle. Each rotation occurs once. The first rotation is the identity.
+    '''
+    step = math.radians(angle_step)
+    num_sphere = max(1, int(round(4 * math.pi / step ** 2)))
+    num_circle = max(1, int(round(2 * math.pi / step)))
+    rotations = [np.eye(3)]
+    for i in range(num_sphere):
+        theta = math.acos(1 - 2 * (i + 0.5) / num_sphere)
+        phi = math.pi * (1 + math.sqrt(5)) * i
+        for j in range(num_circle):
+            psi = 2 * math.pi * j / num_circle
+            q = np.array([math.cos(theta / 2) * math.cos(psi / 2),
+                          math.cos(theta / 2) * math.sin(psi / 2),
+                          math.sin(theta / 2) * math.cos(phi + psi / 2),
+                          math.sin(theta / 2) * math.sin(phi + psi / 2)])
+            rotations.append(quaternion_to_matrix(q))
+    return rotations
+
+
+def get_local_rotations(angle_step):
+    '''
+    Small rotations within angle_step / 2 (degrees) of the identity with a spacing of angle_step / LOCAL_STEPS.
+    '''
+    step = math.radians(angle_step) / LOCAL_STEPS
+    n = LOCAL_STEPS // 2
+    rotations = []
+    for v in np.ndindex(2 * n + 1, 2 * n + 1, 2 * n + 1):
+        v = (np.array(v) - n) * step
+        angle = np.linalg.norm(v)
+        if angle > n * step + 1e-6:
+            continue
+        rotations.append(np.eye(3) if angle == 0 else rotation_matrix(v / angle, angle))
+    return rotations
+
+
+class TranslationSearch:
+    '''
+    Correlation of a model with the map over all translations by FFT cross-correlation of the simulated
+    model map with the map binned to a voxel size of about resolution / SAMPLES_PER_RESOLUTION.
+    '''
+    def __init__(self, data, voxel_size, origin, resolution):
+        data, self.voxel_size, self.origin = density.bin_map(data, voxel_size, origin, resolution / SAMPLES_PER_RESOLUTION)
+        self.shape = data.shape
+        data = data - data.mean()
+        self.map_norm = np.linalg.norm(data)
+        self.map_ft = np.fft.rfftn(data)
+        self.gaussian = density.get_gaussian_filter(self.shape, self.voxel_size, density.SIGMA_FACTOR * resolution)
+        #Weights of the rfftn coefficients for the norm (Parseval), zero at the origin to remove the mean
+        self.parseval = np.full(self.map_ft.shape, 2.0)
+        self.parseval[:, :, 0] = 1.0
+        if self.shape[2] % 2 == 0:
+            self.parseval[:, :, -1] = 1.0
+        self.parseval[0, 0, 0] = 0.0
+
+    def get_correlation(self, coords, weights):
+        '''
+        Correlation (array of the map shape) for each cyclic translation of the model by voxels.
+        '''
+        grid = density.splat_atoms(coords, weights, self.shape, self.voxel_size, self.origin)
+        model_ft = np.fft.rfftn(grid) * self.gaussian
+        model_norm = math.sqrt(np.sum(self.parseval * np.abs(model_ft) ** 2) / np.prod(self.shape))
+        return np.fft.irfftn(self.map_ft * np.conj(model_ft), s=self.shape) / (self.map_norm * model_norm)
+
+
+def _refine_peak(cc, peak):
+    '''
+    Sub-voxel position of a correlation peak from a parabola through the neighbors on each axis.
+    '''
+    offset = []
+    for dim, (i, n) in enumerate(zip(peak, cc.shape)):
+        lower, upper = list(peak), list(peak)
+        lower[dim], upper[dim] = (i - 1) % n, (i + 1) % n
+        a, b, c = cc[tuple(lower)], cc[peak], cc[tuple(upper)]
+        denom = a - 2 * b + c
+        offset.append(0.5 * (a - c) / denom if denom < 0 else 0.0)
+    return np.array(offset)
+
+
+def fit_model(pdb_file, map_file, resolution, angle_step):
+    '''
+    Rigid-body search of the model in the map. Rotations of the model about its center are sampled
+    uniformly with angle_step at COARSE_RESOLUTION_FACTOR times the resolution, and the COARSE_PEAKS best
+    rotations are refined locally at the resolution. For each rotation all translations are searched
+    by FFT (TranslationSearch). Returns a RigidBodyFit for the best rotation and translation
+    or the identity if the correlation improves by less than MIN_IMPROVEMENT.
+    '''
+    coords, weights = density.read_atoms(pdb_file)
+    data, voxel_size, origin = density.read_map(map_file)
+    center = coords.mean(axis=0)
+
+    def rotate(rotation):
+        return (coords - center) @ rotation.T + center
+
+    coarse = TranslationSearch(data, voxel_size, origin, COARSE_RESOLUTION_FACTOR * float(resolution))
+    fine = TranslationSearch(data, voxel_size, origin, float(resolution))
+    rotations = get_rotation_grid(angle_step)
+    local_rotations = get_local_rotations(angle_step)
+    logger.info(f"Rigid-body search with {len(rotations)} rotations on a {'x'.join(map(str, coarse.shape))} grid"
+                f" and {COARSE_PEAKS * len(local_rotations)} rotations on a {'x'.join(map(str, fine.shape))} grid.")
+    coarse_cc = [float(np.max(coarse.get_correlation(rotate(x), weights))) for x in rotations]
+    initial_cc = float(fine.get_correlation(coords, weights)[0, 0, 0])
+    best = None
+    for i in np.argsort(coarse_cc)[::-1][:COARSE_PEAKS]:
+        for local in local_rotations:
+            rotation = local @ rotations[i]
+            cc = fine.get_correlation(rotate(rotation), weights)
+            peak = np.unravel_index(int(np.argmax(cc)), fine.shape)
+            if best is None or cc[peak] > best[0]:
+                best = (float(cc[peak]), rotation, peak, _refine_peak(cc, peak))
+    cc, rotation, peak, offset = best
+    if cc < initial_cc + MIN_IMPROVEMENT:
+        return RigidBodyFit(np.eye(3), center, np.zeros(3), initial_cc, initial_cc)
+    #Cyclic translation to the shortest shift
+    shift = np.array([(i + 0.5 * n) % n - 0.5 * n for i, n in zip(peak, fine.shape)]) + offset
+    return RigidBodyFit(rotation, center, shift * fine.voxel_size, initial_cc, cc)
+
+
+def write_model(pdb_file, out_file, fit):
+    '''
+    Write the model with the rigid-body transformation applied to all atoms.
+    '''
+    with open(pdb_file, 'r') as f_in, open(out_file, 'w') as f_out:
+        for line in f_in:
+            if line.startswith(('ATOM', 'HETATM')):
+                xyz = fit.apply(np.array([[float(line[30:38]), float(line[38:46]), float(line[46:54])]]))[0]
+                line = f"{line[:30]}{xyz[0]:8.3f}{xyz[1]:8.3f}{xyz[2]:8.3f}{line[54:]}"
+            elif line.startswith('ANISOU'):
+                continue
+            f_out.write(line)
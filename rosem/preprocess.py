@@ -0,0 +1,217 @@
+#Copyright 2021 Georg Kempf, Friedrich Miescher Institute for Biomedical Research
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+import math
+import logging
+import numpy as np
+from rosem import mrc
+from rosem.selection_parser import ResidueSelection
+
+logger = logging.getLogger("RosEM")
+
+#Residues that are not part of the rosetta pose
+IGNORED_RESIDUES = ['HOH', 'WAT', 'DOD']
+
+
+#Elements of hydrogen atoms
+HYDROGENS = ['H', 'D']
+
+
+def get_element(line):
+    '''
+    Element of an ATOM/HETATM line from the element column or the atom name.
+    '''
+    element = line[76:78].strip().upper()
+    if element == '':
+        element = line[12:16].strip().lstrip('0123456789')[:1].upper()
+    return element
+
+
+class Atoms:
+    '''
+    Atoms of the first model in a PDB file. Waters are skipped and of alternative
+    locations only the first is read.
+    residues: (chain, residue number, residue name) in pose order
+    coords, names, elements, positions (residue position of each atom): arrays by atom
+    '''
+    def __init__(self, pdb_file, hydrogens=True):
+        self.residues, self.icodes = [], []
+        coords, names, elements, positions = [], [], [], []
+        prev = None
+        seen = set()
+        with open(pdb_file, 'r') as f:
+            for line in f:
+                if line.startswith('ENDMDL'):
+                    break
+                if not line.startswith(('ATOM', 'HETATM')):
+                    continue
+                resname = line[17:20].strip()
+                if resname in IGNORED_RESIDUES:
+                    continue
+                element = get_element(line)
+                if not hydrogens and element in HYDROGENS:
+                    continue
+                residue = (line[21], line[22:27])
+                name = line[12:16].strip()
+                if (residue, name) in seen:
+                    continue
+                seen.add((residue, name))
+                if not residue == prev:
+                    self.residues.append((line[21], int(line[22:26]), resname))
+                    self.icodes.append(line[26])
+                    prev = residue
+                coords.append([float(line[30:38]), float(line[38:46]), float(line[46:54])])
+                names.append(name)
+                elements.append(element)
+                positions.append(len(self.residues) - 1)
+        self.coords = np.array(coords).reshape(-1, 3)
+        self.names = np.array(names)
+        self.elements = np.array(elements)
+        self.positions = np.array(positions, dtype=int)
+
+    def __len__(self):
+        return len(self.coords)
+
+    @property
+    def chains(self):
+        return np.array([self.residues[x][0] for x in self.positions])
+
+    @property
+    def keys(self):
+        '''
+        (chain, residue number, insertion code, atom name) of each atom.
+        '''
+        return [self.residues[x][:2] + (self.icodes[x], str(name)) for x, name in zip(self.positions, self.names)]
+
+
+def read_model(pdb_file):
+    '''
+    Read residues and atom coordinates of the first model in a PDB file.
+    Returns a list of (chain, residue number, residue name) in pose order and
+    an array with the coordinates of all atoms and an array with their residue positions.
+    '''
+    atoms = Atoms(pdb_file)
+    return atoms.residues, atoms.coords, atoms.positions
+
+
+def get_model_box(pdb_file, selection=None):
+    '''
+    Bounding box (min xyz, max xyz) of all atoms or of the residues in the selection string.
+    '''
+    residues, coords, positions = read_model(pdb_file)
+    if not selection is None:
+        selected = ResidueSelection(selection).get_selected(residues)
+        coords = coords[np.isin(positions, list(selected))]
+    if len(coords) == 0:
+        return None
+    return coords.min(axis=0), coords.max(axis=0)
+
+
+def _get_fft_size(n, max_n):
+    '''
+    Smallest size >= n with only the prime factors 2, 3 and 5 that does not exceed max_n.
+    '''
+    for size in range(n, max_n + 1):
+        rest = size
+        for factor in (2, 3, 5):
+            while rest % factor == 0:
+                rest //= factor
+        if rest == 1:
+            return size
+    return n
+
+
+def crop_map(map_file, out_file, box_min, box_max, padding=10.0):
+    '''
+    Crop a map to the box (in Angstrom) plus padding and write it to out_file.
+    The position of the map is kept by shifting the start indices (or the origin if
+    the map uses the origin field). Returns the old and new grid size or None if the
+    box is outside of the map.
+    '''
+    with mrc.MrcFile(map_file) as map_in:
+        header = map_in.header
+        if not np.allclose(header['cellb'], 90.0):
+            logger.warning(f"Cropping of maps with non-orthogonal cells not supported. Using the full map {map_file}.")
+            return None
+        voxel_size, origin, nstart = map_in.voxel_size, map_in.origin, map_in.nstart
+        use_origin = all(nstart == 0) and any(origin != 0)
+        #Limits in file order (columns, rows, sections)
+        start, stop = [], []
+        for i, (axis, size) in enumerate(zip(map_in.axes, map_in.dimensions)):
+            low = math.floor((box_min[axis] - padding - origin[axis]) / voxel_size[axis]) - nstart[i]
+            high = math.ceil((box_max[axis] + padding - origin[axis]) / voxel_size[axis]) - nstart[i] + 1
+            low, high = max(low, 0), min(high, size)
+            if high <= low:
+                return None
+            start.append(low)
+            stop.append(low + _get_fft_size(high - low, size - low))
+        cropped = header.copy()
+        for i, axis in enumerate(map_in.axes):
+            if use_origin:
+                cropped['origin'][axis] = origin[axis] + start[i] * voxel_size[axis]
+            else:
+                cropped['nstart'][i] = nstart[i] + start[i]
+        mrc.write_map(out_file, map_in.read_region(start, stop), cropped, label="RosEM: cropped to model")
+        return map_in.dimensions, tuple(int(y - x) for x, y in zip(start, stop))
+
+
+def get_voxel_size(map_file):
+    return mrc.MrcFile(map_file).voxel_size
+
+
+def resample_map(map_file, out_file, voxel_size):
+    '''
+    Fourier-resample a map to a voxel size of at most voxel_size (in Angstrom) and write it to out_file.
+    Only axes with a smaller voxel size are resampled. The new grid starts at the nearest voxel
+    of the new sampling and the density is shifted by the sub-voxel offset in Fourier space,
+    so that the map stays in place. Returns the old and new voxel size or None if the map is
+    not oversampled.
+    '''
+    with mrc.MrcFile(map_file) as map_in:
+        header = map_in.header
+        old_voxel_size = map_in.voxel_size
+        resampled = header.copy()
+        #Sizes and shifts in file order (columns, rows, sections)
+        sizes, shifts = [], []
+        for i, (axis, size) in enumerate(zip(map_in.axes, map_in.dimensions)):
+            new_size = _get_fft_size(min(math.ceil(size * old_voxel_size[axis] / voxel_size), size), size)
+            new_voxel_size = size * old_voxel_size[axis] / new_size
+            nstart = int(round(header['nstart'][i] * old_voxel_size[axis] / new_voxel_size))
+            shifts.append(nstart * new_voxel_size - header['nstart'][i] * old_voxel_size[axis])
+            sizes.append(new_size)
+            resampled['nstart'][i] = nstart
+            resampled['m'][axis] = int(round(header['m'][axis] * new_size / size))
+            resampled['cella'][axis] = resampled['m'][axis] * new_voxel_size
+        if tuple(sizes) == map_in.dimensions:
+            return None
+        old_shape = map_in.shape
+        axes = map_in.axes
+        coeffs = np.fft.rfftn(map_in.data.astype('f4'))
+    #Truncate the Fourier coefficients (sections, rows, columns) to the new grid.
+    new_shape = tuple(sizes[::-1])
+    index = [np.fft.fftfreq(n, 1.0 / n).astype(int) % old for n, old in zip(new_shape[:2], old_shape[:2])]
+    index.append(np.arange(new_shape[2] // 2 + 1))
+    coeffs = coeffs[np.ix_(*index)]
+    #Phase shift by the offset of the new grid start (in Angstrom)
+    for dim in range(3):
+        i = 2 - dim
+        length = old_shape[dim] * old_voxel_size[axes[i]]
+        if dim < 2:
+            freqs = np.fft.fftfreq(new_shape[dim], 1.0 / new_shape[dim])
+        else:
+            freqs = np.arange(new_shape[2] // 2 + 1)
+        phase = np.exp(2j * np.pi * freqs * shifts[i] / length)
+        coeffs *= phase.reshape([-1 if x == dim else 1 for x in range(3)])
+    new_data = np.fft.irfftn(coeffs, s=new_shape) * (np.prod(new_shape) / np.prod(old_shape))
+    mrc.write_map(out_file, new_data, resampled, label="RosEM: resampled")
+    return tuple(float(x) for x in old_voxel_size), tuple(float(x) for x in resampled['cella'] / resampled['m'])
@@ -0,0 +1,131 @@
+#Copyright 2021 Georg Kempf, Friedrich Miescher Institute for Biomedical Research
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+import logging
+
+logger = logging.getLogger("RosEM")
+
+GB = 1024 ** 3
+#Rough memory model of a rosetta_scripts FastRelax process with density scoring.
+#Database, score function and executable.
+ROSETTA_BASE_MEMORY = 1.0 * GB
+#Bytes per voxel: density, FFT coefficients and gradient grids, 4 byte floats.
+MAP_BYTES_PER_VOXEL = 4 * 6
+#Pose, neighbor graphs, rotamer sets and packer energies per atom.
+ATOM_MEMORY = 20 * 1024
+#Fraction of the available memory that may be used by tasks.
+MEMORY_SAFETY_FACTOR = 0.9
+
+CGROUP_V2_FILES = ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current')
+CGROUP_V1_FILES = ('/sys/fs/cgroup/memory/memory.limit_in_bytes', '/sys/fs/cgroup/memory/memory.usage_in_bytes')
+
+
+def format_memory(size):
+    return f"{size / GB:.1f} GB"
+
+
+def estimate_rosetta_memory(num_voxels=0, num_atoms=0):
+    '''
+    Estimate the peak memory of a rosetta_scripts task in bytes from the number of map voxels
+    (nx * ny * nz of all loaded maps) and the number of atoms in the model.
+    '''
+    return int(ROSETTA_BASE_MEMORY + num_voxels * MAP_BYTES_PER_VOXEL + num_atoms * ATOM_MEMORY)
+
+
+def _read_int(file):
+    try:
+        with open(file, 'r') as f:
+            value = f.read().strip()
+    except OSError:
+        return None
+    if value == 'max' or not value.isdigit():
+        return None
+    return int(value)
+
+
+def get_meminfo_available(meminfo='/proc/meminfo'):
+    try:
+        with open(meminfo, 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def get_cgroup_available():
+    '''
+    Memory left in the cgroup of this process (e.g. a SLURM allocation) or None if there is no limit.
+    '''
+    for limit_file, usage_file in (CGROUP_V2_FILES, CGROUP_V1_FILES):
+        limit = _read_int(limit_file)
+        usage = _read_int(usage_file)
+        #cgroup v1 reports a huge number if no limit is set
+        if not limit is None and limit < 2 ** 60:
+            return max(limit - (usage or 0), 0)
+    return None
+
+
+def get_available_memory():
+    '''
+    Available memory in bytes: the smaller value of MemAvailable in /proc/meminfo and the cgroup limit.
+    '''
+    values = [x for x in (get_meminfo_available(), get_cgroup_available()) if not x is None]
+    if values == []:
+        return None
+    return min(values)
+
+
+class MemoryBudget:
+    '''
+    Book-keeping of memory reserved by running tasks. A task is admitted only if its
+    estimated memory fits into the remaining budget. A task is always admitted if
+    nothing else is running, otherwise it could never start.
+    '''
+    def __init__(self, total):
+        self.total = int(total)
+        self.reserved = 0
+        self.running = 0
+
+    @classmethod
+    def from_system(cls, max_memory=None):
+        '''
+        max_memory: memory limit in bytes. If not given, the available memory is detected.
+        '''
+        if max_memory is None:
+            available = get_available_memory()
+            if available is None:
+                logger.warning("Could not determine available memory. Memory-aware scheduling disabled.")
+                return None
+            max_memory = available * MEMORY_SAFETY_FACTOR
+        return cls(max_memory)
+
+    def try_reserve(self, memory):
+        if self.running == 0 or self.reserved + memory <= self.total:
+            if self.reserved + memory > self.total:
+                logger.warning(f"Estimated task memory ({format_memory(memory)}) exceeds the available memory"
+                               f" ({format_memory(self.total)}). Running the task anyway.")
+            self.reserved += memory
+            self.running += 1
+            return True
+        return False
+
+    def release(self, memory):
+        self.reserved = max(self.reserved - memory, 0)
+        self.running = max(self.running - 1, 0)
+
+    def max_concurrent(self, memory):
+        if memory <= 0:
+            return None
+        return max(1, int(self.total // memory))
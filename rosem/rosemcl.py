@@ -15,30 +15,93 @@ from __future__ import absolute_import
 import argparse
 import xml.etree.ElementTree as ET
 import os
-from subprocess import Popen, PIPE
 import pandas as pd
-from rosem import utils, validation, convert_restraints, selection_parser
+from rosem import utils, validation, convert_restraints, selection_parser, weight_search, scheduler, manifest, cache, orchestrator, resources, slurm, preprocess, mrc, segments, symmetry, prefit, density, energies, ensemble, clashes
 from rosem.selection_parser import ResidueSelection
 import rosem.validation as validation
 import logging
-from multiprocessing import Pool
 import shutil
 from shutil import copyfile
 import sys
 import re
 import traceback
-import signal
-from contextlib import closing
 from xml.dom import minidom
 import json
+import math
+import hashlib
+import shlex
 
 logger = logging.getLogger("RosEM")
 logger.setLevel(logging.INFO)
 
+#Seed used for cached tasks if no seed is given. Replicate n uses seed + n.
+DEFAULT_SEED = 1111
+#Weight of coordinate restraints on boundary residues in segmented refinement.
+SEGMENT_COORDINATE_CST_WEIGHT = 1.0
+#Map sampling for --resample_map: voxels per resolution (voxel size = resolution / 3).
+SAMPLES_PER_RESOLUTION = 3.0
+#Neighboring residues on each side of poorly fitting residues included in focused refinement.
+FOCUSED_FLANK_RESIDUES = 2
+#Models whose ranking value is within this fraction of the best value are ranked by clashscore (--max_clashscore).
+#Relative, as FSC, model-map FSC and correlations are on different scales.
+CLASH_TIE_TOLERANCE = 0.005
+#Options forwarded to the rosemcl jobs of segments and focused refinement as (option, attribute).
+#Flags are forwarded if set and other options if not None. The remaining options are handled by the
+#parent job: restraint generation, symmetry, pre-fit and map preprocessing (passed as files), segments,
+#SLURM and the analysis and validation of the merged or best models.
+REFINEMENT_OPTIONS = [('--resolution', 'resolution'),
+                      ('--weight', 'weights'),
+                      ('--weight_search', 'weight_search'),
+                      ('--weight_search_steps', 'weight_search_steps'),
+                      ('--successive_halving', 'successive_halving'),
+                      ('--halving_rate', 'halving_rate'),
+                      ('--first_wave', 'first_wave'),
+                      ('--num_models', 'num_models'),
+                      ('--num_cycles', 'num_cycles'),
+                      ('--space', 'space'),
+                      ('--nproc', 'nproc'),
+                      ('--nstruct_batch', 'nstruct_batch'),
+                      ('--threads_per_task', 'threads_per_task'),
+                      ('--mpi', 'mpi'),
+                      ('--mpirun', 'mpirun'),
+                      ('--max_memory', 'max_memory'),
+                      ('--dihedral_cst_weight', 'dihedral_cst_weight'),
+                      ('--distance_cst_weight', 'distance_cst_weight'),
+                      ('--bond_cst_weight', 'bond_cst_weight'),
+                      ('--angle_cst_weight', 'angle_cst_weight'),
+                      ('--ramachandran_cst_weight', 'ramachandran_cst_weight'),
+                      ('--coordinate_cst_weight', 'coordinate_cst_weight'),
+                      ('--sc_weights', 'sc_weights'),
+                      ('--bfactor', 'b_factor'),
+                      ('--fastrelax', 'fastrelax'),
+                      ('--norepack', 'norepack'),
+                      ('--exclude_dna', 'exclude_dna'),
+                      ('--selection', 'selection_str'),
+                      ('--crop_map', 'crop_map'),
+                      ('--crop_padding', 'crop_padding'),
+                      ('--test_map', 'test_map'),
+                      ('--params_files', 'params_files'),
+                      ('--ranking_method', 'ranking_method'),
+                      ('--ranking_resolution', 'ranking_resolution'),
+                      ('--max_clashscore', 'max_clashscore'),
+                      ('--fast_validation', 'fast_validation'),
+                      ('--overwrite', 'overwrite'),
+                      ('--cache', 'cache'),
+                      ('--cache_dir', 'cache_dir'),
+                      ('--seed', 'seed'),
+                      ('--runtime_history', 'runtime_history'),
+                      ('--rosetta_path', 'rosetta_path'),
+                      ('--phenix_path', 'phenix_path'),
+                      ('--log_file', 'log_file'),
+                      ('--debug', 'debug')]
+
 class InputError(Exception):
     pass
 
 class ExecPath:
+    #Preference of rosetta build variants, e.g. rosetta_scripts.cxx11threadstatic.linuxgccrelease
+    BUILD_RANKING = [('release', 4), ('debug', -4), ('cxx11thread', 2), ('static', 1)]
+
     def __init__(self):
         self.path_dict = {}
         self.exec_path_dict = {}
@@ -52,30 +115,41 @@ class ExecPath:
     def get_exec(self, exec_name):
         return self.exec_path_dict[exec_name]
 
-    def find(self, program, exec_name):
-        exec_path = shutil.which(exec_name)
-        if exec_path:
-            self.path_dict[program] = os.path.dirname(exec_path)
-            return True
-        
-        # Try common SBGrid variants
-        variants = [
-            f"{exec_name}.static.linuxgccrelease",
-            f"{exec_name}.static.macosclangrelease", 
-            f"{exec_name}.default.linuxgccrelease"
-        ]
-        
-        for variant in variants:
-            exec_path = shutil.which(variant)
+    def find(self, program, exec_name, exclude=None, require=None):
+        if require is None:
+            exec_path = shutil.which(exec_name)
             if exec_path:
                 self.path_dict[program] = os.path.dirname(exec_path)
                 return True
-        
+        #Search the path for build variants (e.g. rosetta_scripts.static.linuxgccrelease) and take the best ranked one
+        candidates = []
+        for path in os.environ.get('PATH', '').split(os.pathsep):
+            if not os.path.isdir(path):
+                continue
+            for f in os.listdir(path):
+                if not f.startswith(f"{exec_name}.") or not os.access(os.path.join(path, f), os.X_OK):
+                    continue
+                if (require is None or re.search(require, f)) and (exclude is None or not re.search(exclude, f)):
+                    candidates.append((self.rank_build(f), path))
+        if len(candidates) > 0:
+            self.path_dict[program] = max(candidates)[1]
+            return True
         return False
 
-    def set_exec(self, program, exec_name, exclude=None):
+    def rank_build(self, exec_file):
+        '''
+        Score of a build variant: release before debug builds, then threaded and static builds.
+        Ties are broken by the name so that the choice does not depend on the directory order.
+        '''
+        score = sum([value for variant, value in self.BUILD_RANKING if variant in exec_file])
+        return (score, exec_file)
+
+    def is_threaded(self, exec_name):
+        return 'cxx11thread' in os.path.basename(self.get_exec(exec_name))
+
+    def set_exec(self, program, exec_name, exclude=None, require=None):
         if self.get(program) is None:
-            if not self.find(program, exec_name):
+            if not self.find(program, exec_name, exclude, require):
                 logger.error(
                     "{a} not found in the path. Add {a} binary directory to system path or specify with --{b}_path.".format(a=exec_name, b=program))
                 raise SystemExit
@@ -83,7 +157,11 @@ class ExecPath:
             exec_ = [f for f in os.listdir(self.get(program)) if re.search(exec_name, f) and not re.search(exclude, f)]
         else:
             exec_ = [f for f in os.listdir(self.get(program)) if re.search(exec_name, f)]
+        if not require is None:
+            exec_ = [f for f in exec_ if re.search(require, f)]
+        exec_ = sorted(exec_, key=self.rank_build, reverse=True)
         if len(exec_) > 0:
+            logger.debug(f"Found {exec_name} variants: {', '.join(exec_)}")
             exec_ = os.path.join(self.get(program), exec_[0])
             self.exec_path_dict[exec_name] = exec_
             if not os.access(exec_, os.X_OK):
@@ -135,6 +213,44 @@ class FastRelaxDensity:
                  sc_weights=None,
                  phenix_path=None,
                  rosetta_path=None,
+                 weight_search='grid',
+                 weight_search_steps=6,
+                 successive_halving=False,
+                 halving_rate=2,
+                 first_wave=2,
+                 runtime_history=None,
+                 overwrite=False,
+                 cache=False,
+                 cache_dir=None,
+                 seed=None,
+                 max_memory=None,
+                 slurm_array=False,
+                 slurm_account=None,
+                 sbatch='sbatch',
+                 array_task=None,
+                 gather=False,
+                 nstruct_batch=1,
+                 mpi=False,
+                 mpirun='mpirun -np {np}',
+                 threads_per_task=1,
+                 crop_map=False,
+                 crop_padding=10.0,
+                 resample_map=False,
+                 segment=None,
+                 segment_selections=None,
+                 max_segment_residues=1500,
+                 segment_context=8.0,
+                 coordinate_cst_weight=None,
+                 detect_symmetry=False,
+                 prefit=False,
+                 prefit_angle_step=30.0,
+                 ranking_resolution=None,
+                 focused_refinement=False,
+                 residue_cc_threshold=0.5,
+                 residue_energies=False,
+                 duplicate_rmsd=None,
+                 max_clashscore=None,
+                 fast_validation=False,
                  **kwargs):
         """
 
@@ -224,6 +340,61 @@ class FastRelaxDensity:
         else:
             self.run_validation = False
         self.selection_str = selection
+        if not self.map_file is None:
+            self.weight_search = weight_search
+        else:
+            self.weight_search = 'grid'
+        self.weight_search_steps = weight_search_steps
+        self.successive_halving = successive_halving
+        self.halving_rate = max(2, int(halving_rate))
+        self.first_wave = max(1, int(first_wave))
+        self.runtime_history = runtime_history
+        self.task_features = None
+        self.overwrite = overwrite
+        self.file_hashes = {}
+        self.cache = cache
+        self.cache_dir = cache_dir
+        self.seed = seed
+        if self.cache and self.seed is None:
+            self.seed = DEFAULT_SEED
+        self.max_memory = max_memory
+        self.task_memory = None
+        self.slurm_array = slurm_array
+        self.slurm_account = slurm_account
+        self.sbatch = sbatch
+        self.array_task = array_task
+        self.gather = gather
+        self.nstruct_batch = nstruct_batch
+        self.mpi = mpi
+        self.mpirun = mpirun
+        self.threads_per_task = threads_per_task
+        self.crop_map = crop_map
+        self.crop_padding = crop_padding
+        self.resample_map = resample_map
+        self.segment = segment
+        self.segment_selections = segment_selections
+        self.max_segment_residues = max_segment_residues
+        self.segment_context = segment_context
+        self.coordinate_cst_weight = coordinate_cst_weight
+        self.detect_symmetry = detect_symmetry
+        self.prefit = prefit
+        self.prefit_angle_step = prefit_angle_step
+        self.ranking_resolution = ranking_resolution
+        self.focused_refinement = focused_refinement
+        self.residue_cc_threshold = residue_cc_threshold
+        self.residue_energies = residue_energies
+        self.duplicate_rmsd = duplicate_rmsd
+        self.max_clashscore = max_clashscore
+        self.fast_validation = fast_validation
+        self.fast_validation_results = {}
+        self.map_metrics = None
+        self.rosetta_path = rosetta_path
+        self.phenix_path = phenix_path
+        #Maps as given by the user. map_file and test_map point to the preprocessed maps.
+        self.input_map_file = self.map_file
+        self.input_test_map = self.test_map
+        self.batches = {}
+        self.log_file = log_file
         self._space_parser()
         #Static
         self.base_dir = os.getcwd()
@@ -232,7 +403,10 @@ class FastRelaxDensity:
         self.path.register('rosetta', rosetta_path)
         self.path.set_exec('phenix', 'phenix.molprobity')
         self.path.set_exec('phenix', 'phenix.real_space_refine')
-        self.path.set_exec('rosetta', 'rosetta_scripts', 'python|mpi|multistage')
+        if self.mpi:
+            self.path.set_exec('rosetta', 'rosetta_scripts', 'python|multistage', require='mpi')
+        else:
+            self.path.set_exec('rosetta', 'rosetta_scripts', 'python|mpi|multistage')
 
 
         if log_file:
@@ -288,6 +462,8 @@ class FastRelaxDensity:
         ET.SubElement(score_function, "Reweight", scoretype="atom_pair_constraint", weight=str(self.distance_cst_weight))
         ET.SubElement(score_function, "Reweight", scoretype="dihedral_constraint", weight=str(self.dihedral_cst_weight))
         ET.SubElement(score_function, "Reweight", scoretype="angle_constraint", weight=str(self.angle_cst_weight))
+        if not self.coordinate_cst_weight is None:
+            ET.SubElement(score_function, "Reweight", scoretype="coordinate_constraint", weight=str(self.coordinate_cst_weight))
 
         #Reweight cartesian bonds and angles to get lower rmsd.
         ET.SubElement(score_function, "Reweight", scoretype="cart_bonded_length", weight=str(self.bond_weight))
@@ -410,7 +586,7 @@ class FastRelaxDensity:
             ET.SubElement(protocols, "Add", mover="report_fsc")
         tree = ET.ElementTree(rosetta)
         xmlstr = minidom.parseString(ET.tostring(rosetta)).toprettyxml(indent="   ")
-        xml_file = self.get_xml_filename(wt)
+        xml_file = os.path.join(self.base_dir, self._get_job_dir(wt), self.get_xml_filename(wt))
         with open(xml_file, 'w') as xml:
             xml.write(xmlstr)
         logger.info(f"XML Input script for weight {wt} written to {xml_file}.")
@@ -444,46 +620,70 @@ class FastRelaxDensity:
             geo_file = None
         return geo_file
 
+    def _get_restraints_key(self, pdb_file, reference_model):
+        '''
+        Key of reference model restraints in the shared cache.
+        '''
+        sha = hashlib.sha256()
+        sha.update(f"MODEL:{utils.hash_file(pdb_file)}".encode())
+        sha.update(f"REFERENCE:{utils.hash_file(reference_model)}".encode())
+        if not self.map_file is None:
+            sha.update(f"MAP:{self._get_file_hash(self.map_file)}".encode())
+        sha.update(f"RESOLUTION:{float(self.resolution)}".encode())
+        return sha.hexdigest()
+
     def _generate_reference_model_restraints(self):
-        geo_file = self._get_geo_file()
-        if geo_file is None:
-            logger.info("Generating reference model restraints.")
-            pdb_file = self._remove_hetatms(self.pdb_file)
-            reference_model = self._remove_hetatms(self.reference_model)
-            if pdb_file is None or reference_model is None:
-                logger.error("Failed to remove HETATMS from models.")
-                raise SystemExit
-            cmd = [self.path.get_exec('phenix.real_space_refine'),
-                   pdb_file,
-                   self.map_file,
-                   "resolution={}".format(self.resolution),
-                   "cycles=0",
-                   "ignore_symmetry_conflicts=True",
-                   "reference_model.enabled=True",
-                   "reference_model.file={}".format(reference_model),
-                   "run_validation=False"]
-            cmd = ' '.join(cmd)
-            logger.info(f"Command: {cmd}")
-            try:
-                with open('reference_model.log', 'w') as f:
-                    p = Popen(cmd, shell=True, stdin=PIPE, stdout=f)
-                    p.communicate()
-            except (KeyboardInterrupt, Exception) as e:
-                logger.error("Could not generate reference model restraints. Check reference_model.log for errors.", exc_info=True)
-                raise Exception
-        
-        else:
-            logger.info("Reference restraints file already exists...skipping.")
-        geo_file = self._get_geo_file()
-        if not geo_file is None:
-            convert_restraints.PhenixToRosetta(geo_file)
-            reference_model_cst = "reference_model_restraints.cst"
-            if os.path.exists(reference_model_cst):
-                reference_model_cst = os.path.abspath(reference_model_cst)
-            else:
-                logger.error("Could not find restraints file.")
+        reference_model_cst = os.path.abspath("reference_model_restraints.cst")
+        pdb_file = self._remove_hetatms(self.pdb_file)
+        reference_model = self._remove_hetatms(self.reference_model)
+        if pdb_file is None or reference_model is None:
+            logger.error("Failed to remove HETATMS from models.")
+            raise SystemExit
+        restraints_cache = cache.ResultCache(self.cache_dir, namespace='restraints')
+        restraints_key = self._get_restraints_key(pdb_file, reference_model)
+        if restraints_cache.restore(restraints_key, {'reference_model_restraints.cst': reference_model_cst}):
+            logger.info("Reference model restraints restored from cache.")
         else:
-            logger.error("Could not find output from phenix. Check reference_model.log for errors.")
+            geo_file = self._get_geo_file()
+            #Only restraints generated in this run are cached. An existing .geo file may be from another reference model.
+            generated = geo_file is None
+            if generated:
+                logger.info("Generating reference model restraints.")
+                cmd = [self.path.get_exec('phenix.real_space_refine'),
+                       pdb_file,
+                       self.map_file,
+                       "resolution={}".format(self.resolution),
+                       "cycles=0",
+                       "ignore_symmetry_conflicts=True",
+                       "reference_model.enabled=True",
+                       "reference_model.file={}".format(reference_model),
+                       "run_validation=False"]
+                logger.info(f"Command: {' '.join(cmd)}")
+                task = orchestrator.run_task(orchestrator.Task("Reference model restraints",
+                                                               cmd,
+                                                               self.base_dir,
+                                                               os.path.join(self.base_dir, 'reference_model.log')))
+                if not task.returncode == 0:
+                    logger.error("Could not generate reference model restraints. Check reference_model.log for errors.")
+
+            else:
+                logger.info("Reference restraints file already exists...skipping.")
+            geo_file = self._get_geo_file()
+            if not geo_file is None:
+                convert_restraints.PhenixToRosetta(geo_file)
+                if os.path.exists(reference_model_cst):
+                    if generated:
+                        restraints_cache.store(restraints_key,
+                                               {'reference_model_restraints.cst': reference_model_cst},
+                                               metadata={'model': os.path.basename(self.pdb_file),
+                                                         'reference_model': os.path.basename(self.reference_model),
+                                                         'resolution': str(self.resolution)})
+                else:
+                    logger.error("Could not find restraints file.")
+                    raise SystemExit
+            else:
+                logger.error("Could not find output from phenix. Check reference_model.log for errors.")
+                raise SystemExit
         if self.cst_file is None:
             self.cst_file = reference_model_cst
         else:
@@ -497,23 +697,589 @@ class FastRelaxDensity:
             else:
                 logger.error("Could not find combined restraints file.")
 
+    def _get_preprocessing_key(self, step, **params):
+        '''
+        Key of preprocessed maps in the shared cache.
+        '''
+        sha = hashlib.sha256()
+        sha.update(f"STEP:{step}".encode())
+        sha.update(f"MAP:{self._get_file_hash(self.map_file)}".encode())
+        if not self.test_map is None:
+            sha.update(f"TEST_MAP:{self._get_file_hash(self.test_map)}".encode())
+        for name, value in sorted(params.items()):
+            sha.update(f"{name.upper()}:{value}".encode())
+        return sha.hexdigest()
+
+    def _get_preprocessed_maps(self, suffix):
+        '''
+        Input map and output file of a preprocessing step by name in cache.
+        '''
+        maps = {'map.mrc': (self.map_file,
+                            os.path.join(self.base_dir, f"{utils.get_filename(self.map_file)}_{suffix}.mrc"))}
+        if not self.test_map is None:
+            maps['test_map.mrc'] = (self.test_map,
+                                    os.path.join(self.base_dir, f"{utils.get_filename(self.test_map)}_{suffix}.mrc"))
+        return maps
+
+    def _set_preprocessed_maps(self, files):
+        self.map_file = files['map.mrc']
+        if 'test_map.mrc' in files:
+            self.test_map = files['test_map.mrc']
+
+    def _crop_maps(self):
+        '''
+        Crop the map and test map to the bounding box of the model (or selection) plus padding.
+        '''
+        if not self.symm_file is None:
+            logger.warning("Map cropping is not supported with symmetry. Using the full map.")
+            return
+        maps = self._get_preprocessed_maps('cropped')
+        files = {name: out_file for name, (_, out_file) in maps.items()}
+        maps_cache = cache.ResultCache(self.cache_dir, namespace='maps')
+        crop_key = self._get_preprocessing_key('crop',
+                                               model=self._get_file_hash(self.pdb_file),
+                                               selection=self.selection_str,
+                                               padding=float(self.crop_padding))
+        if maps_cache.restore(crop_key, files):
+            logger.info("Cropped maps restored from cache.")
+        else:
+            box = preprocess.get_model_box(self.pdb_file, self.selection_str)
+            if box is None:
+                logger.warning("No atoms found for cropping. Using the full map.")
+                return
+            for name, (map_file, out_file) in maps.items():
+                result = preprocess.crop_map(map_file, out_file, box[0], box[1], float(self.crop_padding))
+                if result is None:
+                    logger.warning(f"Model is outside of {map_file}. Using the full map.")
+                    return
+                logger.info(f"Cropped {os.path.basename(map_file)} from {'x'.join(map(str, result[0]))}"
+                            f" to {'x'.join(map(str, result[1]))} voxels.")
+            maps_cache.store(crop_key, files, metadata={'map': os.path.basename(self.map_file),
+                                                       'model': os.path.basename(self.pdb_file),
+                                                       'selection': self.selection_str,
+                                                       'padding': float(self.crop_padding)})
+        self._set_preprocessed_maps(files)
+
+    def _get_target_voxel_size(self):
+        return float(self.resolution) / SAMPLES_PER_RESOLUTION
+
+    def _resample_maps(self):
+        '''
+        Fourier-resample the map and test map to a voxel size of resolution / SAMPLES_PER_RESOLUTION.
+        '''
+        voxel_size = self._get_target_voxel_size()
+        maps = self._get_preprocessed_maps('resampled')
+        if all([min(preprocess.get_voxel_size(map_file)) >= voxel_size * 0.99 for map_file, _ in maps.values()]):
+            logger.info(f"Voxel size of the maps is not below {voxel_size:.2f} A. Resampling not needed.")
+            return
+        files = {name: out_file for name, (_, out_file) in maps.items()}
+        maps_cache = cache.ResultCache(self.cache_dir, namespace='maps')
+        resample_key = self._get_preprocessing_key('resample', voxel_size=round(voxel_size, 4))
+        if maps_cache.restore(resample_key, files):
+            logger.info("Resampled maps restored from cache.")
+        else:
+            for name, (map_file, out_file) in maps.items():
+                result = preprocess.resample_map(map_file, out_file, voxel_size)
+                if result is None:
+                    logger.warning(f"Could not resample {map_file}. Using the map without resampling.")
+                    return
+                logger.info(f"Resampled {os.path.basename(map_file)} from a voxel size of"
+                            f" {'x'.join([f'{x:.2f}' for x in result[0]])} A"
+                            f" to {'x'.join([f'{x:.2f}' for x in result[1]])} A.")
+            maps_cache.store(resample_key, files, metadata={'map': os.path.basename(self.map_file),
+                                                           'voxel_size': round(voxel_size, 4)})
+        self._set_preprocessed_maps(files)
+
+    def _preprocess_maps(self):
+        '''
+        Preprocessing steps that write new maps for the rosetta tasks. The maps are cropped before
+        resampling so that only the cropped box is transformed.
+        '''
+        if self.map_file is None:
+            return
+        for map_file in [self.map_file, self.test_map]:
+            if not map_file is None:
+                try:
+                    mrc.MrcFile(map_file).data
+                except mrc.MrcError as e:
+                    logger.error(f"Could not read map: {e}")
+                    raise SystemExit
+        if self.crop_map:
+            self._crop_maps()
+        if self.resample_map:
+            self._resample_maps()
+
+    def _prefit_model(self):
+        '''
+        Rigid-body pre-fit of the model into the map by FFT cross-correlation over translations
+        and a grid of rotations. The model is replaced by the pre-positioned model.
+        '''
+        if self.map_file is None:
+            logger.warning("Rigid-body pre-fit requires a map. Skipped.")
+            return
+        if not self.symm_file is None:
+            logger.warning("Rigid-body pre-fit is not supported with a symmetry definition. Skipped.")
+            return
+        prefit_file = os.path.join(self.base_dir, f"{utils.get_filename(self.pdb_file)}_prefit.pdb")
+        models_cache = cache.ResultCache(self.cache_dir, namespace='prefit')
+        prefit_key = self._get_preprocessing_key('prefit',
+                                                 model=self._get_file_hash(self.pdb_file),
+                                                 resolution=float(self.resolution),
+                                                 angle_step=float(self.prefit_angle_step))
+        if models_cache.restore(prefit_key, {'model.pdb': prefit_file}):
+            logger.info("Pre-fitted model restored from cache.")
+        else:
+            try:
+                fit = prefit.fit_model(self.pdb_file, self.map_file, self.resolution, float(self.prefit_angle_step))
+            except mrc.MrcError as e:
+                logger.warning(f"Rigid-body pre-fit failed: {e}")
+                return
+            if fit.moved:
+                logger.info(f"Rigid-body pre-fit improved the correlation from {fit.initial_cc:.3f} to {fit.cc:.3f}"
+                            f" (shift {' '.join([f'{x:.1f}' for x in fit.shift])} A).")
+            else:
+                logger.info(f"Rigid-body pre-fit did not improve the correlation ({fit.initial_cc:.3f}). Model not moved.")
+            prefit.write_model(self.pdb_file, prefit_file, fit)
+            models_cache.store(prefit_key, {'model.pdb': prefit_file},
+                               metadata={'map': os.path.basename(self.map_file),
+                                         'model': os.path.basename(self.pdb_file),
+                                         'initial_cc': fit.initial_cc,
+                                         'cc': fit.cc})
+        self.pdb_file = prefit_file
+
+    def _detect_symmetry(self):
+        '''
+        Detect cyclic symmetry of the model. If found, the model is reduced to the asymmetric unit
+        and a symmetry definition is written and used as symm_file.
+        '''
+        if not self.symm_file is None:
+            logger.info("Symmetry definition given. Symmetry detection skipped.")
+            return
+        residues = segments.read_residues(self.pdb_file)
+        symm = symmetry.detect_cyclic_symmetry(residues)
+        if symm is None:
+            logger.info("No symmetry detected.")
+            return
+        asu = [i for i, x in enumerate(residues) if x.chain in symm.asu_chains]
+        name = utils.get_filename(self.pdb_file)
+        symm_file = os.path.join(self.base_dir, f"{name}_{symm.name}.symm")
+        asu_file = os.path.join(self.base_dir, f"{name}_asu.pdb")
+        try:
+            symmetry.write_symmdef(symm, residues, symm_file)
+        except ValueError as e:
+            logger.warning(f"Could not write symmetry definition: {e}")
+            return
+        segments.write_segment_model(residues, asu, asu_file)
+        logger.info(f"Detected {symm.name} symmetry (CA RMSD {symm.rmsd:.2f} A). Refining asymmetric unit"
+                    f" (chains {','.join(symm.asu_chains)}) with symmetry definition {os.path.basename(symm_file)}.")
+        self.pdb_file = asu_file
+        self.symm_file = symm_file
+
     def _get_job_dir(self, wt):
         return 'job_w{}'.format(wt)
 
-    def _run_relax(self, mdl, wt):
+    def _prepare_weight(self, wt):
         '''
-        Build the rosetta_scripts command based on variables and start a subprocess in a dedicated directory.
+        Create the job directory and input xml for a density weight and return the relax tasks.
         '''
-
         job_dir = self._get_job_dir(wt)
-        os.chdir(job_dir)
+        if not os.path.exists(job_dir):
+            os.mkdir(job_dir)
+        elif self.overwrite:
+            logger.info(f"Job directory for weight {wt} already exists. Overwriting content.")
+        else:
+            logger.info(f"Job directory for weight {wt} already exists. Completed tasks will be reused.")
+        #Generate input xml
+        self._generate_xml(wt)
+        return [(i, wt) for i in range(int(self.num_models))]
+
+    def _get_model_output(self, mdl, wt):
+        return os.path.join(self.base_dir,
+                            self._get_job_dir(wt),
+                            "{}_refined_{}_0001.pdb".format(utils.get_filename(self.pdb_file), mdl))
+
+    def _get_task_features(self, wt):
+        '''
+        Features of a relax task used to predict its runtime.
+        '''
+        if self.task_features is None:
+            box = 0
+            if not self.map_file is None:
+                nx, ny, nz = utils.get_map_dimensions(self.map_file)
+                box = nx * ny * nz
+            self.task_features = {'residues': utils.get_residue_count(self.pdb_file),
+                                  'box': box,
+                                  'num_cycles': int(self.num_cycles),
+                                  'space': self.space}
+        features = dict(self.task_features)
+        try:
+            features['weight'] = float(wt)
+        except ValueError:
+            features['weight'] = 0.0
+        return features
+
+    def _get_task_memory(self):
+        '''
+        Estimated peak memory of a relax task in bytes. Each rosetta_scripts process holds its own copy of the maps.
+        '''
+        if self.task_memory is None:
+            num_voxels = 0
+            for map_file in [self.map_file, self.test_map]:
+                if not map_file is None:
+                    nx, ny, nz = utils.get_map_dimensions(map_file)
+                    num_voxels += nx * ny * nz
+            self.task_memory = resources.estimate_rosetta_memory(num_voxels, utils.get_atom_count(self.pdb_file))
+        return self.task_memory
+
+    def _get_memory_budget(self):
+        if self.mpi:
+            #MPI ranks can run on other nodes
+            return None
+        if not self.max_memory is None:
+            memory_budget = resources.MemoryBudget.from_system(self.max_memory * resources.GB)
+        else:
+            memory_budget = resources.MemoryBudget.from_system()
+        if not memory_budget is None:
+            max_concurrent = memory_budget.max_concurrent(self._get_task_memory())
+            logger.info(f"Estimated memory per task: {resources.format_memory(self._get_task_memory())}."
+                        f" Memory available for tasks: {resources.format_memory(memory_budget.total)}.")
+            if max_concurrent < self.nproc:
+                logger.info(f"At most {max_concurrent} tasks will run at the same time to stay within the available memory.")
+        return memory_budget
+
+    def _get_batch_size(self, relax_list):
+        '''
+        Number of replicates run in one rosetta_scripts process. With nstruct_batch 0 the replicates of
+        each weight are split into as few processes as possible while still using all nproc slots.
+        '''
+        if self.mpi:
+            #One MPI job per weight distributes all replicates to its ranks
+            return max([len([x for x in relax_list if x[1] == wt]) for _, wt in relax_list])
+        if int(self.nstruct_batch) > 0:
+            return int(self.nstruct_batch)
+        weights = {wt for _, wt in relax_list}
+        max_replicates = max([len([x for x in relax_list if x[1] == wt]) for wt in weights])
+        processes_per_weight = max(1, math.ceil(int(self.nproc) / len(weights)))
+        return max(1, math.ceil(max_replicates / processes_per_weight))
+
+    def _get_batches(self, relax_list):
+        '''
+        Split the replicates of each weight into batches of consecutive models. Each batch runs in one process.
+        '''
+        batch_size = self._get_batch_size(relax_list) if not relax_list == [] else 1
+        batches = []
+        for wt in list(dict.fromkeys([wt for _, wt in relax_list])):
+            models = sorted([mdl for mdl, x in relax_list if x == wt])
+            for i in range(0, len(models), batch_size):
+                batch = tuple([(mdl, wt) for mdl in models[i:i + batch_size]])
+                for task in batch:
+                    self.batches[task] = batch
+                batches.append(batch)
+        return batches
+
+    def _get_batch(self, mdl, wt):
+        return self.batches.get((mdl, wt), ((mdl, wt),))
+
+    def _get_threads_per_task(self, num_tasks):
+        '''
+        Threads per rosetta_scripts process. With threads_per_task 0 the nproc cores are split
+        between the tasks, so that a small number of tasks still uses all cores.
+        '''
+        threads = int(self.threads_per_task)
+        if self.mpi:
+            return 1
+        if threads == 0:
+            threads = max(1, int(self.nproc) // max(1, num_tasks))
+        elif threads > 1 and not self.path.is_threaded('rosetta_scripts'):
+            logger.warning(f"{self.path.get_exec('rosetta_scripts')} is not a multithreaded (cxx11thread) build."
+                           f" Running tasks with one thread.")
+        if not self.path.is_threaded('rosetta_scripts'):
+            return 1
+        threads = min(threads, int(self.nproc))
+        if threads > 1:
+            logger.info(f"Running {num_tasks} tasks with {threads} threads each.")
+        return threads
+
+    def _run_tasks(self, relax_list):
+        '''
+        Run relax tasks longest first, based on runtimes predicted from previous tasks.
+        Replicates of a weight are run in batches with -nstruct if nstruct_batch is not 1.
+        '''
+        logger.debug("Input List")
+        logger.debug(relax_list)
+        batches = self._get_batches(relax_list)
+        task_manifest = manifest.TaskManifest(os.path.join(self.base_dir, 'task_manifest.json'))
+        task_hashes = {task: self._get_task_hash(*task) for task in relax_list}
+        if not self.overwrite:
+            completed = [task for task in relax_list if task_manifest.is_complete(*task, task_hashes[task],
+                                                                                  validate=self._is_valid_output)]
+            for mdl, wt in completed:
+                logger.info(f"Task \"Density weight {wt}, Model {mdl}\" already completed. Skipping.")
+            #A batch is run again if one of its replicates is missing
+            batches = [batch for batch in batches if not all([task in completed for task in batch])]
+        if self.cache:
+            result_cache = cache.ResultCache(self.cache_dir)
+            cache_keys = {task: self._get_cache_key(*task) for task in relax_list}
+            cached = []
+            for batch in batches:
+                if not all([result_cache.contains(cache_keys[task]) for task in batch]):
+                    continue
+                for mdl, wt in batch:
+                    outputs = {'model.pdb': self._get_model_output(mdl, wt),
+                               'task.log': self._get_task_log(mdl, wt)}
+                    if result_cache.restore(cache_keys[(mdl, wt)], outputs):
+                        logger.info(f"Task \"Density weight {wt}, Model {mdl}\" restored from cache.")
+                        task_manifest.add(mdl, wt, task_hashes[(mdl, wt)], [self._get_model_output(mdl, wt)])
+                        cached.append((mdl, wt))
+            task_manifest.save()
+            batches = [batch for batch in batches if not all([task in cached for task in batch])]
+        if batches == []:
+            return
+        threads = self._get_threads_per_task(len(batches))
+        task_scheduler = scheduler.TaskScheduler(max(1, int(self.nproc) // threads), scheduler.RuntimeHistory(self.runtime_history))
+        batch_features = []
+        for batch in batches:
+            features = self._get_task_features(batch[0][1])
+            features['threads'] = threads
+            features['replicates'] = len(batch)
+            batch_features.append(features)
+        batches = task_scheduler.order(batches, batch_features)
+        task_scheduler.start()
+
+        def on_start(task):
+            task_scheduler.task_started(task.key)
+            logger.info(f"Starting task \"{task.name}\".")
+            logger.info("Command line:\n{}".format('\n'.join(task.cmd)))
+
+        def on_finish(task):
+            if not task.returncode == 0:
+                logger.error(f"Task \"{task.name}\" finished with exit code {task.returncode}. Check {task.log_file} for errors.")
+            if len(task.key) > 1:
+                self._rename_batch_outputs(task.key)
+            batch_success = True
+            for mdl, wt in task.key:
+                success = os.path.exists(self._get_model_output(mdl, wt)) and self._is_valid_output(self._get_model_output(mdl, wt))
+                if success:
+                    task_manifest.add(mdl, wt, task_hashes[(mdl, wt)], [self._get_model_output(mdl, wt)])
+                    if self.cache:
+                        result_cache.store(cache_keys[(mdl, wt)],
+                                           {'model.pdb': self._get_model_output(mdl, wt),
+                                            'task.log': task.log_file},
+                                           metadata={'weight': str(wt),
+                                                     'model': mdl,
+                                                     'input': os.path.basename(self.pdb_file),
+                                                     'job_dir': self.base_dir})
+                else:
+                    task_manifest.remove(mdl, wt)
+                    batch_success = False
+            task_manifest.save()
+            eta = task_scheduler.task_finished(task.key, task.duration, batch_success)
+            logger.info(f"Task finished: \"{task.name}\" took {scheduler.format_duration(task.duration)}."
+                        f" Estimated time to completion: {scheduler.format_duration(eta)}")
+
+        try:
+            task_orchestrator = orchestrator.TaskOrchestrator(self.nproc,
+                                                              on_start=on_start,
+                                                              on_finish=on_finish,
+                                                              memory_budget=self._get_memory_budget())
+            task_orchestrator.run([self._get_relax_task(batch, threads) for batch in batches])
+        finally:
+            task_scheduler.finish()
+
+    def _get_fsc_vals(self, wt):
+        '''
+        Collect the FSC of all models in the job directory of a density weight.
+        Models without FSC (e.g. from failed tasks) are skipped.
+        '''
+        job_dir = os.path.join(self.base_dir, self._get_job_dir(wt))
+        fsc_vals = {}
+        for model in [x for x in os.listdir(job_dir) if x.endswith('.pdb')]:
+            if not validation.has_fsc(os.path.join(job_dir, model)):
+                logger.warning(f"No FSC found in {os.path.join(job_dir, model)}. Model skipped.")
+                continue
+            fsc, _, _, _ = validation.get_fsc(os.path.join(job_dir, model))
+            fsc_vals[model] = float(fsc)
+        return fsc_vals
+
+    def _get_model_metrics(self, model):
+        '''
+        FSC curves, CC_mask and CC_box of a model computed from a simulated model map.
+        The metrics are cached per model, map and resolution.
+        '''
+        metrics_file = f"{os.path.splitext(model)[0]}_metrics.json"
+        metrics_cache = cache.ResultCache(self.cache_dir, namespace='metrics')
+        metrics_key = self._get_preprocessing_key('metrics',
+                                                  model=self._get_file_hash(model),
+                                                  resolution=float(self.resolution))
+        if not metrics_cache.restore(metrics_key, {'metrics.json': metrics_file}):
+            if self.map_metrics is None:
+                self.map_metrics = density.MapMetrics(self.map_file, self.resolution, self.test_map)
+            with open(metrics_file, 'w') as f:
+                json.dump(self.map_metrics.get_metrics(model), f)
+            metrics_cache.store(metrics_key, {'metrics.json': metrics_file},
+                                metadata={'model': os.path.basename(model),
+                                          'map': os.path.basename(self.map_file)})
+        with open(metrics_file, 'r') as f:
+            return json.load(f)
+
+    def _get_ranking_resolution(self):
+        '''
+        Resolution band (low, high) of the model-map FSC for ranking. Default is the band of ReportFSC.
+        '''
+        if not self.ranking_resolution is None:
+            res_low, res_high = [float(x) for x in str(self.ranking_resolution).split(':')]
+            return res_low, res_high
+        return float(self._get_res_low(self.resolution)), float(self.resolution)
+
+    def _get_metric_vals(self, wt):
+        '''
+        Collect a model-map metric (model_fsc, cc_mask or cc_box) of all models in the job directory of a density weight.
+        '''
+        job_dir = os.path.join(self.base_dir, self._get_job_dir(wt))
+        metric_vals = {}
+        for model in [x for x in os.listdir(job_dir) if x.endswith('.pdb')]:
+            metric_vals[model] = self._get_ranking_value(os.path.join(job_dir, model))
+        return metric_vals
+
+    def _get_ranking_value(self, model):
+        '''
+        Value of a model for ranking_method: FSC reported by rosetta (None if the model has no FSC)
+        or a model-map metric.
+        '''
+        if self.ranking_method == 'fsc':
+            return float(validation.get_fsc(model)[0]) if validation.has_fsc(model) else None
+        metrics = self._get_model_metrics(model)
+        if self.ranking_method == 'model_fsc':
+            value = density.get_band_fsc(metrics['resolution'], metrics['fsc'], *self._get_ranking_resolution())
+            if value is None:
+                logger.error(f"No FSC shells in the resolution band {self.ranking_resolution}.")
+                raise SystemExit
+            return value
+        return metrics[self.ranking_method]
 
-        #Generate command script
+    def _exclude_models(self, wt, vals, excluded, reason):
+        '''
+        Remove excluded models from vals. If all models are excluded, all are kept.
+        '''
+        passed = {k: v for k, v in vals.items() if not k in excluded}
+        if passed == {}:
+            logger.warning(f"Density weight {wt}: all models {reason}. Ranking all models.")
+            return vals
+        if len(passed) < len(vals):
+            logger.info(f"Density weight {wt}: {len(vals) - len(passed)} of {len(vals)} models excluded {reason}.")
+        return passed
+
+    def _get_best_model(self, wt, vals):
+        '''
+        Model with the highest ranking value. With fast_validation, models with twisted peptides are excluded.
+        With max_clashscore, models above the approximate clashscore are excluded and models within
+        CLASH_TIE_TOLERANCE (relative) of the best value are ranked by clashscore.
+        '''
+        if self.fast_validation:
+            stats = self._get_fast_validation(wt)
+            twisted = [k for k in vals if stats[k]['twisted_general'] > 0 or stats[k]['twisted_proline'] > 0]
+            vals = self._exclude_models(wt, vals, twisted, "with twisted peptides")
+        if self.max_clashscore is None:
+            return max(vals, key=vals.get)
+        job_dir = os.path.join(self.base_dir, self._get_job_dir(wt))
+        clashscores = {model: clashes.get_clashscore(os.path.join(job_dir, model)) for model in vals}
+        passed = self._exclude_models(wt, vals, [k for k in vals if clashscores[k] > float(self.max_clashscore)],
+                                      f"with approximate clashscore above {self.max_clashscore}")
+        best_val = max(passed.values())
+        tied = [k for k, v in passed.items() if v >= best_val - CLASH_TIE_TOLERANCE * abs(best_val)]
+        best_model = min(tied, key=lambda x: (clashscores[x], -passed[x]))
+        logger.debug(f"Approximate clashscores: {clashscores}")
+        logger.info(f"Density weight {wt}: approximate clashscore of best model {clashscores[best_model]:.1f}")
+        return best_model
+
+    def _run_weights(self, weights):
+        '''
+        Run the relax tasks for a list of density weights.
+        '''
+        if self.successive_halving and len(weights) > 1:
+            self._run_successive_halving(weights)
+        else:
+            relax_list = []
+            for wt in weights:
+                relax_list.extend(self._prepare_weight(wt))
+            self._run_tasks(relax_list)
+
+    def _run_successive_halving(self, weights):
+        '''
+        Run replicates in waves. After each wave the weights are ranked by the best FSC
+        of their models and only the top 1/halving_rate weights receive further replicates.
+        '''
+        num_models = int(self.num_models)
+        relax_dict = {wt: self._prepare_weight(wt) for wt in weights}
+        done = {wt: 0 for wt in weights}
+        survivors = list(weights)
+        wave = min(self.first_wave, num_models)
+        while True:
+            relax_list = []
+            for wt in survivors:
+                relax_list.extend(relax_dict[wt][done[wt]:wave])
+                done[wt] = wave
+            logger.info(f"Successive halving: running {wave} replicate(s) for density weights {', '.join([str(x) for x in survivors])}.")
+            self._run_tasks(relax_list)
+            if wave >= num_models:
+                break
+            if len(survivors) > 1:
+                best_fsc = {}
+                for wt in survivors:
+                    fsc_vals = self._get_fsc_vals(wt)
+                    #Weights without valid models are ranked last
+                    best_fsc[wt] = max(fsc_vals.values()) if not fsc_vals == {} else -math.inf
+                ranked = sorted(survivors, key=best_fsc.get, reverse=True)
+                keep = max(1, math.ceil(len(ranked) / self.halving_rate))
+                survivors = ranked[:keep]
+                for wt in ranked[keep:]:
+                    logger.info(f"Successive halving: density weight {wt} stopped after {done[wt]} replicate(s) (best FSC {best_fsc[wt]}).")
+                wave = min(wave * self.halving_rate, num_models)
+            if len(survivors) == 1:
+                wave = num_models
+
+    def _run_weight_search(self):
+        '''
+        Evaluate density weights proposed by the adaptive search until it converges
+        or the maximum number of steps is reached.
+        '''
+        if len(self.weights) > 1:
+            weights = [wt.replace(" ", "") for wt in self.weights]
+        else:
+            weights = None
+        search = weight_search.get_weight_search(self.weight_search,
+                                                 self.resolution,
+                                                 weights=weights,
+                                                 max_steps=self.weight_search_steps)
+        observed = {}
+        proposal = search.propose(observed)
+        while not proposal == []:
+            logger.info(f"Weight search ({self.weight_search}): testing density weights {', '.join([str(x) for x in proposal])}.")
+            self._run_weights(proposal)
+            for wt in proposal:
+                fsc_vals = self._get_fsc_vals(wt)
+                if fsc_vals == {}:
+                    logger.error(f"Could not find models for weight {wt}. Check log files for possible errors.")
+                    raise SystemExit
+                observed[wt] = max(fsc_vals.values())
+                logger.info(f"Density weight {wt}: best FSC {observed[wt]}")
+            proposal = search.propose(observed)
+        logger.info(f"Weight search finished after {len(observed)} weights. Best density weight is {search.best(observed)}.")
+
+    def _get_batch_suffix(self, mdl):
+        return "_refined_batch{}".format(mdl)
+
+    def _get_rosetta_cmd(self, mdl, wt, nstruct=1):
+        '''
+        Build the rosetta_scripts command based on variables.
+        With nstruct > 1 the replicates mdl to mdl + nstruct - 1 are generated by one process.
+        '''
         cmd_rosetta = [self.path.get_exec('rosetta_scripts'),
                "-in:file:s {}".format(self.pdb_file),
                "-in::use_truncated_termini true",
-               "-parser:protocol {}/{}".format(os.getcwd(),
-                                               self.get_xml_filename(wt)),
+               "-parser:protocol {}".format(os.path.join(self.base_dir,
+                                                         self._get_job_dir(wt),
+                                                         self.get_xml_filename(wt))),
                "-beta",
                "-ignore_unrecognized_res",
                "-score_symm_complex false",
@@ -522,6 +1288,9 @@ class FastRelaxDensity:
                "-dna true",
                "-out::suffix _refined_{}".format(mdl),
                "-overwrite"]
+        if nstruct > 1:
+            cmd_rosetta[cmd_rosetta.index("-out::suffix _refined_{}".format(mdl))] = "-out::suffix {}".format(self._get_batch_suffix(mdl))
+            cmd_rosetta.append("-nstruct {}".format(nstruct))
         if not self.map_file is None:
             cmd_rosetta.extend(["-edensity::cryoem_scatterers",
                                 "-crystal_refine",
@@ -536,28 +1305,134 @@ class FastRelaxDensity:
                 cmd_rosetta.append(params)
         if self.norepack:
             cmd_rosetta.append("-prevent_repacking true")
-        cmd_rosetta_file = " \\\n".join(cmd_rosetta)
+        if not self.seed is None:
+            cmd_rosetta.extend(["-run:constant_seed",
+                                "-run:jran {}".format(int(self.seed) + int(mdl))])
+        return cmd_rosetta
+
+    def _get_file_hash(self, file):
+        if not file in self.file_hashes:
+            self.file_hashes[file] = utils.hash_file(file)
+        return self.file_hashes[file]
+
+    def _get_batch_cmd(self, mdl, wt):
+        '''
+        Command line of the process that generates a replicate. For batched replicates the position
+        in the batch is added because the result depends on it.
+        '''
+        batch = self._get_batch(mdl, wt)
+        if len(batch) == 1:
+            return self._get_rosetta_cmd(mdl, wt)
+        first = batch[0][0]
+        return self._get_rosetta_cmd(first, wt, len(batch)) + [f"#replicate {mdl - first + 1}"]
 
-        with open(f"job_w{wt}_{mdl}.sh", 'w') as f:
+    def _get_task_hash(self, mdl, wt):
+        '''
+        Hash of all inputs of a relax task: input files, generated xml and command line.
+        '''
+        sha = hashlib.sha256()
+        input_files = [self.pdb_file, self.map_file, self.test_map, self.cst_file, self.symm_file] + self.params_files
+        for file in input_files:
+            if not file is None:
+                sha.update(self._get_file_hash(file).encode())
+        xml_file = os.path.join(self.base_dir, self._get_job_dir(wt), self.get_xml_filename(wt))
+        sha.update(utils.hash_file(xml_file).encode())
+        sha.update(' '.join(self._get_batch_cmd(mdl, wt)).encode())
+        return sha.hexdigest()
+
+    def _get_cache_key(self, mdl, wt):
+        '''
+        Content-addressed key of a relax task. Paths in the xml and command line are replaced
+        by placeholders so that identical tasks from different jobs and projects share the key.
+        '''
+        xml_file = os.path.join(self.base_dir, self._get_job_dir(wt), self.get_xml_filename(wt))
+        input_files = [('MODEL', self.pdb_file),
+                       ('MAP', self.map_file),
+                       ('TEST_MAP', self.test_map),
+                       ('CST', self.cst_file),
+                       ('SYMM', self.symm_file)]
+        input_files += [(f'PARAMS{i}', x) for i, x in enumerate(self.params_files)]
+        input_files = [(role, file) for role, file in input_files if not file is None]
+        placeholders = [(file, role) for role, file in input_files]
+        placeholders += [(xml_file, 'XML'),
+                         (self.path.get_exec('rosetta_scripts'), os.path.basename(self.path.get_exec('rosetta_scripts')))]
+        #Replace longer paths first in case one path is a prefix of another.
+        placeholders.sort(key=lambda x: len(x[0]), reverse=True)
+        with open(xml_file, 'r') as f:
+            xml = f.read()
+        cmd = ' '.join(self._get_batch_cmd(mdl, wt))
+        for path, role in placeholders:
+            xml = xml.replace(path, f"<{role}>")
+            cmd = cmd.replace(path, f"<{role}>")
+        sha = hashlib.sha256()
+        for role, file in input_files:
+            sha.update(f"{role}:{self._get_file_hash(file)}".encode())
+        sha.update(xml.encode())
+        sha.update(cmd.encode())
+        sha.update(f"seed:{self.seed}".encode())
+        return sha.hexdigest()
+
+    def _get_task_log(self, mdl, wt):
+        return os.path.join(self.base_dir, self._get_job_dir(wt), 'job_w{}_m{}.log'.format(wt, mdl))
+
+    def _is_valid_output(self, model):
+        if self.map_file is None:
+            return True
+        return validation.has_fsc(model)
+
+    def _rename_batch_outputs(self, batch):
+        '''
+        Rename the models of a batched process (pdbname_refined_batchN_0001.pdb ...) to the
+        names of single replicates (pdbname_refined_N_0001.pdb ...).
+        '''
+        first, wt = batch[0]
+        job_dir = os.path.join(self.base_dir, self._get_job_dir(wt))
+        for i, (mdl, _) in enumerate(batch):
+            output = os.path.join(job_dir, "{}{}_{:04d}.pdb".format(utils.get_filename(self.pdb_file),
+                                                                   self._get_batch_suffix(first),
+                                                                   i + 1))
+            if os.path.exists(output):
+                os.replace(output, self._get_model_output(mdl, wt))
+
+    def _get_mpi_ranks(self, batch):
+        '''
+        Number of MPI ranks for a batch. Rank 0 only distributes the jobs, so at most one rank per replicate is added.
+        '''
+        return max(2, min(int(self.nproc), len(batch) + 1))
+
+    def _get_relax_task(self, batch, threads=1):
+        '''
+        Write the rosetta_scripts command to a script and return it as task running in the job directory of the weight.
+        batch: tuple of (model, weight) tasks of the same weight run by one process.
+        '''
+        mdl, wt = batch[0]
+        job_dir = os.path.join(self.base_dir, self._get_job_dir(wt))
+        cmd_rosetta = self._get_rosetta_cmd(mdl, wt, len(batch))
+        slots = threads
+        if threads > 1:
+            cmd_rosetta.extend(["-multithreading:total_threads {}".format(threads),
+                                "-multithreading:interaction_graph_threads {}".format(threads)])
+        if self.mpi:
+            slots = self._get_mpi_ranks(batch)
+            cmd_rosetta = [self.mpirun.format(np=slots)] + cmd_rosetta
+        cmd_rosetta_file = " \\\n".join(cmd_rosetta)
+        if len(batch) == 1:
+            name = f"Density weight {wt}, Model {mdl}"
+            script = f"job_w{wt}_{mdl}.sh"
+            log_file = self._get_task_log(mdl, wt)
+        else:
+            name = f"Density weight {wt}, Models {mdl}-{batch[-1][0]}"
+            script = f"job_w{wt}_b{mdl}.sh"
+            log_file = os.path.join(job_dir, 'job_w{}_b{}.log'.format(wt, mdl))
+        with open(os.path.join(job_dir, script), 'w') as f:
             f.write(cmd_rosetta_file)
-        cmd_logger = '\n'.join(cmd_rosetta)
-        cmd_rosetta = ' '.join(cmd_rosetta)
-        logger.info(f"Starting task \"Density weight {wt}, Model {mdl}\".")
-        logger.info(f"Command line:\n{cmd_logger}")
-        try:
-            with open('job_w{}_m{}.log'.format(wt, mdl), 'w') as f:
-                p = Popen(cmd_rosetta, shell=True, stdout=f, stderr=f)#, preexec_fn=os.setsid)
-                p.communicate()
-                logger.info(f"Task finished: \"Density weight {wt}, Model {mdl}\".")
-        except KeyboardInterrupt:
-            logger.error("{} interrupted.".format(job_dir))
-            os.killpg(os.getpgid(p.pid), signal.SIGTERM)
-            raise KeyboardInterrupt
-        except Exception as e:
-            logger.error(f"Could not start task \"Density weight {wt}, Model {mdl}\".", exc_info=True)
-            raise Exception
-
-        os.chdir(self.base_dir)
+        return orchestrator.Task(name,
+                                 shlex.split(' '.join(cmd_rosetta)),
+                                 job_dir,
+                                 log_file,
+                                 key=batch,
+                                 memory=self._get_task_memory(),
+                                 slots=slots)
 
     def _select_best_model(self):
         """REMARK
@@ -577,20 +1452,20 @@ class FastRelaxDensity:
             for wt in wts:
                 fsc_vals = []
                 for dir in [x for x in os.listdir(self.base_dir) if os.path.isdir(x)]:
-                    #Collect all folders with same weight
-                    if dir.startswith("job_w{}".format(wt)):
+                    #Collect the folder of this weight
+                    if dir == self._get_job_dir(wt):
                         if self.ranking_method == "fsc":
-                            #There should be one model in each folder
-                            models = [x for x in os.listdir(
-                                os.path.join(self.base_dir, dir)) if x.endswith('.pdb')]
-                            if not models == []:
-                                fsc_vals = {}
-                                for model in models:
-                                    model_path = os.path.join(dir, models[0])
-                                    fsc, _, _, _ = validation.get_fsc(model_path)
-                                    if not model_path in fsc_vals:
-                                        fsc_vals[model] = float(fsc)
-                                best_model = max(fsc_vals, key=fsc_vals.get)
+                            fsc_vals = self._get_fsc_vals(wt)
+                            if not fsc_vals == {}:
+                                best_model = self._get_best_model(wt, fsc_vals)
+                            else:
+                                logger.error("Could not find models in job dir. Check log files for possible errors.")
+                                raise SystemExit
+                        elif self.ranking_method in ["model_fsc", "cc_mask", "cc_box"]:
+                            metric_vals = self._get_metric_vals(wt)
+                            if not metric_vals == {}:
+                                best_model = self._get_best_model(wt, metric_vals)
+                                logger.info(f"Density weight {wt}: best {self.ranking_method} {metric_vals[best_model]:.3f}")
                             else:
                                 logger.error("Could not find models in job dir. Check log files for possible errors.")
                                 raise SystemExit
@@ -619,73 +1494,476 @@ class FastRelaxDensity:
             raise SystemExit
 
 
+    def _run_validation(self):
+        '''
+        Run phenix.molprobity on the best models.
+        '''
+        logger.info("Running validation with phenix.molprobity.")
+        validation_dir = os.path.join(self.base_dir, "validation")
+        validation_list = []
+        models = [os.path.join(self.base_dir, x) for x in sorted(os.listdir(self.base_dir))
+                  if x.startswith("best_model") and x.endswith(".pdb")]
+        if not self.duplicate_rmsd is None and len(models) > 1:
+            models = self._remove_duplicate_models(models)
+        for model in models:
+            validation_list.append(orchestrator.Task(f"Validation {os.path.basename(model)}",
+                                                     [self.path.get_exec('phenix.molprobity'), model],
+                                                     validation_dir,
+                                                     os.path.join(validation_dir, validation.get_validation_log(model)),
+                                                     key=model))
+        if len(validation_list) > 0:
+            try:
+                if not os.path.exists(validation_dir):
+                    os.mkdir(validation_dir)
+                orchestrator.TaskOrchestrator(self.nproc).run(validation_list)
+                result = [validation.get_validation_results(task.key, task.log_file) for task in validation_list]
+                result = [x for x in result if not x is None]
+                logger.debug("Validation result:")
+                logger.debug(result)
+                if not result == []:
+                    df = pd.DataFrame(result)
+                    df.to_csv(os.path.join(validation_dir, 'validation_results.csv'))
+                    with open(os.path.join(validation_dir, 'validation.json'), 'w') as f:
+                        json.dump(result, f)
+                else:
+                    logger.error("No validation results obtained.")
+            except KeyboardInterrupt:
+                raise KeyboardInterrupt
+            except Exception as e:
+                logger.error(f"Error during validation: {e}", exc_info=True)
+                raise Exception
+        else:
+            logger.error("No models found for validation.")
+
+    def _get_segments(self, residues):
+        if not self.segment_selections is None:
+            return segments.partition_by_selection(residues, [x.strip() for x in self.segment_selections.split(';')])
+        elif self.segment == 'domain':
+            return segments.partition_by_domain(residues, int(self.max_segment_residues))
+        else:
+            return segments.partition_by_chain(residues)
+
+    def _get_segment_dir(self, i):
+        return os.path.join(self.base_dir, 'segments', f'segment_{i}')
+
+    def _get_refinement_cmd(self, model, cst_file, nproc, max_memory=None, weights=None, selection=None):
+        '''
+        rosemcl command that refines a segment or selection in its own directory with a cropped map.
+        The options of this job are forwarded as in REFINEMENT_OPTIONS.
+        If weights are given, the model is refined at these weights (grid) without weight search.
+        '''
+        values = {'nproc': nproc,
+                  'max_memory': max_memory,
+                  'selection_str': selection,
+                  'crop_map': True,
+                  'log_file': 'relax.log',
+                  'debug': logger.level == logging.DEBUG,
+                  'params_files': ','.join(self.params_files) if not self.params_files == [] else None,
+                  'cache_dir': os.path.abspath(self.cache_dir) if not self.cache_dir is None else None,
+                  'runtime_history': os.path.abspath(self.runtime_history) if not self.runtime_history is None else None}
+        if weights is None:
+            values['weights'] = ','.join([wt.replace(" ", "") for wt in self.weights])
+        else:
+            values.update({'weights': ','.join(weights), 'weight_search': 'grid', 'successive_halving': False})
+        if self.coordinate_cst_weight is None:
+            values['coordinate_cst_weight'] = SEGMENT_COORDINATE_CST_WEIGHT
+        cmd = [sys.executable, '-m', 'rosem.rosemcl', model, self.map_file]
+        if not cst_file is None:
+            cmd.append(cst_file)
+        for option, attribute in REFINEMENT_OPTIONS:
+            value = values[attribute] if attribute in values else getattr(self, attribute)
+            if isinstance(value, bool):
+                cmd += [option] if value else []
+            elif not value is None:
+                cmd += [option, str(value)]
+        return cmd
+
+    def _merge_segments(self, residues, segment_list):
+        '''
+        Merge the best models of the segments into one model per density weight.
+        If the segments have no density weight in common (adaptive weight search),
+        the models with the highest ranking_method value of each segment are merged.
+        '''
+        best_models = []
+        for i in range(len(segment_list)):
+            segment_dir = self._get_segment_dir(i)
+            models = {}
+            for file in os.listdir(segment_dir):
+                m = re.match(r"best_model_w(.+)\.pdb$", file)
+                if m:
+                    models[m.group(1)] = os.path.join(segment_dir, file)
+            if models == {}:
+                logger.error(f"Segment {i} did not produce a model. Check {os.path.join(segment_dir, 'relax.log')} for errors.")
+                raise SystemExit
+            best_models.append(models)
+        common = set.intersection(*[set(x.keys()) for x in best_models])
+        if len(common) > 0:
+            merged = {f"best_model_w{wt}.pdb": [x[wt] for x in best_models] for wt in sorted(common)}
+        else:
+            merged = {"best_model_merged.pdb": []}
+            for models in best_models:
+                vals = {model: self._get_ranking_value(model) for model in models.values()}
+                vals = {k: v for k, v in vals.items() if not v is None}
+                merged["best_model_merged.pdb"].append(max(vals, key=vals.get) if not vals == {} else list(models.values())[0])
+        for name, models in merged.items():
+            missing = segments.merge_models(residues, segment_list, models, os.path.join(self.base_dir, name))
+            if missing > 0:
+                logger.warning(f"{missing} residues missing in refined segments of {name}. Using the input coordinates.")
+            logger.info(f"Merged model written to: {os.path.join(self.base_dir, name)}")
+
+    def _run_segments(self):
+        '''
+        Refine segments of the model (chains, domains or selections) in parallel. Each segment is
+        refined with its neighboring residues of other segments as context, and residues at the
+        boundary are held by coordinate restraints. The refined segments are merged into one model.
+        '''
+        if self.map_file is None or not self.symm_file is None or self.slurm_array:
+            logger.error("Segmented refinement requires a map and is not supported with symmetry or --slurm_array.")
+            raise SystemExit
+        if not self.selection_str is None:
+            logger.error("Segmented refinement is not supported with --selection. Use --segment_selections instead.")
+            raise SystemExit
+        residues = segments.read_residues(self.pdb_file)
+        segment_list = self._get_segments(residues)
+        if segment_list == []:
+            logger.error("No segments found.")
+            raise SystemExit
+        boundary, context = segments.get_boundaries(residues, segment_list, float(self.segment_context))
+        num_concurrent = max(1, min(len(segment_list), int(self.nproc)))
+        nproc = max(1, int(self.nproc) // num_concurrent)
+        max_memory = self.max_memory
+        if max_memory is None:
+            available = resources.get_available_memory()
+            if not available is None:
+                max_memory = available * resources.MEMORY_SAFETY_FACTOR / resources.GB
+        if not max_memory is None:
+            max_memory = round(max_memory / num_concurrent, 2)
+        logger.info(f"Refining {len(segment_list)} segments with up to {num_concurrent} segments in parallel.")
+        tasks = []
+        for i, positions in enumerate(segment_list):
+            segment_dir = self._get_segment_dir(i)
+            os.makedirs(segment_dir, exist_ok=True)
+            model = os.path.join(segment_dir, f"{utils.get_filename(self.pdb_file)}_segment_{i}.pdb")
+            segments.write_segment_model(residues, set(positions) | context[i], model)
+            cst_file = os.path.join(segment_dir, f"segment_{i}.cst")
+            if segments.write_segment_restraints(residues, positions, boundary[i], context[i], cst_file, self.cst_file) == 0:
+                cst_file = None
+            logger.info(f"Segment {i}: {len(positions)} residues, {len(context[i])} context residues.")
+            tasks.append(orchestrator.Task(f"Segment {i}",
+                                           self._get_refinement_cmd(model, cst_file, nproc, max_memory),
+                                           segment_dir,
+                                           os.path.join(segment_dir, 'segment.out'),
+                                           key=i,
+                                           slots=nproc))
+
+        def on_finish(task):
+            logger.info(f"Segment {task.key} finished after {scheduler.format_duration(task.duration)}.")
+
+        orchestrator.TaskOrchestrator(self.nproc, on_finish=on_finish).run(tasks)
+        self._merge_segments(residues, segment_list)
+
+    def _report_residue_energies(self):
+        '''
+        Collect the per-residue energies of all models from the energies tables written by rosetta
+        and report the consensus over density weights and outliers in energies/.
+        '''
+        models, groups = [], []
+        for dir in sorted(os.listdir(self.base_dir)):
+            m = re.match(r"job_w(\d+)$", dir)
+            if m and os.path.isdir(os.path.join(self.base_dir, dir)):
+                job_dir = os.path.join(self.base_dir, dir)
+                for model in sorted([x for x in os.listdir(job_dir) if x.endswith('.pdb')]):
+                    models.append(os.path.join(job_dir, model))
+                    groups.append(f"w{m.group(1)}")
+        tables = energies.EnergyTables(models, groups)
+        if len(tables) == 0:
+            logger.warning("No energies tables found in the models.")
+            return
+        energies_dir = os.path.join(self.base_dir, 'energies')
+        os.makedirs(energies_dir, exist_ok=True)
+        tables.save(os.path.join(energies_dir, 'residue_energies.npz'))
+        residues, _, _ = preprocess.read_model(tables.models[0])
+        rows = energies.get_residue_report(tables, [energies.DENSITY_TERM, 'total'], residues)
+        pd.DataFrame(rows).to_csv(os.path.join(energies_dir, 'residue_energies.csv'), index=False)
+        outliers = [f"{x['resname']}{x.get('resseq', x['pose_number'])}{x.get('chain', '')}" for x in rows if x['outlier']]
+        logger.info(f"Per-residue energies of {len(tables)} models written to {os.path.join(energies_dir, 'residue_energies.csv')}.")
+        if not outliers == []:
+            logger.info(f"{len(outliers)} residues with outlying energies: {', '.join(outliers[:20])}{' ...' if len(outliers) > 20 else ''}")
+
+    def _get_ranking_order(self, models):
+        '''
+        Indices of models sorted by ranking value, best first. Models without a value are last.
+        '''
+        vals = [self._get_ranking_value(x) for x in models]
+        return sorted(range(len(models)), key=lambda i: -vals[i] if not vals[i] is None else math.inf)
+
+    def _remove_duplicate_models(self, models):
+        '''
+        Remove models within duplicate_rmsd of a model with a higher ranking value. Focused models
+        differ from the model they were refined from only in a few residues and are always kept.
+        '''
+        models_ensemble = ensemble.Ensemble(models)
+        if len(models_ensemble.keys) == 0:
+            logger.warning("Best models have no atoms in common. Duplicates are not removed.")
+            return models
+        rmsd = models_ensemble.get_rmsd_matrix()
+        names = [os.path.basename(x) for x in models]
+        for i, name in enumerate(names):
+            if name.endswith('_focused.pdb'):
+                rmsd[i, :] = rmsd[:, i] = math.nan
+                rmsd[i, i] = 0.0
+        groups = ensemble.get_duplicates(rmsd, float(self.duplicate_rmsd), order=self._get_ranking_order(models))
+        for representative, duplicates in groups.items():
+            for i in duplicates:
+                logger.info(f"{names[i]} is a duplicate of {names[representative]}"
+                            f" (RMSD {rmsd[i, representative]:.2f} A). Skipped.")
+        return [models[i] for i in sorted(groups)]
+
+    def _analyze_ensembles(self):
+        '''
+        Pairwise RMSD and per-residue RMSF of the models of each density weight. Models within
+        duplicate_rmsd of a model with a higher ranking value are reported as duplicates in ensemble/.
+        '''
+        ensemble_dir = os.path.join(self.base_dir, 'ensemble')
+        for dir in sorted(os.listdir(self.base_dir)):
+            m = re.match(r"job_w(\d+)$", dir)
+            if not m or not os.path.isdir(os.path.join(self.base_dir, dir)):
+                continue
+            wt = m.group(1)
+            job_dir = os.path.join(self.base_dir, dir)
+            models = sorted([x for x in os.listdir(job_dir) if x.endswith('.pdb')])
+            if len(models) < 2:
+                continue
+            models_ensemble = ensemble.Ensemble([os.path.join(job_dir, x) for x in models])
+            if len(models_ensemble.keys) == 0:
+                logger.warning(f"Density weight {wt}: models have no atoms in common. Ensemble not analyzed.")
+                continue
+            rmsd = models_ensemble.get_rmsd_matrix()
+            groups = ensemble.get_duplicates(rmsd, float(self.duplicate_rmsd),
+                                             order=self._get_ranking_order([os.path.join(job_dir, x) for x in models]))
+            mean_rmsd = ensemble.get_mean_rmsd(rmsd)
+            residues, rmsf = models_ensemble.get_rmsf()
+            os.makedirs(ensemble_dir, exist_ok=True)
+            with open(os.path.join(ensemble_dir, f"ensemble_w{wt}.json"), 'w') as f:
+                json.dump({'models': models,
+                           'rmsd': rmsd.tolist(),
+                           'mean_rmsd': mean_rmsd,
+                           'duplicate_rmsd': float(self.duplicate_rmsd),
+                           'duplicates': {models[k]: [models[x] for x in v] for k, v in groups.items()}}, f, indent=2)
+            pd.DataFrame([{'chain': chain, 'resseq': resseq, 'icode': icode.strip(), 'rmsf': float(value)}
+                          for (chain, resseq, icode), value in zip(residues, rmsf)]).to_csv(
+                os.path.join(ensemble_dir, f"rmsf_w{wt}.csv"), index=False)
+            logger.info(f"Density weight {wt}: {len(groups)} of {len(models)} models are unique within"
+                        f" {self.duplicate_rmsd} A RMSD (mean pairwise RMSD {mean_rmsd:.2f} A).")
+            if len(groups) < len(models):
+                logger.info(f"Density weight {wt}: replicates converged, num_models could be lowered to {len(groups)}.")
+
+    def _get_fast_validation(self, wt):
+        '''
+        In-process validation of all models of a density weight (dict of model -> stats).
+        '''
+        if not wt in self.fast_validation_results:
+            job_dir = os.path.join(self.base_dir, self._get_job_dir(wt))
+            self.fast_validation_results[wt] = {x: validation.get_fast_validation_results(os.path.join(job_dir, x))
+                                                for x in sorted(os.listdir(job_dir)) if x.endswith('.pdb')}
+        return self.fast_validation_results[wt]
+
+    def _run_fast_validation(self):
+        '''
+        Write the in-process validation of all models of each density weight, which is used to exclude
+        models with twisted peptides from the selection of the best model, to validation/fast_validation.csv.
+        '''
+        validation_dir = os.path.join(self.base_dir, 'validation')
+        result = []
+        for dir in sorted(os.listdir(self.base_dir)):
+            m = re.match(r"job_w(\d+)$", dir)
+            if not m or not os.path.isdir(os.path.join(self.base_dir, dir)):
+                continue
+            wt = m.group(1)
+            stats = list(self._get_fast_validation(wt).values())
+            if stats == []:
+                continue
+            for x in stats:
+                x['density_weight'] = wt
+            twisted = len([x for x in stats if x['twisted_general'] > 0 or x['twisted_proline'] > 0])
+            logger.info(f"Density weight {wt}: {twisted} of {len(stats)} models with twisted peptides,"
+                        f" approximate clashscore {min([x['approx_clashscore'] for x in stats]):.1f}-"
+                        f"{max([x['approx_clashscore'] for x in stats]):.1f}.")
+            result.extend(stats)
+        if not result == []:
+            os.makedirs(validation_dir, exist_ok=True)
+            pd.DataFrame(result).to_csv(os.path.join(validation_dir, 'fast_validation.csv'), index=False)
+            logger.info(f"Fast validation of {len(result)} models written to {os.path.join(validation_dir, 'fast_validation.csv')}.")
+
+    def _get_residue_fit(self, model):
+        '''
+        Per-residue correlation of a model with the map. Written to <model>_residue_fit.csv.
+        '''
+        if self.map_metrics is None:
+            self.map_metrics = density.MapMetrics(self.map_file, self.resolution, self.test_map)
+        residues, cc = self.map_metrics.get_residue_cc(model)
+        df = pd.DataFrame([{'chain': chain, 'resseq': resseq, 'resname': resname, 'cc': value}
+                           for (chain, resseq, resname), value in zip(residues, cc)])
+        df.to_csv(f"{os.path.splitext(model)[0]}_residue_fit.csv", index=False)
+        return residues, cc
+
+    def _run_focused_refinement(self):
+        '''
+        Refine the residues of the best model that fit the map poorly (correlation below
+        residue_cc_threshold) with a map cropped to these residues. The refined model is
+        written to best_model_w<weight>_focused.pdb.
+        '''
+        if not self.symm_file is None:
+            logger.warning("Focused refinement is not supported with symmetry. Skipped.")
+            return
+        best_models = {}
+        for file in os.listdir(self.base_dir):
+            m = re.match(r"best_model_w(\d+)\.pdb$", file)
+            if m:
+                model = os.path.join(self.base_dir, file)
+                metrics = self._get_model_metrics(model)
+                best_models[m.group(1)] = density.get_band_fsc(metrics['resolution'], metrics['fsc'], *self._get_ranking_resolution())
+        if best_models == {}:
+            logger.error("Focused refinement: no best models found.")
+            raise SystemExit
+        wt = max(best_models, key=lambda x: best_models[x] if not best_models[x] is None else -1.0)
+        model = os.path.join(self.base_dir, f"best_model_w{wt}.pdb")
+        residues, cc = self._get_residue_fit(model)
+        poor_fit = [i for i, x in enumerate(cc) if x < float(self.residue_cc_threshold)]
+        if not self.selection_str is None:
+            selected = ResidueSelection(self.selection_str).get_selected(residues)
+            poor_fit = [i for i in poor_fit if i in selected]
+        if poor_fit == []:
+            logger.info(f"Focused refinement: no residues of {os.path.basename(model)} with correlation below {self.residue_cc_threshold}.")
+            return
+        selection = selection_parser.get_selection_string(residues, poor_fit, FOCUSED_FLANK_RESIDUES)
+        logger.info(f"Focused refinement of {len(poor_fit)} residues of {os.path.basename(model)} with correlation"
+                    f" below {self.residue_cc_threshold}: {selection}")
+        focused_dir = os.path.join(self.base_dir, 'focused')
+        os.makedirs(focused_dir, exist_ok=True)
+        with open(os.path.join(focused_dir, 'selection.txt'), 'w') as f:
+            f.write(selection + '\n')
+        task = orchestrator.Task("Focused refinement",
+                                 self._get_refinement_cmd(model, self.cst_file, int(self.nproc), self.max_memory,
+                                                          weights=[wt], selection=selection),
+                                 focused_dir,
+                                 os.path.join(focused_dir, 'focused.out'),
+                                 key=wt,
+                                 slots=int(self.nproc))
+        orchestrator.TaskOrchestrator(self.nproc).run([task])
+        refined = os.path.join(focused_dir, f"best_model_w{wt}.pdb")
+        if not os.path.exists(refined):
+            logger.error(f"Focused refinement did not produce a model. Check {os.path.join(focused_dir, 'relax.log')} for errors.")
+            raise SystemExit
+        focused_model = os.path.join(self.base_dir, f"best_model_w{wt}_focused.pdb")
+        copyfile(refined, focused_model)
+        logger.info(f"Model after focused refinement copied to: {focused_model}")
+
+    def _submit_slurm_array(self):
+        '''
+        Submit one SLURM array task per (model, weight) task and a dependent gather job that
+        selects the best models and runs the validation.
+        '''
+        if not self.weight_search == 'grid' or self.successive_halving:
+            logger.error("Adaptive weight search and successive halving are not supported with --slurm_array.")
+            raise SystemExit
+        relax_list = []
+        for wt in [wt.replace(" ", "") for wt in self.weights]:
+            relax_list.extend(self._prepare_weight(wt))
+        slurm.submit_array(self.base_dir,
+                           relax_list,
+                           self.log_file,
+                           inputs={'cst_file': self.cst_file,
+                                   'pdb_file': self.pdb_file,
+                                   'symm_file': self.symm_file,
+                                   'map_file': self.map_file,
+                                   'test_map': self.test_map},
+                           nproc=self.nproc,
+                           mem=math.ceil(self._get_task_memory() / resources.GB),
+                           account=self.slurm_account,
+                           sbatch=self.sbatch)
+
+    def _read_array_inputs(self):
+        '''
+        Use the inputs generated by the submitting job of a SLURM array, e.g. restraints, the
+        pre-fitted model and preprocessed maps. Returns the array tasks.
+        '''
+        inputs, relax_list = slurm.read_array_tasks(self.base_dir)
+        self.cst_file = inputs.get('cst_file')
+        self.pdb_file = inputs.get('pdb_file', self.pdb_file)
+        self.symm_file = inputs.get('symm_file', self.symm_file)
+        if not self.map_file is None:
+            self.map_file = inputs.get('map_file', self.map_file)
+            self.test_map = inputs.get('test_map', self.test_map)
+        return relax_list
+
+    def _gather(self):
+        '''
+        Select the best models, analyze them and run the validation.
+        '''
+        self._select_best_model()
+        if not self.duplicate_rmsd is None:
+            self._analyze_ensembles()
+        if self.residue_energies:
+            self._report_residue_energies()
+        if self.focused_refinement and not self.map_file is None:
+            self._run_focused_refinement()
+        if self.fast_validation:
+            self._run_fast_validation()
+        if self.run_validation:
+            self._run_validation()
+
+    def _run_array_task(self):
+        '''
+        Run a single task of a SLURM array job.
+        '''
+        relax_list = self._read_array_inputs()
+        if not 0 <= self.array_task < len(relax_list):
+            logger.error(f"Array task {self.array_task} not found in array task list.")
+            raise SystemExit
+        mdl, wt = relax_list[self.array_task]
+        self._run_tasks([(mdl, wt)])
+        if not os.path.exists(self._get_model_output(mdl, wt)):
+            logger.error(f"Task \"Density weight {wt}, Model {mdl}\" did not produce a model.")
+            raise SystemExit
+
     def pipeline(self):
         '''
         Parallelize jobs to test different weights or generate multiple models.
         '''
+        if not self.array_task is None:
+            self._run_array_task()
+            return
+        if self.gather:
+            #Inputs of array tasks are not generated again
+            if slurm.has_array_tasks(self.base_dir):
+                self._read_array_inputs()
+            self._gather()
+            return
+        if self.prefit:
+            self._prefit_model()
+        if self.detect_symmetry:
+            self._detect_symmetry()
         if not self.reference_model is None:
             self._generate_reference_model_restraints()
         if self.reference_model is None and self.self_restraints:
             self.reference_model = self.pdb_file
             self._generate_reference_model_restraints()
-        relax_list = []
+        self._preprocess_maps()
+        if not self.segment is None or not self.segment_selections is None:
+            self._run_segments()
+            if self.run_validation:
+                self._run_validation()
+            return
         logger.info("Preparing input for Rosetta.")
-        for wt in self.weights:
-            wt = wt.replace(" ","")
-            #Create job directory.
-            job_dir = self._get_job_dir(wt)
-            if not os.path.exists(job_dir):
-                os.mkdir(job_dir)
-            else:
-                logger.info(f"Job directory for weight {wt} already exists. Overwriting content.")
-            #Generate input xml
-            os.chdir(job_dir)
-            self._generate_xml(wt)
-            os.chdir(self.base_dir)
-            for i in range(int(self.num_models)):
-                relax_list.append((i, wt))
-
-        logger.debug("Input List")
-        logger.debug(relax_list)
-
-        with closing(Pool(self.nproc)) as pool:
-            pool.starmap(self._run_relax, relax_list)
-        self._select_best_model()
-
-
-
-        if self.run_validation:
-            logger.info("Running validation with phenix.molprobity.")
-            validation_list = []
-            for file in os.listdir(self.base_dir):
-                if file.startswith("best_model"):
-                    validation_list.append((os.path.abspath(file),
-                                          self.path.get_exec('phenix.molprobity')))
-            if len(validation_list) > 0:
-                try:
-                    if not os.path.exists("validation"):
-                        os.mkdir("validation")
-                    os.chdir('validation')
-                    with closing(Pool(self.nproc)) as pool:
-                        result = pool.starmap_async(validation.run_validation, validation_list)
-                    result = result.get()
-                    logger.debug("Validation result:")
-                    logger.debug(result)
-                    if not result == [] and not result is None:
-                        df = pd.DataFrame(result)
-                        df.to_csv('validation_results.csv')
-                        with open('validation.json', 'w') as f:
-                            json.dump(result, f)
-                    else:
-                        logger.error("No validation results obtained.")
-                    os.chdir(self.base_dir)
-                except KeyboardInterrupt:
-                    raise KeyboardInterrupt
-                except Exception as e:
-                    logger.error(f"Error during validation: {e}", exc_info=True)
-                    raise Exception
-            else:
-                logger.error("No models found for validation.")
+        if self.slurm_array:
+            self._submit_slurm_array()
+            return
+        if self.weight_search == 'grid':
+            self._run_weights([wt.replace(" ","") for wt in self.weights])
+        else:
+            self._run_weight_search()
+        self._gather()
 
 def CheckExt(choices):
     class Action(argparse.Action):
@@ -716,6 +1994,48 @@ def get_cli_args():
                         help="Comma separated list of params files (no spaces between commas).")
     parser.add_argument('--weight', '-w',
                         help='Density weight. To test multiple weights separate numbers with \',\' (w/o space). Default=35', default='35')
+    parser.add_argument('--weight_search',
+                        help='Strategy for testing density weights. "grid" runs all weights given with --weight.'
+                             ' "golden" (golden-section) and "bayes" (gaussian process) start from a resolution based'
+                             ' prior and choose the next weights from the FSC of finished models.'
+                             ' Weights given with --weight define the search interval. Default=grid',
+                        choices=['grid', 'golden', 'bayes'],
+                        default='grid')
+    parser.add_argument('--weight_search_steps',
+                        help='Maximum number of density weights tested by the adaptive weight search. Default=6',
+                        default=6,
+                        type=int)
+    parser.add_argument('--successive_halving',
+                        help='Run replicates in waves and only continue the best density weights (ranked by FSC)'
+                             ' after each wave.',
+                        action='store_true')
+    parser.add_argument('--halving_rate',
+                        help='Only the top 1/halving_rate density weights are continued after each wave'
+                             ' of successive halving. Default=2',
+                        default=2,
+                        type=int)
+    parser.add_argument('--first_wave',
+                        help='Number of replicates per density weight in the first wave of successive halving. Default=2',
+                        default=2,
+                        type=int)
+    parser.add_argument('--runtime_history',
+                        help='File with durations of previous tasks used to schedule long tasks first'
+                             ' and estimate the remaining time. Default=~/.rosem/runtime_history.json')
+    parser.add_argument('--overwrite',
+                        help='Rerun all tasks. By default tasks recorded as completed in task_manifest.json'
+                             ' with unchanged input are skipped when the job is restarted.',
+                        action='store_true')
+    parser.add_argument('--cache',
+                        help='Reuse results of identical rosetta tasks from previous jobs and store new results'
+                             ' in the cache. Tasks are run with a constant seed (see --seed).'
+                             ' Use rosemcache to inspect and prune the cache.',
+                        action='store_true')
+    parser.add_argument('--cache_dir',
+                        help='Cache directory. Default=~/.rosem/cache')
+    parser.add_argument('--seed',
+                        help='Random seed for rosetta. Model n is run with seed + n.'
+                             ' Default=random or {} with --cache'.format(DEFAULT_SEED),
+                        type=int)
     parser.add_argument('--bfactor',
                         help='Run B-factor refinement after protocol',
                         action='store_true')
@@ -776,6 +2096,129 @@ def get_cli_args():
                         help='Number of processors.',
                         default=1,
                         type=int)
+    parser.add_argument('--nstruct_batch',
+                        help='Number of replicates generated by one rosetta_scripts process with -nstruct.'
+                             ' The map and database are loaded once per process. 0 chooses the largest batch'
+                             ' that still keeps nproc processes running. Default=1',
+                        default=1,
+                        type=int)
+    parser.add_argument('--mpi',
+                        help='Use the MPI build of rosetta_scripts. The replicates of each density weight are'
+                             ' distributed to the ranks of one MPI job with up to nproc ranks.',
+                        action='store_true')
+    parser.add_argument('--mpirun',
+                        help='Command to launch MPI jobs. {np} is replaced by the number of ranks.'
+                             ' Default="mpirun -np {np}"',
+                        default='mpirun -np {np}')
+    parser.add_argument('--threads_per_task',
+                        help='Threads per rosetta_scripts process (requires a cxx11thread build).'
+                             ' 0 splits nproc between the tasks. Default=1',
+                        default=1,
+                        type=int)
+    parser.add_argument('--crop_map',
+                        help='Crop the map and test map to the model (or selection) plus padding before refinement.'
+                             ' Reduces memory and runtime of tasks for models that cover only a part of the map.'
+                             ' Not supported with symmetry.',
+                        action='store_true')
+    parser.add_argument('--crop_padding',
+                        help='Padding in Angstrom around the model for --crop_map. Default=10',
+                        type=float,
+                        default=10.0)
+    parser.add_argument('--resample_map',
+                        help='Fourier-resample oversampled maps to a voxel size of resolution/3 before refinement.'
+                             ' Reduces memory and runtime of density scoring.',
+                        action='store_true')
+    parser.add_argument('--segment',
+                        help='Refine large models in segments that run in parallel, each with a map cropped to'
+                             ' the segment. "chain" refines each chain separately, "domain" splits chains into'
+                             ' domains of the residue contact graph with at most --max_segment_residues residues.'
+                             ' The refined segments are merged into one model per density weight.',
+                        choices=['chain', 'domain'])
+    parser.add_argument('--segment_selections',
+                        help='Segments defined by selections (same syntax as --selection) separated by \';\'.'
+                             ' Residues not in a selection are not refined.')
+    parser.add_argument('--max_segment_residues',
+                        help='Maximum number of residues of a domain with --segment domain. Default=1500',
+                        default=1500,
+                        type=int)
+    parser.add_argument('--segment_context',
+                        help='Residues of other segments within this distance (Angstrom) are included as context'
+                             ' and held by coordinate restraints. Default=8',
+                        default=8.0,
+                        type=float)
+    parser.add_argument('--coordinate_cst_weight',
+                        help='Weight for coordinate restraints. Default={} for segments, otherwise not changed.'.format(SEGMENT_COORDINATE_CST_WEIGHT),
+                        type=float)
+    parser.add_argument('--detect_symmetry',
+                        help='Detect cyclic symmetry from chains with the same sequence. If found, the asymmetric'
+                             ' unit is refined with a generated symmetry definition. Ignored if a .symm file is given.',
+                        action='store_true')
+    parser.add_argument('--prefit',
+                        help='Rigid-body pre-fit of the model into the map by FFT cross-correlation of a simulated'
+                             ' model map with the map over all translations and a grid of rotations.'
+                             ' For models that are not well placed in the map.',
+                        action='store_true')
+    parser.add_argument('--prefit_angle_step',
+                        help='Angular step in degrees of the rotation grid for --prefit. Default=30',
+                        default=30.0,
+                        type=float)
+    parser.add_argument('--ranking_method',
+                        help='Metric to select the best model of each density weight. "fsc" uses the FSC reported by'
+                             ' rosetta. "model_fsc", "cc_mask" and "cc_box" are computed from a simulated model map'
+                             ' and can be changed when rerunning with --gather. Default=fsc',
+                        choices=['fsc', 'model_fsc', 'cc_mask', 'cc_box'],
+                        default='fsc')
+    parser.add_argument('--ranking_resolution',
+                        help='Resolution band LOW:HIGH in Angstrom of the FSC for --ranking_method model_fsc,'
+                             ' e.g. 8:4. Default=resolution+10:resolution')
+    parser.add_argument('--focused_refinement',
+                        help='After selecting the best models, refine the residues of the best model with a'
+                             ' correlation to the map below --residue_cc_threshold in a follow-up refinement'
+                             ' with a selection and a map cropped to these residues.',
+                        action='store_true')
+    parser.add_argument('--residue_cc_threshold',
+                        help='Per-residue correlation with the map below which residues are refined with'
+                             ' --focused_refinement. Default=0.5',
+                        default=0.5,
+                        type=float)
+    parser.add_argument('--residue_energies',
+                        help='Collect the per-residue energies from the energies tables of all models and report'
+                             ' the consensus over density weights and outlier residues in energies/.',
+                        action='store_true')
+    parser.add_argument('--duplicate_rmsd',
+                        help='Models within this RMSD (Angstrom) are duplicates. Reports the pairwise RMSD, per-residue'
+                             ' RMSF and duplicates of the models of each density weight in ensemble/ and skips'
+                             ' validation of duplicate best models.',
+                        type=float)
+    parser.add_argument('--max_clashscore',
+                        help='Exclude models with an approximate clashscore (heavy-atom overlaps per 1000 atoms) above'
+                             ' this value from the selection of the best model and rank models with nearly equal FSC'
+                             ' by clashscore. If all models exceed it, all are ranked. Default=None',
+                        type=float)
+    parser.add_argument('--fast_validation',
+                        help='Validate all models in-process (cis/twisted peptides, backbone bond and angle RMSD,'
+                             ' approximate clashscore), exclude models with twisted peptides from the selection of'
+                             ' the best model and write the results to validation/fast_validation.csv.',
+                        action='store_true')
+    parser.add_argument('--max_memory',
+                        help='Memory in GB available for rosetta tasks. A task is only started if its'
+                             ' estimated memory fits. Default=Detected from /proc/meminfo or the cgroup limit.',
+                        type=float)
+    parser.add_argument('--slurm_array',
+                        help='Submit one SLURM array task per density weight and model and a dependent job'
+                             ' that selects the best models and runs the validation. Only with grid weight search.',
+                        action='store_true')
+    parser.add_argument('--slurm_account',
+                        help='Account for SLURM array and gather jobs.')
+    parser.add_argument('--sbatch',
+                        help='Command used to submit SLURM jobs. Default=sbatch',
+                        default='sbatch')
+    parser.add_argument('--array_task',
+                        help=argparse.SUPPRESS,
+                        type=int)
+    parser.add_argument('--gather',
+                        help=argparse.SUPPRESS,
+                        action='store_true')
     parser.add_argument('--selection',
                         help='Selection of residues and/or chains.')
     parser.add_argument('--reference_model',
@@ -863,7 +2306,8 @@ def main():
 
     try:
         fastrelax_main(*args)
-        if args[0].log_file:
+        #The gather job reports the exit code of a job submitted as SLURM array.
+        if args[0].log_file and not args[0].slurm_array:
             with open(args[0].log_file, 'a') as f:
                 f.write("\nJob finished with exit code 0")
     except KeyboardInterrupt:
@@ -0,0 +1,188 @@
+#Copyright 2021 Georg Kempf, Friedrich Miescher Institute for Biomedical Research
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+import os
+import json
+import math
+import time
+import heapq
+import logging
+from rosem import utils
+
+logger = logging.getLogger("RosEM")
+
+#Rough runtime per residue and relax cycle in seconds, used until a history is available.
+DEFAULT_SECONDS_PER_RESIDUE_CYCLE = {'cartesian': 0.6,
+                                     'torsional': 0.3}
+
+
+def get_history_file():
+    return os.path.join(utils.get_rosem_dir(), 'runtime_history.json')
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    return f"{hours:d}:{minutes:02d}:{seconds:02d}"
+
+
+def estimate_makespan(durations, nproc, busy=None):
+    '''
+    Simulate greedy longest-task-first assignment of durations to nproc slots.
+    busy: remaining durations of tasks already occupying slots.
+    '''
+    slots = sorted(busy) if not busy is None else []
+    slots = slots[:nproc] + [0.0] * max(0, nproc - len(slots))
+    heapq.heapify(slots)
+    for duration in sorted(durations, reverse=True):
+        heapq.heappush(slots, heapq.heappop(slots) + duration)
+    return max(slots) if not slots == [] else 0.0
+
+
+class RuntimeHistory:
+    '''
+    Local store of past task durations. Each record holds the task features
+    (residues, box, num_cycles, space, weight, threads) and the duration in seconds.
+    '''
+    def __init__(self, history_file=None, max_records=5000):
+        if history_file is None:
+            history_file = get_history_file()
+        self.history_file = history_file
+        self.max_records = max_records
+        self.records = self._load()
+
+    def _load(self):
+        if os.path.exists(self.history_file):
+            try:
+                with open(self.history_file, 'r') as f:
+                    return json.load(f)
+            except (ValueError, OSError):
+                logger.debug(f"Could not read runtime history from {self.history_file}.")
+        return []
+
+    def add(self, features, duration):
+        record = dict(features)
+        record['duration'] = duration
+        self.records.append(record)
+
+    def save(self):
+        #Merge with records written by other jobs in the meantime.
+        records = self._load()
+        known = {json.dumps(x, sort_keys=True) for x in records}
+        records.extend([x for x in self.records if not json.dumps(x, sort_keys=True) in known])
+        self.records = records[-self.max_records:]
+        tmp_file = f"{self.history_file}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_file, 'w') as f:
+                json.dump(self.records, f)
+            os.replace(tmp_file, self.history_file)
+        except OSError:
+            logger.debug(f"Could not write runtime history to {self.history_file}.", exc_info=True)
+
+    def predict(self, features):
+        '''
+        Predict the duration of a task. Past durations are scaled linearly by residues x cycles
+        and averaged with weights decreasing with the distance of the features.
+        '''
+        residues = max(features['residues'], 1)
+        num_cycles = max(features['num_cycles'], 1)
+        threads = max(features.get('threads', 1), 1)
+        records = [x for x in self.records if x['space'] == features['space']]
+        if records == []:
+            return DEFAULT_SECONDS_PER_RESIDUE_CYCLE.get(features['space'], 0.6) * residues * num_cycles / threads
+        weighted_sum, weight_sum = 0.0, 0.0
+        for record in records:
+            distance = abs(math.log(residues / max(record['residues'], 1)))
+            distance += abs(math.log(num_cycles / max(record['num_cycles'], 1)))
+            distance += abs(math.log(max(features['box'], 1) / max(record['box'], 1)))
+            distance += abs(features['weight'] - record['weight']) / 50
+            distance += abs(math.log(threads / max(record.get('threads', 1), 1)))
+            weight = math.exp(-4 * distance)
+            scaled = record['duration'] * residues / max(record['residues'], 1) * num_cycles / max(record['num_cycles'], 1)
+            scaled *= max(record.get('threads', 1), 1) / threads
+            weighted_sum += weight * scaled
+            weight_sum += weight
+        if weight_sum == 0:
+            return DEFAULT_SECONDS_PER_RESIDUE_CYCLE.get(features['space'], 0.6) * residues * num_cycles / threads
+        return weighted_sum / weight_sum
+
+
+class TaskScheduler:
+    '''
+    Longest-task-first ordering of tasks by predicted runtime with a live estimate of the remaining time.
+    Tasks are expected to be started in the returned order as soon as one of nproc slots is free
+    and reported with task_started and task_finished.
+    '''
+    def __init__(self, nproc, history=None):
+        self.nproc = max(1, int(nproc))
+        self.history = history
+        self.predictions = {}
+        self.features = {}
+        self.pending = []
+        self.running = {}
+        self.observed = 0.0
+        self.predicted = 0.0
+
+    def order(self, tasks, features):
+        '''
+        Sort tasks by predicted runtime (longest first).
+        features: list of task feature dicts in the same order as tasks. A task that generates
+        several replicates has the number in the feature replicates.
+        '''
+        for task, task_features in zip(tasks, features):
+            task_features = dict(task_features)
+            replicates = task_features.pop('replicates', 1)
+            self.features[task] = (task_features, replicates)
+            if not self.history is None:
+                self.predictions[task] = self.history.predict(task_features) * replicates
+            else:
+                self.predictions[task] = 0.0
+        ordered = sorted(tasks, key=lambda x: self.predictions[x], reverse=True)
+        self.pending = list(ordered)
+        return ordered
+
+    def start(self):
+        logger.info(f"Estimated time to completion: {format_duration(self.eta())}")
+
+    def task_started(self, task):
+        if task in self.pending:
+            self.pending.remove(task)
+        self.running[task] = time.time()
+
+    def _calibration(self):
+        if self.predicted > 0:
+            return self.observed / self.predicted
+        return 1.0
+
+    def task_finished(self, task, duration, success=True):
+        self.running.pop(task, None)
+        if task in self.pending:
+            self.pending.remove(task)
+        if success:
+            self.observed += duration
+            self.predicted += self.predictions.get(task, 0.0)
+            if not self.history is None:
+                task_features, replicates = self.features[task]
+                self.history.add(task_features, duration / replicates)
+        return self.eta()
+
+    def eta(self):
+        now = time.time()
+        cal = self._calibration()
+        busy = [max(self.predictions[task] * cal - (now - started), 0.0) for task, started in self.running.items()]
+        return estimate_makespan([self.predictions[task] * cal for task in self.pending], self.nproc, busy)
+
+    def finish(self):
+        if not self.history is None:
+            self.history.save()
@@ -0,0 +1,302 @@
+#Copyright 2021 Georg Kempf, Friedrich Miescher Institute for Biomedical Research
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+import re
+import logging
+from collections import defaultdict
+import numpy as np
+from rosem.preprocess import IGNORED_RESIDUES
+from rosem.selection_parser import ResidueSelection
+from rosem.spatial import get_neighbor_pairs
+
+logger = logging.getLogger("RosEM")
+
+#Distance in Angstrom between residue centers that counts as contact for domain partitioning.
+CONTACT_DISTANCE = 10.0
+#Smaller fragments of a split domain are merged with their neighbors.
+MIN_DOMAIN_RESIDUES = 30
+#Standard deviation in Angstrom of coordinate restraints on boundary and context residues.
+BOUNDARY_SD = 0.5
+CONTEXT_SD = 0.1
+#Atoms used for coordinate restraints in order of preference.
+RESTRAINT_ATOMS = ['CA', 'P', "C4'"]
+
+
+class Residue:
+    '''
+    Residue of a PDB file with its ATOM/HETATM lines.
+    '''
+    def __init__(self, chain, resseq, icode, resname):
+        self.chain = chain
+        self.resseq = resseq
+        self.icode = icode
+        self.resname = resname
+        self.lines = []
+
+    @property
+    def key(self):
+        return (self.chain, self.resseq, self.icode)
+
+    @property
+    def pdb_number(self):
+        return f"{self.resseq}{self.chain}"
+
+    def get_coords(self):
+        return np.array([[float(x[30:38]), float(x[38:46]), float(x[46:54])] for x in self.lines])
+
+    def get_atom(self, names):
+        for name in names:
+            for line in self.lines:
+                if line[12:16].strip() == name:
+                    return name, [float(line[30:38]), float(line[38:46]), float(line[46:54])]
+        return None
+
+
+def read_residues(pdb_file):
+    '''
+    Residues of the first model in pose order. Waters are skipped as in rosetta.
+    '''
+    residues = []
+    with open(pdb_file, 'r') as f:
+        for line in f:
+            if line.startswith('ENDMDL'):
+                break
+            if not line.startswith(('ATOM', 'HETATM')):
+                continue
+            resname = line[17:20].strip()
+            if resname in IGNORED_RESIDUES:
+                continue
+            key = (line[21], int(line[22:26]), line[26])
+            if residues == [] or not residues[-1].key == key:
+                residues.append(Residue(line[21], int(line[22:26]), line[26], resname))
+            residues[-1].lines.append(line)
+    return residues
+
+
+def get_centers(residues):
+    return np.array([x.get_coords().mean(axis=0) for x in residues]).reshape(-1, 3)
+
+
+def _get_components(members, pairs):
+    '''
+    Connected components of the contact graph restricted to members.
+    '''
+    members = set(members)
+    neighbors = defaultdict(list)
+    for i, j in pairs.tolist():
+        if i in members and j in members:
+            neighbors[i].append(j)
+            neighbors[j].append(i)
+    components, visited = [], set()
+    for start in sorted(members):
+        if start in visited:
+            continue
+        component, stack = [], [start]
+        visited.add(start)
+        while stack:
+            i = stack.pop()
+            component.append(i)
+            for j in neighbors[i]:
+                if not j in visited:
+                    visited.add(j)
+                    stack.append(j)
+        components.append(sorted(component))
+    return components
+
+
+def _split_domain(segment, centers, pairs):
+    '''
+    Split a segment in two halves along its principal axis. Fragments of a half that are
+    not in contact with the rest of the half are merged with the piece they have most contacts with.
+    '''
+    points = centers[segment] - centers[segment].mean(axis=0)
+    axis = np.linalg.svd(points, full_matrices=False)[2][0]
+    order = np.argsort(points @ axis)
+    half = len(segment) // 2
+    pieces = []
+    for members in ([segment[x] for x in order[:half]], [segment[x] for x in order[half:]]):
+        pieces.extend(_get_components(members, pairs))
+    pieces.sort(key=len, reverse=True)
+    large = [x for x in pieces if len(x) >= MIN_DOMAIN_RESIDUES]
+    if large == []:
+        large = pieces[:1]
+    for piece in [x for x in pieces if not any([x is y for y in large])]:
+        piece_set = set(piece)
+        contacts = []
+        for target in large:
+            target_set = set(target)
+            contacts.append(sum([1 for i, j in pairs.tolist() if (i in piece_set and j in target_set) or (j in piece_set and i in target_set)]))
+        large[int(np.argmax(contacts))].extend(piece)
+    return [sorted(x) for x in large]
+
+
+def partition_by_chain(residues):
+    chains = defaultdict(list)
+    for i, residue in enumerate(residues):
+        chains[residue.chain].append(i)
+    return list(chains.values())
+
+
+def partition_by_domain(residues, max_residues):
+    '''
+    Chains are split into domains of the residue contact graph until no domain
+    has more than max_residues residues.
+    '''
+    centers = get_centers(residues)
+    pairs = get_neighbor_pairs(centers, CONTACT_DISTANCE)
+    stack = partition_by_chain(residues)
+    segments = []
+    while stack:
+        segment = stack.pop()
+        if len(segment) <= max_residues or len(segment) < 2 * MIN_DOMAIN_RESIDUES:
+            segments.append(segment)
+            continue
+        pieces = _split_domain(segment, centers, pairs)
+        if len(pieces) < 2:
+            segments.append(segment)
+        else:
+            stack.extend(pieces)
+    return sorted(segments, key=lambda x: x[0])
+
+
+def partition_by_selection(residues, selections):
+    '''
+    One segment per selection string. A residue belongs to the first selection that contains it.
+    Residues not covered by any selection are not refined.
+    '''
+    residue_tuples = [(x.chain, x.resseq, x.resname) for x in residues]
+    assigned = set()
+    segments = []
+    for selection in selections:
+        selected = ResidueSelection(selection).get_selected(residue_tuples) - assigned
+        if len(selected) == 0:
+            logger.warning(f"No residues found for segment selection \"{selection}\".")
+            continue
+        assigned |= selected
+        segments.append(sorted(selected))
+    if len(assigned) < len(residues):
+        logger.warning(f"{len(residues) - len(assigned)} residues are not part of a segment and are not refined.")
+    return segments
+
+
+def get_boundaries(residues, segments, context_distance):
+    '''
+    For each segment the residues at the boundary to other segments and the residues of
+    other segments within context_distance (context).
+    '''
+    segment_of = {}
+    for i, segment in enumerate(segments):
+        for position in segment:
+            segment_of[position] = i
+    boundary = [set() for _ in segments]
+    context = [set() for _ in segments]
+    for i, j in get_neighbor_pairs(get_centers(residues), context_distance).tolist():
+        si, sj = segment_of.get(i), segment_of.get(j)
+        if si == sj:
+            continue
+        for own, own_segment, other in ((i, si, j), (j, sj, i)):
+            if not own_segment is None:
+                boundary[own_segment].add(own)
+                context[own_segment].add(other)
+    return boundary, context
+
+
+def write_segment_model(residues, positions, out_file):
+    with open(out_file, 'w') as f:
+        for position in sorted(positions):
+            f.writelines(residues[position].lines)
+        f.write("END\n")
+
+
+def _get_restraint(residue, anchor, sd):
+    atom = residue.get_atom(RESTRAINT_ATOMS)
+    if atom is None or not residue.icode == ' ':
+        return None
+    name, (x, y, z) = atom
+    return f"CoordinateConstraint {name} {residue.pdb_number} {anchor[0]} {anchor[1]} {x:.3f} {y:.3f} {z:.3f} HARMONIC 0.0 {sd}\n"
+
+
+def write_segment_restraints(residues, positions, boundary, context, out_file, cst_file=None):
+    '''
+    Coordinate restraints that hold the boundary and context residues of a segment in place.
+    Restraints from cst_file (PDB numbering) are added if all their residues are in the segment.
+    Restraints without PDB numbered residues are skipped.
+    Returns the number of restraints.
+    '''
+    positions = sorted(positions)
+    anchor = None
+    for position in positions:
+        atom = residues[position].get_atom(RESTRAINT_ATOMS)
+        if not atom is None:
+            anchor = (atom[0], residues[position].pdb_number)
+            break
+    lines = []
+    if not anchor is None:
+        for position in sorted(boundary):
+            lines.append(_get_restraint(residues[position], anchor, BOUNDARY_SD))
+        for position in sorted(context):
+            lines.append(_get_restraint(residues[position], anchor, CONTEXT_SD))
+    lines = [x for x in lines if not x is None]
+    if not cst_file is None:
+        pdb_numbers = {residues[x].pdb_number for x in positions}
+        skipped = 0
+        with open(cst_file, 'r') as f:
+            for line in f:
+                if line.strip() == '' or line.lstrip().startswith('#'):
+                    continue
+                refs = [x for x in line.split() if re.match(r"^-?\d+[A-Za-z]$", x)]
+                #Pose numbers refer to the full model and cannot be mapped to the segment
+                if refs == []:
+                    skipped += 1
+                elif all([x in pdb_numbers for x in refs]):
+                    lines.append(line if line.endswith('\n') else line + '\n')
+        if skipped > 0:
+            logger.warning(f"{skipped} restraints in {cst_file} without PDB numbering (e.g. 10A) are not used in segments.")
+    with open(out_file, 'w') as f:
+        f.writelines(lines)
+    return len(lines)
+
+
+def merge_models(residues, segments, segment_models, out_file):
+    '''
+    Replace the residues of each segment with the residues of its refined model.
+    Residues that are not part of a segment or missing in the refined model are taken from the input.
+    Returns the number of segment residues missing in the refined models.
+    '''
+    refined = {}
+    segment_keys = set()
+    for segment, model in zip(segments, segment_models):
+        keys = {residues[x].key for x in segment}
+        segment_keys |= keys
+        for residue in read_residues(model):
+            if residue.key in keys:
+                refined[residue.key] = residue
+    missing = 0
+    atom_num = 1
+    with open(out_file, 'w') as f:
+        prev_chain = None
+        for residue in residues:
+            if not prev_chain is None and not residue.chain == prev_chain:
+                f.write("TER\n")
+            prev_chain = residue.chain
+            if residue.key in refined:
+                lines = refined[residue.key].lines
+            else:
+                lines = residue.lines
+                if residue.key in segment_keys:
+                    missing += 1
+            for line in lines:
+                f.write(f"{line[:6]}{atom_num % 100000:5d}{line[11:]}")
+                atom_num += 1
+        f.write("TER\nEND\n")
+    return missing
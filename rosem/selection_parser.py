@@ -215,6 +215,93 @@ class ResidueSelection:
             logger.debug(self.converted_lst)
             return self.converted_lst
 
+    def _match_index(self, values, residues):
+        '''
+        Rosetta resnums: pose numbers (10, 10-50) or PDB numbers with chain (10A, 10A-50A).
+        '''
+        selected = set()
+        for value in values.split(','):
+            limits = []
+            for resnum in value.split('-'):
+                m = re.match(r"^(\d+)([A-Za-z]?)$", resnum)
+                if m is None:
+                    raise SelectionParserError(f"Could not interpret residue number {resnum}.")
+                limits.append((int(m.group(1)), m.group(2)))
+            first, last = limits[0], limits[-1]
+            for i, (chain, resseq, resname) in enumerate(residues):
+                if first[1] == '':
+                    #Pose numbering starts at 1
+                    if first[0] <= i + 1 <= last[0]:
+                        selected.add(i)
+                elif chain == first[1] and first[0] <= resseq <= last[0]:
+                    selected.add(i)
+        return selected
+
+    def _select(self, name, selectors, residues):
+        type, name, values, invert = selectors[name]
+        if type in ['And', 'Or']:
+            subsets = [self._select(x, selectors, residues) for x in values.split(',') if x in selectors]
+            if subsets == []:
+                selected = set()
+            elif type == 'And':
+                selected = set.intersection(*subsets)
+            else:
+                selected = set.union(*subsets)
+        elif type == 'Chain':
+            selected = {i for i, x in enumerate(residues) if x[0] in values.split(',')}
+        elif type == 'ResidueName':
+            selected = {i for i, x in enumerate(residues) if x[2] in values.split(',')}
+        else:
+            selected = self._match_index(values, residues)
+        if invert:
+            selected = set(range(len(residues))) - selected
+        return selected
+
+    def get_selected(self, residues):
+        '''
+        Evaluate the selection on a model in the same way as the movemap in the rosetta xml.
+        residues: list of (chain, residue number, residue name) in pose order.
+        Returns the set of selected positions in residues.
+        '''
+        converted_lst = self.get_list()
+        selectors = {x[1]: x for x in converted_lst}
+        types = [x[0] for x in converted_lst]
+        root_len = min([len(x[1]) for x in converted_lst])
+        if 'And' in types or 'Or' in types:
+            roots = [x[1] for x in converted_lst if x[0] in ['And', 'Or'] and len(x[1]) == root_len]
+        else:
+            roots = [x[1] for x in converted_lst]
+        selected = set()
+        for name in roots:
+            selected |= self._select(name, selectors, residues)
+        return selected
+
+def get_selection_string(residues, positions, flank=0):
+    '''
+    Selection string of residue ranges in PDB numbering (resi 10A-20A or resi 5B) that covers the
+    positions and flank neighboring residues of the same chain on each side.
+    residues: list of (chain, residue number, residue name) in pose order.
+    '''
+    selected = set()
+    for position in positions:
+        for i in range(position - flank, position + flank + 1):
+            if 0 <= i < len(residues) and residues[i][0] == residues[position][0]:
+                selected.add(i)
+    ranges = []
+    for i in sorted(selected):
+        if not ranges == [] and ranges[-1][1] == i - 1 and residues[ranges[-1][0]][0] == residues[i][0]:
+            ranges[-1][1] = i
+        else:
+            ranges.append([i, i])
+    terms = []
+    for first, last in ranges:
+        chain = residues[first][0]
+        if first == last:
+            terms.append(f"resi {residues[first][1]}{chain}")
+        else:
+            terms.append(f"resi {residues[first][1]}{chain}-{residues[last][1]}{chain}")
+    return ' or '.join(terms)
+
 def main():
     logger = logging.getLogger('RosEM')
     formatter = logging.Formatter("[%(filename)s:%(lineno)s - %(funcName)20s() ] %(message)s")
@@ -0,0 +1,140 @@
+#Copyright 2021 Georg Kempf, Friedrich Miescher Institute for Biomedical Research
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+import os
+import sys
+import json
+import shlex
+import subprocess
+import logging
+from jinja2 import Environment, PackageLoader
+
+logger = logging.getLogger("RosEM")
+
+ARRAY_DIR = 'slurm_array'
+ARRAY_TASKS_FILE = 'array_tasks.json'
+ARRAY_TEMPLATE = 'array_task_slurm.j2'
+GATHER_TEMPLATE = 'gather_slurm.j2'
+#Options of the submitting command that are not passed on to array tasks and the gather job.
+SUBMIT_ONLY_OPTIONS = ['--slurm_array']
+#Minimum memory in GB of the gather job (selection of the best models and validation).
+GATHER_MEMORY = 8
+
+
+def get_array_dir(job_dir):
+    return os.path.join(job_dir, ARRAY_DIR)
+
+
+def get_rosemcl_command(argv=None):
+    '''
+    Command to rerun rosemcl with the arguments of the current process on a compute node.
+    '''
+    if argv is None:
+        argv = sys.argv[1:]
+    args = [x for x in argv if not x in SUBMIT_ONLY_OPTIONS]
+    return ' '.join([shlex.quote(x) for x in [sys.executable, '-m', 'rosem.rosemcl'] + args])
+
+
+def render_template(template_name, **kwargs):
+    env = Environment(loader=PackageLoader("rosem", "templates"))
+    return env.get_template(template_name).render(**kwargs)
+
+
+def write_script(script_file, content):
+    with open(script_file, 'w') as f:
+        f.write(content)
+    os.chmod(script_file, 0o755)
+
+
+def write_array_tasks(job_dir, tasks, inputs=None):
+    '''
+    tasks: list of (model, weight) tuples. The array task index is the position in the list.
+    inputs: dict of input files generated by the submitting job (e.g. cst_file, map_file).
+    '''
+    with open(os.path.join(get_array_dir(job_dir), ARRAY_TASKS_FILE), 'w') as f:
+        json.dump({'inputs': inputs if not inputs is None else {},
+                   'tasks': [[mdl, str(wt)] for mdl, wt in tasks]}, f, indent=2)
+
+
+def has_array_tasks(job_dir):
+    return os.path.exists(os.path.join(get_array_dir(job_dir), ARRAY_TASKS_FILE))
+
+
+def read_array_tasks(job_dir):
+    array_tasks_file = os.path.join(get_array_dir(job_dir), ARRAY_TASKS_FILE)
+    if not os.path.exists(array_tasks_file):
+        logger.error(f"Array task list {array_tasks_file} not found.")
+        raise SystemExit
+    with open(array_tasks_file, 'r') as f:
+        array_tasks = json.load(f)
+    return array_tasks['inputs'], [(mdl, wt) for mdl, wt in array_tasks['tasks']]
+
+
+def submit(script_file, sbatch='sbatch', dependency=None):
+    '''
+    Submit a script with sbatch and return the job id.
+    dependency: job id of an array job that has to end before the job starts.
+    '''
+    cmd = shlex.split(sbatch) + ['--parsable']
+    if not dependency is None:
+        cmd.append(f"--dependency=afterany:{dependency}")
+    cmd.append(script_file)
+    logger.debug(f"Submitting: {' '.join(cmd)}")
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True)
+    except OSError:
+        logger.error(f"Could not run {sbatch}.", exc_info=True)
+        raise SystemExit
+    if not result.returncode == 0:
+        logger.error(f"Submission of {script_file} failed with exit code {result.returncode}: {result.stderr.strip()}")
+        raise SystemExit
+    #Output of --parsable is jobid[;cluster]
+    job_id = result.stdout.strip().split('\n')[-1].split(';')[0]
+    if not job_id.isdigit():
+        logger.error(f"Could not read job id from sbatch output: {result.stdout.strip()}")
+        raise SystemExit
+    return job_id
+
+
+def submit_array(job_dir, tasks, log_file, inputs=None, nproc=1, mem=1, account=None, sbatch='sbatch', argv=None):
+    '''
+    Submit one array task per (model, weight) task and a gather job that runs after all array tasks ended.
+    mem: memory in GB per array task. The gather job requests this memory (at least GATHER_MEMORY) in total.
+    Returns the job ids of the array job and the gather job.
+    '''
+    array_dir = get_array_dir(job_dir)
+    if not os.path.exists(array_dir):
+        os.mkdir(array_dir)
+    write_array_tasks(job_dir, tasks, inputs)
+    command = get_rosemcl_command(argv)
+    array_script = os.path.join(array_dir, 'array_tasks.run')
+    write_script(array_script, render_template(ARRAY_TEMPLATE,
+                                               account=account,
+                                               num_tasks=len(tasks),
+                                               mem=mem,
+                                               job_dir=job_dir,
+                                               array_dir=array_dir,
+                                               command=command))
+    gather_script = os.path.join(array_dir, 'gather.run')
+    write_script(gather_script, render_template(GATHER_TEMPLATE,
+                                                account=account,
+                                                cpu=nproc,
+                                                mem=max(mem, GATHER_MEMORY),
+                                                job_dir=job_dir,
+                                                logfile=os.path.abspath(log_file),
+                                                command=command))
+    array_job_id = submit(array_script, sbatch)
+    logger.info(f"Submitted array job {array_job_id} with {len(tasks)} tasks.")
+    gather_job_id = submit(gather_script, sbatch, dependency=array_job_id)
+    logger.info(f"Submitted gather job {gather_job_id}. It runs after all array tasks ended.")
+    return array_job_id, gather_job_id
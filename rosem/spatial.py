@@ -0,0 +1,72 @@
+#Copyright 2021 Georg Kempf, Friedrich Miescher Institute for Biomedical Research
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+import numpy as np
+
+#Offsets of the cell itself and half of its 26 neighbors, so that each pair of cells is visited once.
+HALF_SHELL = [x for x in np.ndindex(3, 3, 3) if tuple(np.array(x) - 1) >= (0, 0, 0)]
+
+
+class CellList:
+    '''
+    Spatial index of points binned into cubic cells of size cell_size.
+    Points are sorted by cell, so that the points of a cell are a contiguous range.
+    '''
+    def __init__(self, points, cell_size):
+        self.points = np.asarray(points, dtype=float).reshape(-1, 3)
+        self.cell_size = cell_size
+        cells = np.floor(self.points / cell_size).astype(np.int64)
+        if len(cells) > 0:
+            cells -= cells.min(axis=0)
+        #One empty layer on each side so that neighbor cells of all points have valid ids
+        self.grid = cells.max(axis=0) + 3 if len(cells) > 0 else np.ones(3, dtype=np.int64)
+        self.cells = cells + 1
+        cell_ids = self._get_ids(self.cells)
+        self.order = np.argsort(cell_ids, kind='stable')
+        #Occupied cells with the range of their points in order
+        self.cell_ids, self.starts, self.counts = np.unique(cell_ids[self.order], return_index=True, return_counts=True)
+
+    def _get_ids(self, cells):
+        return (cells[:, 0] * self.grid[1] + cells[:, 1]) * self.grid[2] + cells[:, 2]
+
+    def get_pairs(self, cutoff):
+        '''
+        Pairs (i, j) with i < j of points closer than cutoff (at most the cell size).
+        '''
+        pairs = []
+        for offset in HALF_SHELL:
+            neighbor_ids = self._get_ids(self.cells + np.array(offset) - 1)
+            index = np.minimum(np.searchsorted(self.cell_ids, neighbor_ids), len(self.cell_ids) - 1)
+            occupied = self.cell_ids[index] == neighbor_ids
+            starts = self.starts[index]
+            counts = np.where(occupied, self.counts[index], 0)
+            i = np.repeat(np.arange(len(self.points)), counts)
+            #Position of each pair in the range of its neighbor cell
+            within = np.arange(len(i)) - np.repeat(np.cumsum(counts) - counts, counts)
+            j = self.order[np.repeat(starts, counts) + within]
+            if offset == (1, 1, 1):
+                keep = i < j
+                i, j = i[keep], j[keep]
+            close = np.sum((self.points[i] - self.points[j]) ** 2, axis=1) < cutoff ** 2
+            i, j = i[close], j[close]
+            pairs.append(np.stack([np.minimum(i, j), np.maximum(i, j)], axis=1))
+        return np.concatenate(pairs)
+
+
+def get_neighbor_pairs(points, cutoff):
+    '''
+    Pairs (i, j) with i < j of points closer than cutoff.
+    '''
+    if len(points) == 0:
+        return np.zeros((0, 2), dtype=int)
+    return CellList(points, cutoff).get_pairs(cutoff)
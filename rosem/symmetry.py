@@ -0,0 +1,243 @@
+#Copyright 2021 Georg Kempf, Friedrich Miescher Institute for Biomedical Research
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+import math
+import logging
+from collections import OrderedDict
+import numpy as np
+
+logger = logging.getLogger("RosEM")
+
+#Maximum CA RMSD in Angstrom between a chain and the symmetry copy of the reference chain.
+MAX_SYMMETRY_RMSD = 2.0
+#Maximum angle in degrees between the rotation axes of the chains.
+MAX_AXIS_ANGLE = 10.0
+#Chains with this fraction of residues in common (same number and residue name) have the same sequence.
+MIN_SEQUENCE_IDENTITY = 0.9
+
+
+class CyclicSymmetry:
+    '''
+    Cyclic point group Cn with the rotation axis through center.
+    asu_chains: chains of the asymmetric unit, one of each entity.
+    '''
+    def __init__(self, n, center, axis, asu_chains, rmsd):
+        self.n = n
+        self.center = center
+        self.axis = axis
+        self.asu_chains = asu_chains
+        self.rmsd = rmsd
+
+    @property
+    def name(self):
+        return f"C{self.n}"
+
+    def get_rotation(self, k):
+        return rotation_matrix(self.axis, 2 * math.pi * k / self.n)
+
+    def apply(self, coords, k):
+        return (coords - self.center) @ self.get_rotation(k).T + self.center
+
+
+def rotation_matrix(axis, angle):
+    '''
+    Rotation by angle (radians) about a unit axis (Rodrigues formula).
+    '''
+    x, y, z = axis
+    k = np.array([[0, -z, y], [z, 0, -x], [-y, x, 0]])
+    return np.eye(3) + math.sin(angle) * k + (1 - math.cos(angle)) * k @ k
+
+
+def superimpose(mobile, target):
+    '''
+    Least-squares rotation and translation (Kabsch) that superimpose mobile onto target.
+    Returns rotation, translation and RMSD after superposition.
+    '''
+    mobile_center, target_center = mobile.mean(axis=0), target.mean(axis=0)
+    h = (mobile - mobile_center).T @ (target - target_center)
+    u, s, vt = np.linalg.svd(h)
+    d = np.sign(np.linalg.det(vt.T @ u.T))
+    rotation = vt.T @ np.diag([1, 1, d]) @ u.T
+    translation = target_center - mobile_center @ rotation.T
+    rmsd = np.sqrt(np.mean(np.sum((mobile @ rotation.T + translation - target) ** 2, axis=1)))
+    return rotation, translation, rmsd
+
+
+def get_rotation_axis(rotation):
+    axis = np.array([rotation[2, 1] - rotation[1, 2],
+                     rotation[0, 2] - rotation[2, 0],
+                     rotation[1, 0] - rotation[0, 1]])
+    norm = np.linalg.norm(axis)
+    if norm < 1e-6:
+        return None
+    return axis / norm
+
+
+def get_chains(residues):
+    '''
+    CA atoms of each chain: dict chain -> OrderedDict (residue number, insertion code) -> (residue name, xyz)
+    '''
+    chains = OrderedDict()
+    for residue in residues:
+        atom = residue.get_atom(['CA'])
+        if atom is None:
+            continue
+        chains.setdefault(residue.chain, OrderedDict())[(residue.resseq, residue.icode)] = (residue.resname, atom[1])
+    return chains
+
+
+def _get_ca(chain):
+    return np.array([x[1] for x in chain.values()]).reshape(-1, 3)
+
+
+def _get_common(chain_1, chain_2):
+    '''
+    CA coordinates of the residues present in both chains with the same residue name.
+    '''
+    common = [x for x in chain_1 if x in chain_2 and chain_1[x][0] == chain_2[x][0]]
+    return np.array([chain_1[x][1] for x in common]).reshape(-1, 3), np.array([chain_2[x][1] for x in common]).reshape(-1, 3)
+
+
+def get_entities(chains):
+    '''
+    Group chains with the same sequence.
+    '''
+    entities = []
+    for chain_id, chain in chains.items():
+        for entity in entities:
+            ref = chains[entity[0]]
+            common, _ = _get_common(ref, chain)
+            if len(common) >= MIN_SEQUENCE_IDENTITY * max(len(ref), len(chain)):
+                entity.append(chain_id)
+                break
+        else:
+            entities.append([chain_id])
+    return entities
+
+
+def _match_copy(symmetry, chains, ref_id, candidates, k):
+    '''
+    Chain of candidates that matches the k-th symmetry copy of the reference chain or None.
+    '''
+    best = None
+    for chain_id in candidates:
+        ref, target = _get_common(chains[ref_id], chains[chain_id])
+        if len(ref) < 3:
+            continue
+        rmsd = np.sqrt(np.mean(np.sum((symmetry.apply(ref, k) - target) ** 2, axis=1)))
+        if rmsd < MAX_SYMMETRY_RMSD and (best is None or rmsd < best[1]):
+            best = (chain_id, rmsd)
+    return best
+
+
+def detect_cyclic_symmetry(residues):
+    '''
+    Detect cyclic (Cn) symmetry of a model from the superposition of chains with the same sequence.
+    All entities must have n copies that are related by the same n-fold rotation.
+    Returns CyclicSymmetry or None.
+    '''
+    chains = get_chains(residues)
+    entities = get_entities(chains)
+    n = len(entities[0]) if not entities == [] else 0
+    if n < 2 or not all([len(x) == n for x in entities]):
+        logger.debug(f"No symmetry: chains per entity {[len(x) for x in entities]}")
+        return None
+    #Rotation axes of the superposition of the reference chain onto the other copies
+    reference = max(entities, key=lambda x: len(chains[x[0]]))
+    ref_id = reference[0]
+    axes, rotations, translations = [], [], []
+    for chain_id in reference[1:]:
+        mobile, target = _get_common(chains[ref_id], chains[chain_id])
+        if len(mobile) < 3:
+            return None
+        rotation, translation, rmsd = superimpose(mobile, target)
+        rotations.append(rotation)
+        translations.append(translation)
+        axis = get_rotation_axis(rotation)
+        if axis is None or rmsd > MAX_SYMMETRY_RMSD:
+            return None
+        if not axes == [] and np.dot(axis, axes[0]) < 0:
+            axis = -axis
+        axes.append(axis)
+    axis = np.mean(axes, axis=0)
+    axis /= np.linalg.norm(axis)
+    if any([np.degrees(np.arccos(min(1.0, abs(np.dot(axis, x))))) > MAX_AXIS_ANGLE for x in axes]):
+        logger.debug("No symmetry: rotation axes are not parallel.")
+        return None
+    #Point on all rotation axes (least squares) closest to the center of the reference entity
+    center, _, _, _ = np.linalg.lstsq(np.concatenate([np.eye(3) - x for x in rotations]),
+                                      np.concatenate(translations), rcond=None)
+    centroid = np.concatenate([_get_ca(chains[x]) for x in reference]).mean(axis=0)
+    center += np.dot(centroid - center, axis) * axis
+    symmetry = CyclicSymmetry(n, center, axis, [], 0.0)
+    #Asymmetric unit: reference chain and the closest chain of each other entity
+    ref_center = _get_ca(chains[ref_id]).mean(axis=0)
+    asu_chains = [ref_id]
+    for entity in [x for x in entities if not x is reference]:
+        distances = [np.linalg.norm(_get_ca(chains[x]).mean(axis=0) - ref_center) for x in entity]
+        asu_chains.append(entity[int(np.argmin(distances))])
+    rmsds = []
+    for asu_chain, entity in zip(asu_chains, [reference] + [x for x in entities if not x is reference]):
+        matched = set()
+        for k in range(1, n):
+            match = _match_copy(symmetry, chains, asu_chain, [x for x in entity if not x == asu_chain], k)
+            if match is None or match[0] in matched:
+                logger.debug(f"No symmetry: no match for copy {k} of chain {asu_chain}.")
+                return None
+            matched.add(match[0])
+            rmsds.append(match[1])
+    symmetry.asu_chains = asu_chains
+    symmetry.rmsd = float(np.mean(rmsds))
+    return symmetry
+
+
+def _format_vector(v):
+    return ','.join([f"{x:.6f}" for x in v])
+
+
+def write_symmdef(symmetry, residues, symm_file):
+    '''
+    Write a rosetta symmetry definition for cyclic symmetry in the layout of make_symmdef_file.pl (NCS mode).
+    Each subunit has a virtual residue at the symmetry center (VRTk) with the x axis pointing to the
+    subunit and a virtual residue at the center of mass of the subunit (VRTk_base).
+    '''
+    n = symmetry.n
+    chains = get_chains(residues)
+    com = np.concatenate([_get_ca(chains[x]) for x in symmetry.asu_chains]).mean(axis=0)
+    radial = com - symmetry.center
+    radial -= np.dot(radial, symmetry.axis) * symmetry.axis
+    if np.linalg.norm(radial) < 1e-3:
+        raise ValueError("Center of mass of the asymmetric unit is on the symmetry axis.")
+    x_axis = radial / np.linalg.norm(radial)
+    interfaces = [f"{n if not 2 * k == n else n // 2}*(VRT0_base:VRT{k}_base)" for k in range(1, n // 2 + 1)]
+    lines = [f"symmetry_name {symmetry.name}\n",
+             f"E = {n}*VRT0_base + {' + '.join(interfaces)}\n",
+             "anchor_residue COM\n",
+             "virtual_coordinates_start\n"]
+    for k in range(n):
+        rotation = symmetry.get_rotation(k)
+        x_k = rotation @ x_axis
+        lines.append(f"xyz VRT{k} {_format_vector(x_k)} {_format_vector(symmetry.axis)} {_format_vector(symmetry.center)}\n")
+        lines.append(f"xyz VRT{k}_base {_format_vector(x_k)} {_format_vector(symmetry.axis)} {_format_vector(symmetry.apply(com, k))}\n")
+    lines.append("virtual_coordinates_stop\n")
+    for k in range(n):
+        lines.append(f"connect_virtual JUMP{k}_to_com VRT{k} VRT{k}_base\n")
+        lines.append(f"connect_virtual JUMP{k}_to_subunit VRT{k}_base SUBUNIT\n")
+    for k in range(1, n):
+        lines.append(f"connect_virtual JUMP{k} VRT0 VRT{k}\n")
+    lines.append("set_dof JUMP0_to_com x y z\n")
+    lines.append("set_dof JUMP0_to_subunit angle_x angle_y angle_z\n")
+    lines.append(f"set_jump_group JUMPGROUP1 {' '.join([f'JUMP{k}_to_com' for k in range(n)])}\n")
+    lines.append(f"set_jump_group JUMPGROUP2 {' '.join([f'JUMP{k}_to_subunit' for k in range(n)])}\n")
+    with open(symm_file, 'w') as f:
+        f.writelines(lines)
@@ -12,13 +12,46 @@
 #See the License for the specific language governing permissions and
 #limitations under the License.
 import os
+import hashlib
 from multiprocessing import Process
 import signal
 import sys
+from rosem import mrc
 
 def get_filename(file):
     return os.path.splitext(os.path.basename(file))[0]
 
+def hash_file(file, block_size=1048576):
+    sha = hashlib.sha256()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def get_rosem_dir():
+    rosem_dir = os.path.join(os.path.expanduser("~"), '.rosem')
+    if not os.path.exists(rosem_dir):
+        os.makedirs(rosem_dir, exist_ok=True)
+    return rosem_dir
+
+def get_residue_count(pdb_file):
+    residues = set()
+    with open(pdb_file, 'r') as f:
+        for line in f:
+            if line.startswith("ATOM") or line.startswith("HETATM"):
+                residues.add(line[21:27])
+    return len(residues)
+
+def get_atom_count(pdb_file):
+    with open(pdb_file, 'r') as f:
+        return len([line for line in f if line.startswith("ATOM") or line.startswith("HETATM")])
+
+def get_map_dimensions(map_file):
+    '''
+    Read the number of columns, rows and sections from the MRC header.
+    '''
+    return mrc.MrcFile(map_file).dimensions
+
 def multiprocessing_routine(queue, nproc, target_func):
     
     while queue.qsize() > 0:
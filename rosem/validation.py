@@ -18,6 +18,7 @@ from subprocess import Popen, PIPE
 from dataclasses import dataclass, asdict
 from typing import Optional
 import rosem.utils as utils
+from rosem import geometry, clashes
 import json
 import logging
 import sys
@@ -36,6 +37,13 @@ def get_fsc(model):
                 fsc = groups.group(4)
         return fsc, fsc_resolution_low, fsc_resolution_high, fsc_mask
 
+def has_fsc(model):
+    with open(model, 'r') as f:
+        for line in f:
+            if re.search("REMARK\s*1\s*FSC", line):
+                return True
+    return False
+
 def get_fsc_test(model):
     fsc = 0.0
     with open(model, 'r') as f:
@@ -116,22 +124,15 @@ def _get_validation_results(file):
 
         return stats_dict
 
-def run_validation(model, exec_path, stage='post-ref'):
-    cmd = [exec_path,
-           model,
-           ]
-    logger.debug(cmd)
-    validation_log = 'phenix_validation_{}_{}.log'.format(utils.get_filename(model), stage)
-    with open(validation_log, 'w') as f:
-        p = Popen(' '.join(cmd), shell=True, stdout=f, stderr=PIPE)
-        _, error = p.communicate()
-        if not error is None:
-            error = error.decode()
-            if len(error) > 0:
-                logger.error(f"The following error occured during validation:\n{error}")
+def get_validation_log(model, stage='post-ref'):
+    return 'phenix_validation_{}_{}.log'.format(utils.get_filename(model), stage)
 
+def get_validation_results(model, validation_log):
     if os.path.exists(validation_log):
         stats = _get_validation_results(validation_log)
+        if stats is None:
+            logger.error(f"Could not read validation results from {validation_log}.")
+            return None
         fsc, fsc_resolution_low, fsc_resolution_high, fsc_mask =  get_fsc(model)
         fsc_test = get_fsc_test(model)
         try:
@@ -147,6 +148,44 @@ def run_validation(model, exec_path, stage='post-ref'):
     else:
         logger.debug("No validation output found.")
 
+def get_fast_validation_results(model):
+    '''
+    Validation in-process without phenix. Cis and twisted peptides (percent, as in molprobity) fill the
+    Stats fields. Backbone bond and angle RMSD to ideal values and the approximate clashscore of heavy atoms
+    are not comparable with phenix and are returned as backbone_bonds, backbone_angles and approx_clashscore.
+    Other Stats fields are None.
+    '''
+    backbone = geometry.BackboneGeometry(model)
+    stats = Stats()
+    peptides = backbone.get_peptides()
+    stats.cis_proline = peptides['cis_proline']
+    stats.cis_general = peptides['cis_general']
+    stats.twisted_proline = peptides['twisted_proline']
+    stats.twisted_general = peptides['twisted_general']
+    stats_dict = asdict(stats)
+    stats_dict['backbone_bonds'] = geometry.get_rmsd(backbone.get_bond_deviations())
+    stats_dict['backbone_angles'] = geometry.get_rmsd(backbone.get_angle_deviations())
+    stats_dict['approx_clashscore'] = clashes.get_clashscore(model)
+    stats_dict['model'] = os.path.basename(model)
+    if has_fsc(model):
+        stats_dict['fsc'] = get_fsc(model)[0]
+    return stats_dict
+
+def run_validation(model, exec_path, stage='post-ref'):
+    cmd = [exec_path,
+           model,
+           ]
+    logger.debug(cmd)
+    validation_log = get_validation_log(model, stage)
+    with open(validation_log, 'w') as f:
+        p = Popen(' '.join(cmd), shell=True, stdout=f, stderr=PIPE)
+        _, error = p.communicate()
+        if not error is None:
+            error = error.decode()
+            if len(error) > 0:
+                logger.error(f"The following error occured during validation:\n{error}")
+    return get_validation_results(model, validation_log)
+
 
 if __name__ == '__main__':
     run_validation(sys.argv[1], sys.argv[2])
\ No newline at end of file
@@ -0,0 +1,197 @@
+#Copyright 2021 Georg Kempf, Friedrich Miescher Institute for Biomedical Research
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+import math
+import logging
+import numpy as np
+
+logger = logging.getLogger("RosEM")
+
+#(resolution, density weight) pairs used to derive a starting weight. Better maps tolerate higher weights.
+PRIOR_TABLE = [(2.0, 60.0),
+               (3.0, 45.0),
+               (3.5, 35.0),
+               (4.5, 25.0),
+               (6.0, 15.0)]
+MIN_WEIGHT = 5
+MAX_WEIGHT = 150
+GOLDEN_RATIO = (math.sqrt(5) - 1) / 2
+
+
+def get_prior_weight(resolution):
+    '''
+    Interpolate a starting density weight from the map resolution.
+    '''
+    resolution = float(resolution)
+    if resolution <= PRIOR_TABLE[0][0]:
+        return PRIOR_TABLE[0][1]
+    if resolution >= PRIOR_TABLE[-1][0]:
+        return PRIOR_TABLE[-1][1]
+    for (res_a, wt_a), (res_b, wt_b) in zip(PRIOR_TABLE, PRIOR_TABLE[1:]):
+        if res_a <= resolution <= res_b:
+            return wt_a + (resolution - res_a) / (res_b - res_a) * (wt_b - wt_a)
+
+
+def get_weight_bounds(resolution, weights=None):
+    '''
+    Search interval for the density weight. User supplied weights define the interval,
+    otherwise it spans half to twice the prior weight.
+    '''
+    if not weights is None and len(weights) > 1:
+        weights = [float(x) for x in weights]
+        lower, upper = min(weights), max(weights)
+    else:
+        prior = get_prior_weight(resolution)
+        lower, upper = prior / 2, prior * 2
+    lower = max(MIN_WEIGHT, int(round(lower)))
+    upper = min(MAX_WEIGHT, int(round(upper)))
+    return lower, upper
+
+
+class WeightSearch:
+    '''
+    Proposes density weights to evaluate based on the FSC values obtained so far.
+    Weights are integers because job directories are named job_w<weight>.
+    '''
+    def __init__(self, resolution, weights=None, max_steps=6):
+        self.resolution = resolution
+        self.prior = int(round(get_prior_weight(resolution)))
+        self.lower, self.upper = get_weight_bounds(resolution, weights)
+        self.prior = min(max(self.prior, self.lower), self.upper)
+        self.max_steps = max_steps
+        logger.info(f"Density weight search between {self.lower} and {self.upper} (prior {self.prior}).")
+
+    def propose(self, observed):
+        '''
+        Return a list of weights to evaluate next or an empty list if the search has converged.
+        observed: dict of weight -> FSC
+        '''
+        raise NotImplementedError
+
+    def _remaining(self, observed):
+        return self.max_steps - len(observed)
+
+    def best(self, observed):
+        if observed == {}:
+            return None
+        return max(observed, key=observed.get)
+
+
+class GoldenSectionSearch(WeightSearch):
+    '''
+    Golden-section search for the weight with the highest FSC, assuming a single maximum
+    within the interval. The first interior point is placed at the prior.
+    '''
+    def __init__(self, *args, **kwargs):
+        super(GoldenSectionSearch, self).__init__(*args, **kwargs)
+        self.a = self.lower
+        self.b = self.upper
+        self.c = None
+        self.d = None
+
+    def _interior(self):
+        c = int(round(self.b - GOLDEN_RATIO * (self.b - self.a)))
+        d = int(round(self.a + GOLDEN_RATIO * (self.b - self.a)))
+        return c, d
+
+    def _initial_points(self):
+        c, d = self._interior()
+        #Move the interior point closest to the prior onto the prior.
+        if abs(self.prior - c) <= abs(self.prior - d):
+            if self.a < self.prior < d:
+                c = self.prior
+        elif c < self.prior < self.b:
+            d = self.prior
+        return c, d
+
+    def propose(self, observed):
+        if self._remaining(observed) <= 0:
+            return []
+        if self.c is None:
+            self.c, self.d = self._initial_points()
+        while True:
+            missing = [wt for wt in (self.c, self.d) if not wt in observed]
+            if not missing == []:
+                return missing[:self._remaining(observed)]
+            if observed[self.c] >= observed[self.d]:
+                self.b = self.d
+            else:
+                self.a = self.c
+            if self.b - self.a <= 2:
+                logger.info(f"Golden-section search converged to interval {self.a}-{self.b}.")
+                return []
+            self.c, self.d = self._interior()
+            if self.c == self.d:
+                self.d += 1
+
+
+class BayesianSearch(WeightSearch):
+    '''
+    Gaussian process regression of FSC over the weight with expected improvement as
+    acquisition function. Starts with the prior and the interval bounds.
+    '''
+    def __init__(self, *args, length_scale=None, noise=1e-4, min_improvement=1e-4, **kwargs):
+        super(BayesianSearch, self).__init__(*args, **kwargs)
+        if length_scale is None:
+            length_scale = (self.upper - self.lower) / 4
+        self.length_scale = max(length_scale, 1.0)
+        self.noise = noise
+        self.min_improvement = min_improvement
+
+    def _kernel(self, x1, x2):
+        return np.exp(-0.5 * ((x1[:, None] - x2[None, :]) / self.length_scale) ** 2)
+
+    def _posterior(self, x_obs, y_obs, x_new):
+        y_mean = y_obs.mean()
+        y_std = y_obs.std() if y_obs.std() > 0 else 1.0
+        y_norm = (y_obs - y_mean) / y_std
+        k_obs = self._kernel(x_obs, x_obs) + self.noise * np.eye(len(x_obs))
+        k_new = self._kernel(x_new, x_obs)
+        chol = np.linalg.cholesky(k_obs)
+        alpha = np.linalg.solve(chol.T, np.linalg.solve(chol, y_norm))
+        mu = k_new @ alpha
+        v = np.linalg.solve(chol, k_new.T)
+        var = np.clip(1.0 - np.sum(v ** 2, axis=0), 1e-12, None)
+        return mu * y_std + y_mean, np.sqrt(var) * y_std
+
+    def _expected_improvement(self, mu, sigma, y_best):
+        z = (mu - y_best) / sigma
+        cdf = 0.5 * (1 + np.vectorize(math.erf)(z / math.sqrt(2)))
+        pdf = np.exp(-0.5 * z ** 2) / math.sqrt(2 * math.pi)
+        return (mu - y_best) * cdf + sigma * pdf
+
+    def propose(self, observed):
+        if self._remaining(observed) <= 0:
+            return []
+        initial = [wt for wt in dict.fromkeys([self.prior, self.lower, self.upper]) if not wt in observed]
+        if not initial == []:
+            return initial[:self._remaining(observed)]
+        x_obs = np.array(list(observed.keys()), dtype=float)
+        y_obs = np.array(list(observed.values()), dtype=float)
+        candidates = np.array([wt for wt in range(self.lower, self.upper + 1) if not wt in observed], dtype=float)
+        if len(candidates) == 0:
+            return []
+        mu, sigma = self._posterior(x_obs, y_obs, candidates)
+        ei = self._expected_improvement(mu, sigma, y_obs.max())
+        if ei.max() < self.min_improvement:
+            logger.info("Expected improvement below threshold. Stopping weight search.")
+            return []
+        return [int(candidates[np.argmax(ei)])]
+
+
+def get_weight_search(method, resolution, weights=None, max_steps=6):
+    searches = {'golden': GoldenSectionSearch,
+                'bayes': BayesianSearch}
+    if not method in searches:
+        raise ValueError(f"Unknown weight search method {method}.")
+    return searches[method](resolution, weights=weights, max_steps=max_steps)